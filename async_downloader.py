@@ -1,24 +1,66 @@
+import asyncio
+import functools
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
 import httpx
-import aiometer
-import aiofiles
 from pathlib import Path
 from collections import defaultdict
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import os
 
+from download_manifest import DownloadManifest, COMPLETE, FAILED, PARTIAL
+from rate_control import FixedController
+from retry_policy import RetryPolicy, parse_retry_after
+from download_metrics import DownloadMetrics, DownloadRecord
+from download_sinks import FileSink, Sink
+from download_plan import SCHEDULES, schedule_urls
+from session_store import SessionStore
+from download_validation import (
+    BAD_DIMENSIONS,
+    INVALID_REASONS,
+    InvalidDownload,
+    StreamCheck,
+    check_dimensions,
+)
+
 from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
     Union,
     Iterable,
+    Set,
     Optional,
     DefaultDict,
     List,
+    Tuple,
 )
 
+if TYPE_CHECKING:
+    from sharded_downloader import SharedBudget
+
 
 def merra2_file_from_url(url: str) -> str:
     return url.split("/")[-1].split(".nc4?")[0]
 
 
+def log_failures(
+    directory: Path, failed_downloads: Dict[Union[int, str], List[str]]
+) -> None:
+    """Write failed URLs, grouped by reason, to the next unused directory / fails_X.txt"""
+    n = len(list(directory.glob("fails_*.txt")))
+    filepath = directory / f"fails_{n}.txt"
+    with open(filepath, "w") as f:
+        for reason, url_list in failed_downloads.items():
+            print(f"Reason: {reason}", file=f)
+            print(*url_list, sep="\n", file=f)
+
+
 class AsyncDownloader(object):
     def __init__(
         self,
@@ -27,6 +69,24 @@ class AsyncDownloader(object):
         max_per_second: float = 3.0,
         timeout: float = 30.0,
         retries: int = 1,
+        manifest_name: Optional[str] = "manifest.jsonl",
+        controller: Optional[FixedController] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        metrics: Optional[DownloadMetrics] = None,
+        metrics_interval: Optional[float] = None,
+        metrics_name: str = "metrics.json",
+        on_complete: Optional[Callable[[str, Path], Awaitable[None]]] = None,
+        sink: Optional[Sink] = None,
+        schedule: Optional[str] = None,
+        session: Optional[SessionStore] = None,
+        max_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = 30.0,
+        http1: bool = True,
+        http2: bool = False,
+        verify: bool = True,
+        validate_dimensions: bool = False,
+        validation_workers: int = 4,
+        budget: Optional["SharedBudget"] = None,
     ) -> None:
         """Class to download many files concurrently. Hardcoded for MERRA-2 reanalysis data.
 
@@ -35,14 +95,47 @@ class AsyncDownloader(object):
         directory : Union[str, Path]
             Path to output directory. Will be created if needed.
         max_at_once : int, optional
-            Max concurrent connections set by aiometer, by default 10
+            Max concurrent connections, by default 10. Ignored if controller is given.
         max_per_second : float, optional
-            Max rate of connections set by aiometer. This sleeps between function calls, so unless the function takes 0 seconds to execute, the actual rate will be slower. By default 3.0
+            Max rate of connections. This sleeps between function calls, so unless the function takes 0 seconds to execute, the actual rate will be slower. By default 3.0. Ignored if controller is given.
         timeout : float, optional
             Max seconds to wait for server response, by default 30.0
         retries : int, optional
-            How many times to retry failed connections, by default 1
-
+            How many times to retry each failed URL, by default 1. Ignored if retry_policy is given.
+        manifest_name : Optional[str], optional
+            Name of the download manifest file inside directory. URLs recorded as complete in the manifest are skipped, which makes interrupted downloads resumable. Files are written to a temporary '.part' file and renamed on completion, so a file is never left truncated under its final name. Set to None to disable the manifest and re-download everything. By default "manifest.jsonl"
+        controller : Optional[FixedController], optional
+            Sets concurrency and rate limits, which are re-read before every new connection. Pass a rate_control.AIMDController to adapt limits to server health. By default None, which uses a FixedController(max_at_once, max_per_second)
+        retry_policy : Optional[RetryPolicy], optional
+            Per-URL retry budgets and backoff delays. Each failed URL is retried on its own schedule, interleaved with first attempts of other URLs, and honors the server's Retry-After header. By default None, which uses RetryPolicy(retries)
+        metrics : Optional[DownloadMetrics], optional
+            Collects per-URL timings (queue wait, time to first byte, transfer, disk write), bytes and status, plus rolling throughput and latency quantiles. By default None, which creates a new DownloadMetrics. Available as self.metrics after the run.
+        metrics_interval : Optional[float], optional
+            If given, write metrics to directory / metrics_name every metrics_interval seconds during the run. Metrics are always written once at the end. By default None
+        metrics_name : str, optional
+            File name for metrics output. Names ending in '.prom' are written in Prometheus text format, all others as JSON. By default "metrics.json"
+        on_complete : Optional[Callable[[str, Path], Awaitable[None]]], optional
+            Coroutine function awaited with (url, filepath) after each file is successfully written. Its download slot is held until it returns, so a callback that blocks (e.g. on a full queue) applies backpressure to the download. By default None
+        sink : Optional[Sink], optional
+            Where response bodies go: download_sinks.FileSink, MemorySink or CallbackSink. The manifest is only used with FileSink, since other sinks don't persist between runs. By default None, which uses FileSink(directory)
+        schedule : Optional[str], optional
+            Download order, estimated from each URL's slabs and fields; see download_plan.schedule_urls. 'longest_first' shortens the tail of runs that mix large and small responses. 'by_date' keeps each date's files together so complete dates are available early. Either reads all URLs up front. By default None, which downloads URLs in the order given.
+        session : Optional[SessionStore], optional
+            Persists Earthdata Login cookies between runs. With a valid stored session, concurrent downloads start immediately instead of after a serial login request, and downloaders sharing the store reuse each other's logins. By default None, which logs in once per download call.
+        max_connections : Optional[int], optional
+            Size of the connection pool. Idle connections are kept alive up to this many, so connections are reused rather than re-opened as concurrency rises and falls. By default None for no limit beyond the controller's concurrency limit.
+        keepalive_expiry : Optional[float], optional
+            Seconds an idle pooled connection is kept open, by default 30.0. None keeps idle connections indefinitely.
+        http1, http2 : bool, optional
+            HTTP versions the client may use, as in httpx.AsyncClient. With http2=True, HTTPS servers that support HTTP/2 multiplex all concurrent requests over a few connections; set http1=False as well to use HTTP/2 over plain HTTP (prior knowledge). HTTP/2 requires the h2 package (pip install httpx[http2]). By default HTTP/1.1 only.
+        verify : bool, optional
+            Check each response while it streams to the sink: it must start with a netCDF or HDF5 signature and match its Content-Length. The body's sha256 is recorded in the manifest. Invalid responses are never finalized by the sink and are retried right away under the retry policy, with failure reason 'bad_signature' or 'truncated'. By default True
+        validate_dimensions : bool, optional
+            After each file is written, open it in a thread pool and check its fields and time/lat/lon sizes against the URL's request. The check runs after the response is closed, so it holds neither a connection nor a concurrency slot, and the file is only recorded as complete in the manifest once it passes. Bad files are deleted and retried right away with failure reason 'bad_dimensions'. Only used with FileSink. By default False
+        validation_workers : int, optional
+            Threads for validate_dimensions, by default 4
+        budget : Optional[SharedBudget], optional
+            Concurrency and rate budget shared with other processes, as used by sharded_downloader.ShardedDownloader. Every request waits for the budget in addition to this downloader's own limits. By default None
 
         Example
         -------
@@ -54,91 +147,416 @@ class AsyncDownloader(object):
         self.failed_downloads: DefaultDict[Union[int, str], List[str]] = defaultdict(
             list
         )
-        self._max_at_once = max_at_once
-        self._max_per_second = max_per_second
+        if controller is None:
+            controller = FixedController(max_at_once, max_per_second)
+        self.controller = controller
         self._timeout = timeout
-        self._retries = retries
+        if retry_policy is None:
+            retry_policy = RetryPolicy(retries=retries)
+        self.retry_policy = retry_policy
+        # entries are (ready time, tiebreaker, url, attempt number)
+        self._retry_queue: List[Tuple[float, int, str, int]] = []
+        self._retry_counter = itertools.count()
+        self.metrics = metrics if metrics is not None else DownloadMetrics()
+        self._metrics_interval = metrics_interval
+        self._metrics_name = metrics_name
+        self._on_complete = on_complete
+        self.sink = sink if sink is not None else FileSink(self.directory)
+        if not self.sink.persistent:
+            manifest_name = None
+        self.manifest_name = manifest_name
+        self.manifest: Optional[DownloadManifest] = None
+        if schedule is not None and schedule not in SCHEDULES:
+            raise ValueError(f"schedule must be one of {SCHEDULES}; given {schedule}")
+        self.schedule = schedule
+        self.session = session
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http1 = http1
+        self._http2 = http2
+        self.verify = verify
+        self.validate_dimensions = validate_dimensions and self.sink.persistent
+        self._validation_workers = validation_workers
+        self._validation_pool: Optional[ThreadPoolExecutor] = None
+        # dimension checks of downloaded files, run after their responses are closed,
+        # and the rest of those attempts once checked (see _validated)
+        self._validations: Set[asyncio.Future] = set()
+        self.budget = budget
+        # ShardedDownloader writes one combined failure log instead
+        self.write_failure_log = True
 
         self._client: Optional[httpx.AsyncClient] = None
 
         # merra config
         load_dotenv()
-        self._auth = (os.getenv("MERRA2_USER"), os.getenv("MERRA2_PASS"))
+        user, password = os.getenv("MERRA2_USER"), os.getenv("MERRA2_PASS")
+        self._auth = (user, password) if user is not None else None
 
     def _get_filepath(self, url: str) -> Path:
         return self.directory / merra2_file_from_url(url)
 
-    async def _write_async(self, response: httpx.Response) -> None:
+    def filepath_for_url(self, url: str) -> Path:
+        # same as the path _write_async uses, which is taken from response.url.path
+        return self._get_filepath(urlsplit(url).path)
+
+    def _is_complete(self, url: str) -> bool:
+        return self.manifest is not None and self.manifest.is_complete(
+            url, self.directory
+        )
+
+    async def _write_async(
+        self, response: httpx.Response, url: str
+    ) -> Tuple[int, float, Optional[str]]:
+        """Stream response body to the sink. Returns bytes written, seconds spent waiting on writes and the body's sha256 if verified. The file is recorded as complete in the manifest unless it still has to pass validate_dimensions."""
         filepath = self._get_filepath(response.url.path)
-        async with aiofiles.open(filepath, "wb") as f:
-            async for chunk in response.aiter_bytes():  # httpx doesn't yet support chunk_size arg
-                if chunk:
-                    await f.write(chunk)
+        # httpx doesn't yet support chunk_size arg
+        chunks: AsyncIterator[bytes] = response.aiter_bytes()
+        check = None
+        if self.verify:
+            expected_size = None
+            # Content-Length counts encoded bytes, but aiter_bytes decodes
+            if "Content-Encoding" not in response.headers:
+                expected_size = int(response.headers.get("Content-Length", -1))
+            check = StreamCheck(chunks, expected_size if expected_size != -1 else None)
+            chunks = check
+        try:
+            size, write_time = await self.sink.write(url, filepath.name, chunks)
+        except InvalidDownload:
+            if self.manifest is not None:
+                self.manifest.record(url, filepath.name, 0, FAILED)
+            raise
+        except BaseException:
+            if self.manifest is not None:
+                self.manifest.record(url, filepath.name, 0, PARTIAL)
+            raise
+        sha256 = check.hexdigest if check is not None else None
+        if not self.validate_dimensions:
+            self._record_complete(url, size, sha256)
+        return size, write_time, sha256
+
+    def _record_complete(self, url: str, size: int, sha256: Optional[str]) -> None:
+        if self.manifest is not None:
+            extra = {"sha256": sha256} if sha256 is not None else {}
+            name = self.filepath_for_url(url).name
+            self.manifest.record(url, name, size, COMPLETE, **extra)
 
-    async def _download_url(self, url: str) -> None:
+    async def _validate(
+        self, url: str, nbytes: int, sha256: Optional[str]
+    ) -> Optional[str]:
+        """Check a downloaded file's dimensions in the validation pool and record the result in the manifest. Runs as its own task, so the attempt's connection and concurrency slots are already free. Returns the failure reason, or None for a valid file."""
+        filepath = self.filepath_for_url(url)
+        problem = await asyncio.get_running_loop().run_in_executor(
+            self._validation_pool, check_dimensions, filepath, url
+        )
+        if problem is None:
+            self._record_complete(url, nbytes, sha256)
+            return None
+        print(f"Invalid file: {problem}\nURL: {url}\n")
+        filepath.unlink(missing_ok=True)
+        if self.manifest is not None:
+            self.manifest.record(url, filepath.name, 0, FAILED)
+        return BAD_DIMENSIONS
+
+    def _validated(
+        self,
+        url: str,
+        attempt: int,
+        record: DownloadRecord,
+        duration: float,
+        task: asyncio.Future,
+    ) -> None:
+        """Done callback of a _validate task: finish the attempt's metrics record, even if the check was cancelled before it started, then finish the attempt as _download_url would have"""
+        if task.cancelled() or task.exception() is not None:
+            self.metrics.finished(record)
+            return
+        reason = task.result()
+        self.metrics.finished(
+            record if reason is None else record._replace(status=reason)
+        )
+        self._validations.add(
+            asyncio.ensure_future(self._finish(url, attempt, reason, duration))
+        )
+
+    async def _finish(
+        self,
+        url: str,
+        attempt: int,
+        reason: Optional[Union[int, str]],
+        duration: float,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        """Report an attempt's outcome to the controller, then retry it or hand the file to on_complete"""
+        self.controller.record(reason, duration)
+        if reason is not None:
+            self._handle_failure(url, attempt, reason, retry_after)
+        elif self._on_complete is not None:
+            await self._on_complete(url, self.filepath_for_url(url))
+
+    async def _download_url(
+        self, url: str, attempt: int = 0, queued_at: Optional[float] = None
+    ) -> None:
+        start = time.monotonic()
+        headers_at = None
+        nbytes = 0
+        write_time = 0.0
+        status: Union[int, str] = "no_response"
+        reason: Optional[Union[int, str]] = None
+        retry_after: Optional[float] = None
+        sha256: Optional[str] = None
+        closed = False
+        self.metrics.started()
         try:
             async with self._client.stream("GET", url) as resp:
+                headers_at = time.monotonic()
+                status = resp.status_code
                 try:
                     resp.raise_for_status()
-                    await self._write_async(resp)
-                    return
-                except httpx.HTTPError:
+                    nbytes, write_time, sha256 = await self._write_async(resp, url)
+                except httpx.HTTPStatusError:
                     print(f"Status: {resp.status_code}\nURL: {url}\n")
-                    self.failed_downloads[resp.status_code].append(url)
+                    reason = resp.status_code
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                except InvalidDownload as e:
+                    print(f"Invalid file: {e}\nURL: {url}\n")
+                    reason = e.reason
+            closed = True
         except httpx.TimeoutException:
             print(f"Timeout\nURL: {url}\n")
-            self.failed_downloads["timeout"].append(url)
+            reason = "timeout"
+        except httpx.TransportError as e:
+            # connection refused or reset, or closed mid-body
+            print(f"Connection error: {e!r}\nURL: {url}\n")
+            reason = "connection_error"
         except httpx.TooManyRedirects:
             print(f"Too many redirects\nURL: {url}\n")
-            self.failed_downloads["too_many_redirects"].append(url)
+            reason = "too_many_redirects"
+        finally:
+            end = time.monotonic()
+            if headers_at is None:
+                headers_at = end
+            record = DownloadRecord(
+                url=url,
+                status=status if reason is None else reason,
+                attempt=attempt,
+                queue_wait=0.0 if queued_at is None else max(start - queued_at, 0.0),
+                ttfb=headers_at - start,
+                transfer=end - headers_at,
+                write=write_time,
+                nbytes=nbytes,
+                end=end,
+            )
+            validate = self.validate_dimensions and closed and reason is None
+            if not validate:
+                self.metrics.finished(record)
+        if validate:
+            # the response is closed; release this attempt's slot before checking the file
+            task = asyncio.ensure_future(self._validate(url, nbytes, sha256))
+            task.add_done_callback(
+                functools.partial(self._validated, url, attempt, record, end - start)
+            )
+            self._validations.add(task)
+            return
+        await self._finish(url, attempt, reason, end - start, retry_after)
+
+    def _handle_failure(
+        self,
+        url: str,
+        attempt: int,
+        reason: Union[int, str],
+        retry_after: Optional[float] = None,
+    ) -> None:
+        """Queue url for another attempt after a backoff delay, or record it as failed if its retry budget is spent."""
+        if self.retry_policy.should_retry(reason, attempt):
+            # a bad file says nothing about server load, so don't back off
+            delay = (
+                0.0
+                if reason in INVALID_REASONS
+                else self.retry_policy.delay(attempt, retry_after)
+            )
+            ready = asyncio.get_running_loop().time() + delay
+            heapq.heappush(
+                self._retry_queue, (ready, next(self._retry_counter), url, attempt + 1)
+            )
+        else:
+            self.failed_downloads[reason].append(url)
+
+    async def _run_on_each(self, urls: Iterable[str]) -> None:
+        """Run _download_url on each url, reading concurrency and rate limits from self.controller before starting each one. Replaces aiometer.run_on_each, which fixes its limits at call time.
+        Retries queued by _handle_failure share the same limits and take priority over new URLs once their backoff delay has passed, so they overlap with first attempts instead of waiting for the whole batch. Dimension checks (see _validate) don't count against the limits, but are waited for since they can queue retries.
+        """
+        loop = asyncio.get_running_loop()
+        in_flight: Set[asyncio.Future] = set()
+        last_start = float("-inf")
+        url_iterator = iter(urls)
+        urls_exhausted = False
+        try:
+            while True:
+                self._reap_validations()
+                queued_at = loop.time()
+                while len(in_flight) >= self.controller.max_at_once:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()  # propagate unexpected exceptions
+
+                if self._retry_queue and self._retry_queue[0][0] <= loop.time():
+                    queued_at, _, url, attempt = heapq.heappop(self._retry_queue)
+                else:
+                    url = None if urls_exhausted else next(url_iterator, None)
+                    attempt = 0
+                if url is None:
+                    urls_exhausted = True
+                    if (
+                        not in_flight
+                        and not self._retry_queue
+                        and not self._validations
+                    ):
+                        return
+                    # sleep until the next retry is ready or a download finishes
+                    timeout = (
+                        max(self._retry_queue[0][0] - loop.time(), 0)
+                        if self._retry_queue
+                        else None
+                    )
+                    if in_flight or self._validations:
+                        done, _ = await asyncio.wait(
+                            in_flight | self._validations,
+                            timeout=timeout,
+                            return_when=asyncio.FIRST_COMPLETED,
+                        )
+                        in_flight -= done
+                        for task in done - self._validations:
+                            task.result()
+                    else:
+                        await asyncio.sleep(timeout)  # type: ignore
+                    continue
+
+                delay = last_start + 1 / self.controller.max_per_second - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                last_start = loop.time()
+                in_flight.add(
+                    asyncio.ensure_future(self._start_download(url, attempt, queued_at))
+                )
+        finally:
+            # await what's cancelled, including tasks _validated adds meanwhile
+            pending = in_flight | self._validations
+            while pending:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                self._validations -= pending
+                pending = set(self._validations)
+
+    def _reap_validations(self) -> None:
+        """Forget finished dimension checks, propagating unexpected exceptions"""
+        done = {task for task in self._validations if task.done()}
+        self._validations -= done
+        for task in done:
+            task.result()
+
+    async def _start_download(
+        self, url: str, attempt: int = 0, queued_at: Optional[float] = None
+    ) -> None:
+        """_download_url, after waiting for the shared budget if there is one"""
+        if self.budget is None:
+            await self._download_url(url, attempt, queued_at)
+            return
+        await self.budget.acquire()
+        try:
+            await self._download_url(url, attempt, queued_at)
+        finally:
+            self.budget.release()
 
     def _log_failures(self) -> None:
-        n = len(list(self.directory.glob("fails_*.txt")))
-        filepath = self.directory / f"fails_{n}.txt"
-        with open(filepath, "w") as f:
-            for reason, url_list in self.failed_downloads.items():
-                print(f"Reason: {reason}", file=f)
-                print(*url_list, sep="\n", file=f)
-        return
+        log_failures(self.directory, self.failed_downloads)
+
+    def _dump_metrics(self) -> None:
+        self.metrics.extra.update(
+            {f"limit_{k}": v for k, v in self.controller.metrics().items()}
+        )
+        self.metrics.dump(self.directory / self._metrics_name)
+
+    async def _dump_metrics_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._metrics_interval)  # type: ignore
+            self._dump_metrics()
+
+    async def _start_session(self, first_url: str) -> bool:
+        """Log in by downloading first_url on its own, unless self.session holds a valid session. Returns True if first_url was downloaded."""
+        if self.session is None:
+            await self._start_download(first_url)
+            return True
+        # the lock only covers the cookie file, never the login request, so a process
+        # waiting on it can't stall this event loop's downloads for a login round trip
+        async with self.session.locked_async():
+            cookies = self.session.load()
+        if cookies is not None:
+            self._client.cookies = cookies  # type: ignore
+            return False
+        await self._start_download(first_url)
+        async with self.session.locked_async():
+            self.session.save(self._client.cookies)  # type: ignore
+        return True
 
     async def download(self, urls: Iterable[str]) -> None:
         self.directory.mkdir(parents=True, exist_ok=True)
+        if self.manifest_name is not None:
+            self.manifest = DownloadManifest(self.directory / self.manifest_name)
+            self.manifest.compact()  # drop superseded lines from previous runs
+
+        # skip files already completed by a previous run
+        url_iterator = (url for url in urls if not self._is_complete(url))
+        if self.schedule is not None:
+            url_iterator = iter(schedule_urls(list(url_iterator), self.schedule))
 
         # run first_url to completion before starting concurrent download
         # This ensures authentication and cookie gathering is done only once
-        url_iterator = iter(urls)  # makes compatible with lists and generators
-        first_url = next(url_iterator)
+        first_url = next(url_iterator, None)
+        if first_url is None:
+            print("All files already downloaded.")
+            return
 
-        async with httpx.AsyncClient(auth=self._auth, timeout=self._timeout) as client:  # type: ignore
+        async with httpx.AsyncClient(
+            auth=self._auth,
+            timeout=self._timeout,
+            limits=self._limits,
+            http1=self._http1,
+            http2=self._http2,
+            follow_redirects=True,  # Earthdata login redirects
+        ) as client:  # type: ignore
             self._client = client
-            await self._download_url(first_url)
-            await aiometer.run_on_each(
-                self._download_url,
-                url_iterator,
-                max_at_once=self._max_at_once,
-                max_per_second=self._max_per_second,
-            )
-
-            for i in range(self._retries):
-                if not self.failed_downloads:
-                    return
-                # flatten and reset
-                retry_urls = [
-                    url for sublist in self.failed_downloads.values() for url in sublist
-                ]
-                self.failed_downloads = defaultdict(list)
-                await aiometer.run_on_each(
-                    self._download_url,
-                    retry_urls,
-                    max_at_once=self._max_at_once,
-                    max_per_second=self._max_per_second,
-                )
+            if self.validate_dimensions:
+                self._validation_pool = ThreadPoolExecutor(self._validation_workers)
+            reporter = None
+            if self._metrics_interval:
+                reporter = asyncio.ensure_future(self._dump_metrics_periodically())
+            try:
+                if await self._start_session(first_url):
+                    # also runs any retry of first_url
+                    await self._run_on_each(url_iterator)
+                else:
+                    await self._run_on_each(itertools.chain([first_url], url_iterator))
+            finally:
+                if reporter is not None:
+                    reporter.cancel()
+                if self._validation_pool is not None:
+                    self._validation_pool.shutdown()
+                    self._validation_pool = None
+                self._dump_metrics()
+                if self.session is not None:
+                    # keep any cookies refreshed during the run
+                    async with self.session.locked_async():
+                        self.session.save(client.cookies)
 
             if self.failed_downloads:
-                print(
-                    f"After {self._retries + 1} tries, there were still failed downloads."
-                )
+                print("After exhausting retries, there were still failed downloads.")
                 for reason, url_list in self.failed_downloads.items():
                     print(f"{len(url_list)}\tfailures due to: {reason}")
-                print("Failed URLs will be output to fails_X.txt")
-                self._log_failures()
+                if self.write_failure_log:
+                    print("Failed URLs will be output to fails_X.txt")
+                    self._log_failures()
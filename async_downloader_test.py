@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+import pytest
+
+import merra_urls
+from async_downloader import AsyncDownloader
+from download_sinks import CallbackSink, MemorySink
+from download_validation import check_dimensions
+from fake_opendap_server import FakeOpendapServer
+from rate_control import AIMDController
+from retry_policy import RetryPolicy
+
+URLS = list(
+    merra_urls.url_generator(
+        time_interval=(datetime(2020, 3, 1), datetime(2020, 3, 11)),
+        lat_interval=(26, 37),
+        lon_interval=(-107, -93),
+        collections=[
+            {
+                "collection": "tavg1_2d_slv_Nx",
+                "short_name": "M2T1NXSLV",
+                "fields": ["PS", "T10M"],
+            }
+        ],
+    )
+)
+
+
+def test_download_and_resume(tmp_path):
+    with FakeOpendapServer() as server:
+        urls = [server.localize(url) for url in URLS]
+        downloader = AsyncDownloader(tmp_path, max_per_second=100)
+        asyncio.run(downloader.download(urls))
+        assert not downloader.failed_downloads
+        assert len(list(tmp_path.glob("*.nc4"))) == len(urls)
+        assert not list(tmp_path.glob("*.part"))
+
+        # rerun skips everything completed
+        requests = server.stats[200]
+        asyncio.run(AsyncDownloader(tmp_path).download(urls))
+        assert server.stats[200] == requests
+
+        # a truncated file is re-fetched
+        truncated = sorted(tmp_path.glob("*.nc4"))[0]
+        truncated.write_bytes(truncated.read_bytes()[:10])
+        asyncio.run(AsyncDownloader(tmp_path).download(urls))
+        assert server.stats[200] == requests + 1
+
+
+def test_retries(tmp_path):
+    with FakeOpendapServer(error_rate=0.3, seed=0) as server:
+        downloader = AsyncDownloader(
+            tmp_path,
+            max_per_second=100,
+            retry_policy=RetryPolicy(retries=10, base_delay=0.01),
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert server.stats[503] > 0
+        assert not downloader.failed_downloads
+        assert downloader.metrics.status_counts["200"] == len(URLS)
+
+
+def test_aimd_backs_off(tmp_path):
+    with FakeOpendapServer(latency=0.2, max_concurrent=2) as server:
+        controller = AIMDController(
+            initial_at_once=8, initial_per_second=100, max_per_second=100
+        )
+        downloader = AsyncDownloader(
+            tmp_path,
+            controller=controller,
+            retry_policy=RetryPolicy(retries=10, base_delay=0.01),
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert not downloader.failed_downloads
+        assert controller.n_decreases > 0
+        assert controller.max_at_once < 8
+
+
+def test_memory_and_callback_sinks(tmp_path):
+    with FakeOpendapServer() as server:
+        sink = MemorySink()
+        downloader = AsyncDownloader(tmp_path, sink=sink, max_per_second=100)
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert len(sink.buffers) == len(URLS)
+        assert all(body.startswith(b"CDF") for body in sink.buffers.values())
+        assert not list(tmp_path.glob("*.nc4*"))
+
+        sizes = []
+        sink = CallbackSink(lambda url, body: sizes.append(len(body)))
+        downloader = AsyncDownloader(tmp_path, sink=sink, max_per_second=100)
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert len(sizes) == len(URLS)
+
+
+def test_schedule(tmp_path):
+    big = merra_urls.url_generator(
+        time_interval=(datetime(2020, 3, 1), datetime(2020, 3, 3)),
+        lat_interval=(26, 37),
+        lon_interval=(-107, -93),
+        collections=[
+            {
+                "collection": "tavg1_2d_flx_Nx",
+                "short_name": "M2T1NXFLX",
+                "fields": ["PRECTOTCORR", "RHOA", "RISFC", "Z0M"],
+            }
+        ],
+    )
+    urls = URLS[:2] + list(big)
+    with FakeOpendapServer() as server:
+        order = []
+        downloader = AsyncDownloader(
+            tmp_path,
+            max_at_once=1,
+            max_per_second=100,
+            sink=CallbackSink(lambda url, body: order.append(url)),
+            schedule="longest_first",
+        )
+        asyncio.run(downloader.download(server.localize_all(urls)))
+        assert order == list(server.localize_all(urls[2:] + urls[:2]))
+
+        order.clear()
+        downloader.schedule = "by_date"
+        asyncio.run(downloader.download(server.localize_all(urls)))
+        assert order == list(server.localize_all([urls[2], urls[0], urls[3], urls[1]]))
+
+
+def test_connection_reuse(tmp_path):
+    with FakeOpendapServer(latency=0.05) as server:
+        downloader = AsyncDownloader(
+            tmp_path / "http1", max_at_once=4, max_per_second=100, manifest_name=None
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert not downloader.failed_downloads
+        assert server.stats["connections"] <= 4
+
+
+def test_http2(tmp_path):
+    pytest.importorskip("h2")
+    with FakeOpendapServer(latency=0.05, http2=True, bandwidth=1e7) as server:
+        downloader = AsyncDownloader(
+            tmp_path,
+            max_at_once=4,
+            max_per_second=100,
+            http1=False,
+            http2=True,
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert not downloader.failed_downloads
+        assert server.stats[200] == len(URLS)
+        assert server.max_in_flight > 1
+        assert server.stats["connections"] == 1  # multiplexed
+        assert len(list(tmp_path.glob("*.nc4"))) == len(URLS)
+
+
+def test_invalid_files_are_retried(tmp_path):
+    with FakeOpendapServer(corrupt_rate=0.4, seed=1) as server:
+        downloader = AsyncDownloader(
+            tmp_path,
+            max_per_second=100,
+            retry_policy=RetryPolicy(retries=10),
+            validate_dimensions=True,
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert not downloader.failed_downloads
+        counts = downloader.metrics.status_counts
+        assert counts["bad_signature"] > 0 and counts["bad_dimensions"] > 0
+        assert counts["200"] == len(URLS)
+        assert not list(tmp_path.glob("*.part"))
+        for url in server.localize_all(URLS):
+            path = downloader.filepath_for_url(url)
+            assert check_dimensions(path, url) is None
+            entry = downloader.manifest.get(url)  # type: ignore
+            assert entry["sha256"] == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_validation_releases_the_slot(tmp_path, monkeypatch):
+    # each check waits until every file was served, which can only happen if
+    # checks don't hold the single download slot
+    timed_out = []
+
+    def check_after_all_served(path, url):
+        deadline = time.monotonic() + 5
+        while server.stats[200] < len(URLS):
+            if time.monotonic() > deadline:
+                timed_out.append(url)
+                break
+            time.sleep(0.01)
+        return check_dimensions(path, url)
+
+    monkeypatch.setattr("async_downloader.check_dimensions", check_after_all_served)
+    with FakeOpendapServer() as server:
+        downloader = AsyncDownloader(
+            tmp_path,
+            max_at_once=1,
+            max_per_second=100,
+            validate_dimensions=True,
+            validation_workers=len(URLS),
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+    assert not timed_out
+    assert not downloader.failed_downloads
+    assert downloader.metrics.status_counts["200"] == len(URLS)
+    for url in server.localize_all(URLS):
+        assert downloader.manifest.is_complete(url, tmp_path)  # type: ignore
+
+
+def test_cancelled_validation_finishes_its_record(tmp_path, monkeypatch):
+    with FakeOpendapServer() as server:
+        url = next(iter(server.localize_all(URLS)))
+        downloader = AsyncDownloader(
+            tmp_path, manifest_name=None, validate_dimensions=True
+        )
+
+        async def cancel_before_the_check_starts():
+            async with httpx.AsyncClient() as client:
+                downloader._client = client
+                downloader._validation_pool = ThreadPoolExecutor(1)
+                await downloader._download_url(url)
+                [task] = downloader._validations
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(cancel_before_the_check_starts())
+        assert downloader.metrics.in_flight == 0
+        assert downloader.metrics.status_counts["200"] == 1
+
+        # a run cancelled while checks are pending waits for them to finish
+        def slow_check(path, url):
+            time.sleep(0.2)
+            return None
+
+        monkeypatch.setattr("async_downloader.check_dimensions", slow_check)
+        downloader = AsyncDownloader(
+            tmp_path / "cancelled",
+            max_per_second=100,
+            validate_dimensions=True,
+            validation_workers=1,
+        )
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(
+                asyncio.wait_for(downloader.download(server.localize_all(URLS)), 0.5)
+            )
+        assert downloader.metrics.in_flight == 0
+        assert not downloader._validations
+
+
+def test_dropped_connections(tmp_path):
+    with FakeOpendapServer(drop_rate=0.3, seed=0) as server:
+        controller = AIMDController(initial_at_once=4, initial_per_second=100)
+        downloader = AsyncDownloader(
+            tmp_path,
+            controller=controller,
+            retry_policy=RetryPolicy(retries=10, base_delay=0.01),
+        )
+        asyncio.run(downloader.download(server.localize_all(URLS)))
+        assert server.stats["dropped"] > 0
+        assert not downloader.failed_downloads
+        counts = downloader.metrics.status_counts
+        assert counts["connection_error"] == server.stats["dropped"]
+        assert counts["200"] == len(URLS)
+        assert controller.n_decreases > 0
+        for url in server.localize_all(URLS):
+            assert downloader.manifest.is_complete(url, tmp_path)  # type: ignore
+
+    # a server that's gone fails each URL instead of aborting the run
+    downloader = AsyncDownloader(
+        tmp_path / "refused", max_per_second=100, retry_policy=RetryPolicy(retries=0)
+    )
+    asyncio.run(downloader.download(server.localize_all(URLS)))
+    assert len(downloader.failed_downloads["connection_error"]) == len(URLS)
+    assert len(list((tmp_path / "refused").glob("fails_*.txt"))) == 1
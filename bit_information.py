@@ -0,0 +1,135 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+class BitInformation(object):
+    def __init__(self, dtype: np.dtype = np.float32) -> None:
+        """Streaming estimate of how much real information each bit of a float variable carries, after Klöwer et al. (2021), "Compressing atmospheric data into its real information content". The information in a bit is the mutual information between that bit in neighbouring values: bits that can be predicted from the neighbour carry information, while the low mantissa bits of noisy data are independent random draws and carry none.
+
+        Feed it blocks of data with update; only counts of set bits in each pair of neighbours are kept, so memory doesn't grow with the amount of data seen.
+
+        Parameters
+        ----------
+        dtype : np.dtype, optional
+            float32 or float64, the dtype of all data passed to update. By default np.float32
+
+        Example
+        -------
+        info = BitInformation()
+        for day in days:
+            info.update(day["TS"].values, axis=0)  # neighbours in time
+        info.keepbits(information_level=0.99)  # -> 9
+        """
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError(f"BitInformation needs float32 or float64, got {dtype}")
+        self.n_bits = 8 * self.dtype.itemsize
+        self.n_mantissa = np.finfo(self.dtype).nmant
+        self.n_pairs = 0
+        # per bit, most significant (sign) first: set in the first value, in the second, in both
+        self.first = np.zeros(self.n_bits, dtype=np.int64)
+        self.second = np.zeros(self.n_bits, dtype=np.int64)
+        self.both = np.zeros(self.n_bits, dtype=np.int64)
+
+    def _count(self, bits: np.ndarray) -> np.ndarray:
+        """Set bits per position, most significant first"""
+        big_endian = bits.astype(bits.dtype.newbyteorder(">"), copy=False)
+        unpacked = np.unpackbits(
+            big_endian.view(np.uint8).reshape(-1, self.dtype.itemsize), axis=1
+        )
+        return unpacked.sum(axis=0, dtype=np.int64)
+
+    def update(self, x: np.ndarray, axis: int = 0) -> None:
+        """Count bits in each pair of neighbouring values along axis. Pairs don't span calls, so pass blocks that are long along axis.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            block of data with this object's dtype. Should not contain NaN.
+        axis : int, optional
+            axis along which values are neighbours, by default 0
+        """
+        if x.dtype != self.dtype:
+            raise ValueError(f"Expected {self.dtype} data, got {x.dtype}")
+        x = np.moveaxis(x, axis, 0)
+        uint = f"u{self.dtype.itemsize}"
+        first = np.ascontiguousarray(x[:-1]).view(uint).reshape(-1)
+        second = np.ascontiguousarray(x[1:]).view(uint).reshape(-1)
+        self.n_pairs += len(first)
+        self.first += self._count(first)
+        self.second += self._count(second)
+        self.both += self._count(first & second)
+
+    def information(self, confidence: float = 0.99) -> np.ndarray:
+        """Mutual information in bits between each bit position of neighbouring values, most significant (sign) bit first. Values not significantly above what independent random bits would give, at the given confidence level, are set to 0.
+
+        Parameters
+        ----------
+        confidence : float, optional
+            confidence level of the significance test, by default 0.99
+
+        Returns
+        -------
+        np.ndarray
+            information per bit position, in [0, 1]
+        """
+        if self.n_pairs == 0:
+            raise ValueError("No data seen; call update first")
+        n = self.n_pairs
+        p11 = self.both / n
+        p10 = (self.first - self.both) / n
+        p01 = (self.second - self.both) / n
+        p00 = 1 - p11 - p10 - p01
+        p1_, p_1 = self.first / n, self.second / n
+        joint = np.stack([p00, p01, p10, p11])
+        marginals = np.stack(
+            [(1 - p1_) * (1 - p_1), (1 - p1_) * p_1, p1_ * (1 - p_1), p1_ * p_1]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.where(joint > 0, joint * np.log2(joint / marginals), 0.0)
+        information = terms.sum(axis=0)
+
+        # information that n pairs of independent bits exceed only with probability 1 - confidence
+        p = 0.5 + NormalDist().inv_cdf(1 - (1 - confidence) / 2) / (2 * np.sqrt(n))
+        p = min(p, 1.0)
+        entropy = -sum(q * np.log2(q) for q in (p, 1 - p) if q > 0)
+        information[information <= 1 - entropy] = 0.0
+        return information
+
+    def keepbits(
+        self, information_level: float = 0.99, confidence: float = 0.99
+    ) -> int:
+        """Number of mantissa bits needed to keep information_level of the total information, for bitround or bitgroom. Information in bits after the first gap (a bit without any, following one with some) is treated as artificial and ignored. Data with no significant information (e.g. a constant) keeps every mantissa bit, since there is nothing to say which bits are false precision.
+
+        Parameters
+        ----------
+        information_level : float, optional
+            fraction of the total information to keep, by default 0.99
+        confidence : float, optional
+            as in information, by default 0.99
+
+        Returns
+        -------
+        int
+            mantissa bits to keep, between 0 and 23 for float32 or 52 for float64
+        """
+        information = self.information(confidence)
+        # Bits after a gap in the information can still look informative, e.g. from float32
+        # arithmetic in unit conversions. That information is artificial. Leading bits that
+        # never change (such as a fixed exponent) carry none either, but aren't a gap
+        informative = information > 0
+        if informative.any():
+            first = int(np.argmax(informative))
+            gap = ~informative[first:]
+            if gap.any():
+                information[first + int(np.argmax(gap)) :] = 0.0
+        total = information.sum()
+        if total == 0:
+            return self.n_mantissa
+        cumulative = np.cumsum(information) / total
+        # the first bit position reaching the level, counted from the first mantissa bit
+        needed = int(np.argmax(cumulative >= information_level)) + 1
+        return int(
+            np.clip(needed - (self.n_bits - self.n_mantissa), 0, self.n_mantissa)
+        )
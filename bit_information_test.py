@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from bit_information import BitInformation
+
+RNG = np.random.default_rng(0)
+WALK = np.cumsum(RNG.normal(size=(5000, 20)), axis=0) + 100
+
+
+def keepbits(data, dtype=np.float32, **kwargs):
+    info = BitInformation(dtype)
+    info.update(data.astype(dtype), axis=0)
+    return info.keepbits(**kwargs)
+
+
+def test_keepbits():
+    clean = keepbits(WALK)
+    assert 0 < clean < 23
+    # noise hides the low bits
+    assert keepbits(WALK + RNG.normal(scale=1, size=WALK.shape)) < clean
+    assert keepbits(WALK, information_level=0.9999) >= clean
+    assert keepbits(WALK, dtype=np.float64) < 52
+    # nothing to go on, so nothing is dropped
+    assert keepbits(np.full((100, 3), 1.1)) == 23
+
+    # float32 arithmetic leaves artificial information in the last bits
+    celsius = WALK.astype(np.float32) + np.float32(200) - np.float32(273.15)
+    assert keepbits(celsius) <= clean + 1
+
+
+def test_streaming():
+    whole = BitInformation()
+    whole.update(WALK.astype(np.float32).T, axis=1)
+    parts = BitInformation()
+    for block in np.split(WALK.astype(np.float32), 4, axis=1):
+        parts.update(block, axis=0)
+    assert parts.n_pairs == whole.n_pairs
+    np.testing.assert_array_equal(parts.information(), whole.information())
+
+    with pytest.raises(ValueError):
+        parts.update(WALK)  # float64
+    with pytest.raises(ValueError):
+        BitInformation().information()
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import merra_urls
+from async_downloader import merra2_file_from_url
+from fake_opendap_server import synthetic_response
+
+# collections with every variable merra_etl.transforms uses
+COLLECTIONS = [
+    {
+        "collection": "tavg1_2d_slv_Nx",
+        "short_name": "M2T1NXSLV",
+        "fields": ["PS", "TS", "T10M", "U50M", "V50M"],
+    },
+    {
+        "collection": "tavg1_2d_flx_Nx",
+        "short_name": "M2T1NXFLX",
+        "fields": ["PRECTOTCORR", "RHOA", "RISFC", "Z0M"],
+    },
+    {
+        "collection": "tavg1_2d_lnd_Nx",
+        "short_name": "M2T1NXLND",
+        "fields": ["GHLAND"],
+    },
+]
+
+
+def _write_daily_files(
+    directory,
+    lat_interval=(26, 30),
+    lon_interval=(-100, -95),
+    time_interval=(datetime(2020, 1, 1), datetime(2020, 1, 5)),
+    collections=COLLECTIONS,
+):
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for url in merra_urls.url_generator(
+        time_interval=time_interval,
+        lat_interval=lat_interval,
+        lon_interval=lon_interval,
+        collections=collections,
+    ):
+        path = directory / merra2_file_from_url(url)
+        path.write_bytes(synthetic_response(url))
+        files.append(path)
+    return files
+
+
+def _read_sorted(directory):
+    df = pd.read_parquet(directory)
+    return (
+        df.sort_values(["lat", "lon", "time"])
+        .reset_index(drop=True)
+        .reindex(columns=sorted(df.columns))
+    )
+
+
+@pytest.fixture
+def collections():
+    return [dict(collection) for collection in COLLECTIONS]
+
+
+@pytest.fixture
+def write_daily_files():
+    """write_daily_files(directory, lat_interval, lon_interval, time_interval, collections) writes a synthetic daily file per date and collection, as the fake OPeNDAP server would serve them, and returns their paths"""
+    return _write_daily_files
+
+
+@pytest.fixture
+def read_sorted():
+    """read_sorted(directory) reads a parquet directory in grid point then time order, with columns sorted by name"""
+    return _read_sorted
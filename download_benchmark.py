@@ -0,0 +1,313 @@
+"""Offline throughput benchmarks for the download path, run against fake_opendap_server.FakeOpendapServer.
+
+Sweeps client type, concurrency and rate limits over a synthetic MERRA-2 request and reports files, bytes and throughput per configuration.
+Clients:
+* async: AsyncDownloader with fixed limits
+* aimd: AsyncDownloader with rate_control.AIMDController, starting from the given limits
+* threaded: thread pool of blocking urllib requests sharing one cookie jar, the approach of scratch_work/threaded_downloader.py
+Async clients are also swept over download schedules (see download_plan.schedule_urls); 'none' keeps generator order.
+Protocols:
+* http1: HTTP/1.1 with a keep-alive connection pool
+* http1-nokeepalive: HTTP/1.1 with a new connection per request
+* http2: cleartext HTTP/2, all requests multiplexed over one connection (async clients only; needs the h2 package)
+
+Example
+-------
+python download_benchmark.py --days 60 --max-at-once 1 5 10 20 --latency 0.2 --bandwidth 2e6 --error-rate 0.05
+python download_benchmark.py --clients async --protocols http1 http1-nokeepalive http2 --max-at-once 5 20 50
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Union
+
+import merra_urls
+from async_downloader import AsyncDownloader, merra2_file_from_url
+from download_plan import SCHEDULES
+from fake_opendap_server import FakeOpendapServer
+from rate_control import AIMDController
+
+COLLECTIONS = [
+    {
+        "collection": "tavg1_2d_slv_Nx",
+        "short_name": "M2T1NXSLV",
+        "fields": ["PS", "TS", "T10M", "U50M", "V50M"],
+    },
+    {
+        "collection": "tavg1_2d_flx_Nx",
+        "short_name": "M2T1NXFLX",
+        "fields": ["PRECTOTCORR", "RHOA", "RISFC"],
+    },
+]
+
+
+def benchmark_urls(
+    days: int, lat_interval=(26, 37), lon_interval=(-107, -93)
+) -> List[str]:
+    start = datetime(2020, 1, 1)
+    return list(
+        merra_urls.url_generator(
+            time_interval=(start, start + timedelta(days=days)),
+            lat_interval=lat_interval,
+            lon_interval=lon_interval,
+            collections=COLLECTIONS,
+        )
+    )
+
+
+def run_async(
+    urls: Sequence[str],
+    directory: Path,
+    max_at_once: int,
+    max_per_second: float,
+    adaptive: bool = False,
+    **downloader_kwargs,
+) -> Dict[str, int]:
+    controller = (
+        AIMDController(initial_at_once=max_at_once, initial_per_second=max_per_second)
+        if adaptive
+        else None
+    )
+    downloader = AsyncDownloader(
+        directory,
+        max_at_once=max_at_once,
+        max_per_second=max_per_second,
+        controller=controller,
+        manifest_name=None,
+        **downloader_kwargs,
+    )
+    asyncio.run(downloader.download(urls))
+    out = {"failures": sum(len(v) for v in downloader.failed_downloads.values())}
+    out.update(
+        {
+            f"final_{k}": v
+            for k, v in downloader.controller.metrics().items()
+            if k.startswith("max")
+        }
+    )
+    return out
+
+
+def run_threaded(
+    urls: Sequence[str],
+    directory: Path,
+    max_at_once: int,
+    max_per_second: float,
+    **kwargs,
+) -> Dict[str, int]:
+    auth = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+    auth.add_password(None, urls[0].split("/opendap/")[0], os.getenv("MERRA2_USER"), os.getenv("MERRA2_PASS"))  # type: ignore
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPBasicAuthHandler(auth),
+        urllib.request.HTTPCookieProcessor(CookieJar()),
+    )
+    directory.mkdir(parents=True, exist_ok=True)
+
+    def fetch(url: str) -> bool:
+        try:
+            with opener.open(url, timeout=30) as resp:
+                (directory / merra2_file_from_url(url)).write_bytes(resp.read())
+            return True
+        except (urllib.error.URLError, OSError):
+            return False
+
+    failures = int(
+        not fetch(urls[0])
+    )  # authenticate once, as the async downloader does
+    with ThreadPoolExecutor(max_at_once) as pool:
+        futures = []
+        for url in urls[1:]:
+            futures.append(pool.submit(fetch, url))
+            time.sleep(1 / max_per_second)
+        failures += sum(not f.result() for f in futures)
+    return {"failures": failures}
+
+
+PROTOCOLS: Dict[str, Dict[str, Union[bool, float]]] = {
+    "http1": {},
+    "http1-nokeepalive": {"keepalive_expiry": 0.0},
+    "http2": {"http1": False, "http2": True},
+}
+
+CLIENTS: Dict[str, Callable[..., Dict[str, int]]] = {
+    "async": run_async,
+    "aimd": lambda *args, **kwargs: run_async(*args, adaptive=True, **kwargs),
+    "threaded": run_threaded,
+}
+
+
+def run_benchmark(
+    urls: Sequence[str],
+    server: FakeOpendapServer,
+    client: str,
+    max_at_once: int,
+    max_per_second: float,
+    **client_kwargs,
+) -> Dict[str, Union[str, int, float]]:
+    """Download urls from server once with the given client and limits. Returns a dict of settings and results."""
+    server.stats.clear()
+    server.max_in_flight = 0
+    local_urls = [server.localize(url) for url in urls]
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # silence per-failure prints
+            result = CLIENTS[client](
+                local_urls, directory, max_at_once, max_per_second, **client_kwargs
+            )
+        seconds = time.perf_counter() - start
+        nbytes = sum(f.stat().st_size for f in directory.glob("*.nc4*"))
+    out: Dict[str, Union[str, int, float]] = {
+        "client": client,
+        "schedule": str(client_kwargs.get("schedule")),
+        "http2": bool(client_kwargs.get("http2")),
+        # urllib opens a connection per request
+        "keepalive": client != "threaded"
+        and client_kwargs.get("keepalive_expiry") != 0.0,
+        "max_at_once": max_at_once,
+        "max_per_second": max_per_second,
+        "seconds": seconds,
+        "files": len(urls) - result["failures"],
+        "megabytes": nbytes / 2**20,
+        "mb_per_second": nbytes / 2**20 / seconds,
+        "files_per_second": (len(urls) - result["failures"]) / seconds,
+        "server_max_in_flight": server.max_in_flight,
+        "server_connections": server.stats["connections"],
+        "server_errors": sum(
+            n for s, n in server.stats.items() if isinstance(s, int) and s >= 400
+        ),
+    }
+    out.update({k: v for k, v in result.items() if k != "failures"})
+    out["failures"] = result["failures"]
+    return out
+
+
+def print_table(rows: List[Dict[str, Union[str, int, float]]]) -> None:
+    columns = list(rows[0].keys())
+    print("\t".join(columns))
+    for row in rows:
+        print(
+            "\t".join(
+                (
+                    f"{row.get(c, ''):.3g}"
+                    if isinstance(row.get(c), float)
+                    else str(row.get(c, ""))
+                )
+                for c in columns
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--days", type=int, default=30, help="days of data per collection"
+    )
+    parser.add_argument(
+        "--clients", nargs="+", default=list(CLIENTS), choices=list(CLIENTS)
+    )
+    parser.add_argument("--max-at-once", nargs="+", type=int, default=[1, 5, 10, 20])
+    parser.add_argument("--max-per-second", nargs="+", type=float, default=[100.0])
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="server seconds before headers"
+    )
+    parser.add_argument("--latency-per-request", type=float, default=0.0)
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="server bytes/second per response"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=None,
+        help="server answers 503 beyond this",
+    )
+    parser.add_argument("--require-auth", action="store_true")
+    parser.add_argument(
+        "--schedules",
+        nargs="+",
+        default=["none"],
+        choices=["none", *SCHEDULES],
+        help="download orders for the async clients",
+    )
+    parser.add_argument(
+        "--protocols",
+        nargs="+",
+        default=["http1"],
+        choices=list(PROTOCOLS),
+        help="HTTP versions and pooling to compare",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=None,
+        help="connection pool size for the async clients",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="also write results as JSON"
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("MERRA2_USER", "user")
+    os.environ.setdefault("MERRA2_PASS", "pass")
+    urls = benchmark_urls(args.days)
+    rows = []
+    for protocol in args.protocols:
+        with FakeOpendapServer(
+            latency=args.latency,
+            latency_per_request=args.latency_per_request,
+            bandwidth=args.bandwidth,
+            error_rate=args.error_rate,
+            max_concurrent=args.max_concurrent,
+            require_auth=args.require_auth,
+            username=os.environ["MERRA2_USER"],
+            password=os.environ["MERRA2_PASS"],
+            seed=0,
+            http2=protocol == "http2",
+        ) as server:
+            for client in args.clients:
+                if client == "threaded":
+                    if protocol != "http1":  # urllib: HTTP/1.1, no pooling
+                        continue
+                    schedules = ["none"]
+                else:
+                    schedules = args.schedules
+                for schedule in schedules:
+                    kwargs = dict(PROTOCOLS[protocol]) if client != "threaded" else {}
+                    if schedule != "none":
+                        kwargs["schedule"] = schedule
+                    if client != "threaded" and args.max_connections is not None:
+                        kwargs["max_connections"] = args.max_connections
+                    for max_at_once in args.max_at_once:
+                        for max_per_second in args.max_per_second:
+                            rows.append(
+                                run_benchmark(
+                                    urls,
+                                    server,
+                                    client,
+                                    max_at_once,
+                                    max_per_second,
+                                    **kwargs,
+                                )
+                            )
+    print_table(rows)
+    if args.output is not None:
+        args.output.write_text(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Union
+
+COMPLETE = "complete"
+PARTIAL = "partial"
+FAILED = "failed"
+
+
+class DownloadManifest(object):
+    def __init__(self, path: Union[str, Path]) -> None:
+        """Persistent record of download outcomes, keyed by URL. Used to make downloads resumable: a rerun skips every URL whose file is recorded as complete AND still exists on disk with the recorded byte size.
+
+        The manifest is an append-only JSON lines file, so recording an outcome costs one small write rather than rewriting the whole manifest. When loading, later lines override earlier ones and a truncated final line (from an interrupted run) is ignored.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            Path to manifest file. Will be created on first write if needed.
+
+        Example
+        -------
+        manifest = DownloadManifest(Path('./data/manifest.jsonl'))
+        manifest.record(url, 'MERRA2_400.tavg1_2d_slv_Nx.20200331.nc4', 123456, COMPLETE)
+        manifest.is_complete(url, Path('./data/'))  # -> True
+        """
+        self.path = Path(path)
+        self._entries: Dict[str, Dict[str, Union[str, int]]] = {}
+        if self.path.exists():
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # partially written last line
+                    continue
+                self._entries[entry["url"]] = entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def get(self, url: str) -> Optional[Dict[str, Union[str, int]]]:
+        return self._entries.get(url)
+
+    def record(self, url: str, filename: str, size: int, status: str, **extra) -> None:
+        """Record the outcome of a download and append it to the manifest file.
+
+        Parameters
+        ----------
+        url : str
+            URL that was downloaded
+        filename : str
+            name of the output file, relative to the download directory
+        size : int
+            number of bytes written
+        status : str
+            One of COMPLETE, PARTIAL, or FAILED
+        **extra
+            any additional JSON serializable fields to store with the entry
+        """
+        entry = {"url": url, "filename": filename, "size": size, "status": status}
+        entry.update(extra)
+        self._entries[url] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            print(json.dumps(entry), file=f)
+
+    def is_complete(self, url: str, directory: Union[str, Path]) -> bool:
+        """True if url was recorded as complete and its file still exists with the recorded size.
+
+        Parameters
+        ----------
+        url : str
+            URL to check
+        directory : Union[str, Path]
+            download directory that recorded filenames are relative to
+
+        Returns
+        -------
+        bool
+        """
+        entry = self._entries.get(url)
+        if entry is None or entry["status"] != COMPLETE:
+            return False
+        filepath = Path(directory) / str(entry["filename"])
+        try:
+            return filepath.stat().st_size == entry["size"]
+        except FileNotFoundError:
+            return False
+
+    def compact(self) -> None:
+        """Rewrite the manifest with one line per URL. Written to a temporary file first, then atomically renamed over the old manifest."""
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for entry in self._entries.values():
+                print(json.dumps(entry), file=f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,38 @@
+from download_manifest import DownloadManifest, COMPLETE, PARTIAL
+
+URL = "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2I1NXLFO.5.12.4/2020/03/MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4?PS[0:23][176:184][285:291]"
+FILENAME = "MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4"
+
+
+def test_is_complete(tmp_path):
+    manifest = DownloadManifest(tmp_path / "manifest.jsonl")
+    assert not manifest.is_complete(URL, tmp_path)  # no entry
+
+    manifest.record(URL, FILENAME, 4, COMPLETE)
+    assert not manifest.is_complete(URL, tmp_path)  # no file
+
+    (tmp_path / FILENAME).write_bytes(b"abc")
+    assert not manifest.is_complete(URL, tmp_path)  # wrong size
+
+    (tmp_path / FILENAME).write_bytes(b"abcd")
+    assert manifest.is_complete(URL, tmp_path)
+
+    manifest.record(URL, FILENAME, 4, PARTIAL)
+    assert not manifest.is_complete(URL, tmp_path)
+
+
+def test_persistence(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    manifest = DownloadManifest(path)
+    manifest.record(URL, FILENAME, 2, PARTIAL)
+    manifest.record(URL, FILENAME, 4, COMPLETE)
+    with open(path, "a") as f:
+        f.write('{"url": "trunc')  # interrupted write
+
+    reloaded = DownloadManifest(path)
+    assert len(reloaded) == 1
+    assert reloaded.get(URL)["status"] == COMPLETE
+
+    reloaded.compact()
+    assert len(path.read_text().splitlines()) == 1
+    assert DownloadManifest(path).get(URL)["size"] == 4
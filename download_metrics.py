@@ -0,0 +1,198 @@
+import json
+import time
+from collections import Counter, deque
+from pathlib import Path
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# DownloadRecord durations reported as latency summaries
+TIMINGS = ("latency", "ttfb", "queue_wait", "write")
+
+
+class DownloadRecord(NamedTuple):
+    """Timing of one download attempt. All durations are in seconds.
+    * queue_wait: from when the URL was ready to go until its request was sent (concurrency and rate limiting)
+    * ttfb: time to first byte, from request sent until response headers arrived (server latency)
+    * transfer: from response headers until the body was fully written
+    * write: part of transfer spent waiting on disk writes
+    """
+
+    url: str
+    status: Union[int, str]
+    attempt: int
+    queue_wait: float
+    ttfb: float
+    transfer: float
+    write: float
+    nbytes: int
+    end: float
+
+    @property
+    def latency(self) -> float:
+        return self.ttfb + self.transfer
+
+
+def quantiles(
+    values: Sequence[float], qs: Iterable[float] = QUANTILES
+) -> Dict[float, float]:
+    """Nearest-rank quantiles of values. Returns 0.0 for each quantile if values is empty."""
+    ordered = sorted(values)
+    n = len(ordered)
+    if n == 0:
+        return {q: 0.0 for q in qs}
+    return {q: ordered[min(int(q * n), n - 1)] for q in qs}
+
+
+class DownloadMetrics(object):
+    def __init__(
+        self,
+        window: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+        keep_records: bool = False,
+    ) -> None:
+        """Collects a DownloadRecord per download attempt and aggregates them into totals (whole run) and rolling statistics (last `window` seconds). Only the records in the window are kept, so memory doesn't grow with the length of the run.
+
+        Parameters
+        ----------
+        window : float, optional
+            Length in seconds of the rolling window used for rates and latency quantiles, by default 60.0
+        clock : Callable[[], float], optional
+            Monotonic clock in seconds, by default time.monotonic
+        keep_records : bool, optional
+            Also keep every record in self.records, e.g. for offline analysis. Memory grows with the number of attempts. By default False
+
+        Example
+        -------
+        metrics = DownloadMetrics()
+        downloader = AsyncDownloader(Path('./data/'), metrics=metrics, metrics_interval=30)
+        asyncio.run(downloader.download(urls))
+        print(metrics.to_prometheus())
+        """
+        self.window = window
+        self._clock = clock
+        self.start = clock()
+        self.keep_records = keep_records
+        self.records: List[DownloadRecord] = []
+        self._recent: Deque[DownloadRecord] = deque()
+        self.in_flight = 0
+        self.requests_total = 0
+        self.total_bytes = 0
+        self.status_counts: Counter = Counter()
+        self.seconds_total: Dict[str, float] = {name: 0.0 for name in TIMINGS}
+        self.extra: Dict[str, float] = {}  # e.g. controller limits
+
+    def now(self) -> float:
+        return self._clock()
+
+    def started(self) -> None:
+        self.in_flight += 1
+
+    def finished(self, record: DownloadRecord) -> None:
+        self.in_flight -= 1
+        if self.keep_records:
+            self.records.append(record)
+        self._recent.append(record)
+        self.requests_total += 1
+        self.total_bytes += record.nbytes
+        self.status_counts[str(record.status)] += 1
+        for name in TIMINGS:
+            self.seconds_total[name] += getattr(record, name)
+
+    def merge(self, other: "DownloadMetrics") -> None:
+        """Add the totals and windowed records of metrics collected elsewhere, e.g. by another process. Record end times must come from the same clock."""
+        other._prune(self.now())
+        if self.keep_records:
+            self.records.extend(other.records)
+        self._recent = deque(
+            sorted([*self._recent, *other._recent], key=lambda r: r.end)
+        )
+        self.requests_total += other.requests_total
+        self.total_bytes += other.total_bytes
+        self.status_counts.update(other.status_counts)
+        for name in TIMINGS:
+            self.seconds_total[name] += other.seconds_total[name]
+
+    def _prune(self, now: float) -> None:
+        while self._recent and self._recent[0].end < now - self.window:
+            self._recent.popleft()
+
+    def summary(self) -> Dict[str, Union[int, float, Dict[str, float]]]:
+        """Totals and rolling aggregates as a flat-ish, JSON serializable dict."""
+        now = self.now()
+        self._prune(now)
+        elapsed = max(now - self.start, 1e-9)
+        span = max(min(self.window, elapsed), 1e-9)
+        recent = list(self._recent)
+        out: Dict[str, Union[int, float, Dict[str, float]]] = {
+            "elapsed_seconds": elapsed,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "bytes_total": self.total_bytes,
+            "bytes_per_second_total": self.total_bytes / elapsed,
+            "bytes_per_second": sum(r.nbytes for r in recent) / span,
+            "requests_per_second": len(recent) / span,
+            "status_counts": dict(self.status_counts),
+        }
+        for name in TIMINGS:
+            qs = quantiles([getattr(r, name) for r in recent])
+            out[f"{name}_seconds"] = {f"p{int(q * 100)}": v for q, v in qs.items()}
+        out.update(self.extra)
+        return out
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix: str = "merra2_download") -> str:
+        """Render summary() in the Prometheus text exposition format. Latency summaries have quantiles over the rolling window, and _sum and _count series over the whole run."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name: str, kind: str, samples: Dict[str, float]) -> None:
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples.items():
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        metric("requests_total", "counter", {"": summary["requests_total"]})
+        metric(
+            "responses_total",
+            "counter",
+            {f'{{status="{s}"}}': n for s, n in self.status_counts.items()},
+        )
+        metric("bytes_total", "counter", {"": summary["bytes_total"]})
+        metric("bytes_per_second", "gauge", {"": summary["bytes_per_second"]})
+        metric("requests_per_second", "gauge", {"": summary["requests_per_second"]})
+        metric("in_flight", "gauge", {"": summary["in_flight"]})
+        for name in TIMINGS:
+            qs = summary[f"{name}_seconds"]
+            metric(
+                f"{name}_seconds",
+                "summary",
+                {f'{{quantile="{int(k[1:]) / 100}"}}': v for k, v in qs.items()},  # type: ignore
+            )
+            lines.append(f"{prefix}_{name}_seconds_sum {self.seconds_total[name]}")
+            lines.append(f"{prefix}_{name}_seconds_count {self.requests_total}")
+        for name, value in self.extra.items():
+            metric(name, "gauge", {"": value})
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: Union[str, Path], fmt: Optional[str] = None) -> None:
+        """Write metrics to path, as JSON or Prometheus text. Format defaults to Prometheus for '.prom' files, else JSON.
+        Written to a temporary file and renamed, so readers never see a half written file.
+        """
+        path = Path(path)
+        if fmt is None:
+            fmt = "prometheus" if path.suffix == ".prom" else "json"
+        text = self.to_prometheus() if fmt == "prometheus" else self.to_json()
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(text)
+        tmp_path.replace(path)
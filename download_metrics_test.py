@@ -0,0 +1,98 @@
+import json
+import pickle
+
+from download_metrics import DownloadMetrics, DownloadRecord, quantiles
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+
+def make_record(end, latency, nbytes=100, status=200):
+    return DownloadRecord(
+        url="u",
+        status=status,
+        attempt=0,
+        queue_wait=0.5,
+        ttfb=latency / 2,
+        transfer=latency / 2,
+        write=0.01,
+        nbytes=nbytes,
+        end=end,
+    )
+
+
+def test_quantiles():
+    assert quantiles(list(range(1, 101)), (0.5, 0.95, 0.99)) == {
+        0.5: 51,
+        0.95: 96,
+        0.99: 100,
+    }
+    assert quantiles([]) == {0.5: 0.0, 0.95: 0.0, 0.99: 0.0}
+
+
+def test_rolling_window():
+    clock = FakeClock()
+    metrics = DownloadMetrics(window=10.0, clock=clock)
+    for i in range(20):
+        clock.t = float(i)
+        metrics.started()
+        metrics.finished(make_record(clock.t, latency=float(i)))
+    assert metrics.in_flight == 0
+
+    clock.t = 20.0
+    summary = metrics.summary()
+    assert summary["requests_total"] == 20
+    assert summary["bytes_total"] == 2000
+    assert summary["bytes_per_second"] == 100.0  # 10 records in last 10 s
+    assert summary["latency_seconds"]["p50"] == 15.0
+    assert summary["status_counts"] == {"200": 20}
+    json.loads(metrics.to_json())
+    # only the window is kept, unless asked for every record
+    assert len(metrics._recent) == 10 and not metrics.records
+    kept = DownloadMetrics(keep_records=True)
+    kept.started()
+    kept.finished(make_record(0.0, latency=1.0))
+    assert len(kept.records) == 1
+
+
+def test_merge():
+    clock = FakeClock()
+    metrics, other = DownloadMetrics(window=10.0, clock=clock), DownloadMetrics(
+        window=10.0, clock=clock
+    )
+    for i in range(20):
+        clock.t = float(i)
+        for m in (metrics, other):
+            m.started()
+            m.finished(make_record(clock.t, latency=1.0, status=200 + i % 2))
+    metrics.merge(pickle.loads(pickle.dumps(other)))
+    clock.t = 20.0
+    summary = metrics.summary()
+    assert summary["requests_total"] == 40
+    assert summary["bytes_total"] == 4000
+    assert summary["requests_per_second"] == 2.0
+    assert summary["status_counts"] == {"200": 20, "201": 20}
+    assert metrics.seconds_total["latency"] == 40.0
+
+
+def test_prometheus(tmp_path):
+    metrics = DownloadMetrics()
+    metrics.started()
+    metrics.finished(make_record(metrics.now(), latency=1.0, status=503))
+    metrics.extra["limit_max_at_once"] = 4
+    text = metrics.to_prometheus()
+    assert 'merra2_download_responses_total{status="503"} 1' in text
+    assert 'merra2_download_latency_seconds{quantile="0.95"} 1.0' in text
+    assert "merra2_download_limit_max_at_once 4" in text
+    # summaries also need their _sum and _count series
+    assert "merra2_download_latency_seconds_sum 1.0" in text
+    assert "merra2_download_latency_seconds_count 1" in text
+    assert "merra2_download_queue_wait_seconds_sum 0.5" in text
+
+    metrics.dump(tmp_path / "metrics.prom")
+    assert (tmp_path / "metrics.prom").read_text().startswith("# TYPE")
@@ -0,0 +1,384 @@
+import datetime
+import json
+import math
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+import merra_urls
+from download_manifest import COMPLETE, DownloadManifest
+
+_STREAM_YEARS = np.array([1992, 2001, 2011])
+_STREAMS = np.array(["100", "200", "300", "400"])
+
+SCHEDULES = ("longest_first", "by_date")
+
+
+def _collection_key(collection: dict) -> Tuple[str, str, Tuple[str, ...]]:
+    return (
+        collection["collection"],
+        collection["short_name"],
+        tuple(collection["fields"]),
+    )
+
+
+class DownloadPlan(object):
+    def __init__(
+        self,
+        dates: np.ndarray,
+        collection_ids: np.ndarray,
+        slabs: np.ndarray,
+        collections: Sequence[dict],
+    ) -> None:
+        """A set of MERRA-2 OPeNDAP requests stored as arrays: one entry per (date, collection, slab). URLs are only rendered when asked for, all at once with numpy string operations, so planning, diffing, and size estimates for multi-decade jobs take milliseconds.
+
+        Usually built with DownloadPlan.from_intervals or DownloadPlan.from_urls rather than directly. Iterating over a plan yields its URLs, so a plan can be passed anywhere a URL iterable is expected, e.g. AsyncDownloader.download.
+
+        Parameters
+        ----------
+        dates : np.ndarray
+            datetime64[D] date of each entry
+        collection_ids : np.ndarray
+            index into collections of each entry
+        slabs : np.ndarray
+            (n, 6) inclusive index slabs of each entry: time start, time stop, lat start, lat stop, lon start, lon stop
+        collections : Sequence[dict]
+            collection dicts as passed to merra_urls.url_generator
+
+        Example
+        -------
+        plan = DownloadPlan.from_intervals(time_interval, lat_interval, lon_interval, collections)
+        todo = plan.missing_from_manifest(DownloadManifest(path), directory)
+        asyncio.run(AsyncDownloader(directory).download(todo))
+        """
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.collection_ids = np.asarray(collection_ids, dtype=np.int64)
+        self.slabs = np.asarray(slabs, dtype=np.int64).reshape(-1, 6)
+        self.collections = [dict(c) for c in collections]
+        if not (len(self.dates) == len(self.collection_ids) == len(self.slabs)):
+            raise ValueError("dates, collection_ids, and slabs must have equal length")
+
+    @classmethod
+    def from_intervals(
+        cls,
+        time_interval: Tuple[datetime.datetime, datetime.datetime],
+        lat_interval: Tuple[float, float] = (-90, 90),
+        lon_interval: Tuple[float, float] = (-180, 180),
+        collections: Optional[Sequence[dict]] = None,
+    ) -> "DownloadPlan":
+        """Same requests, in the same order, as merra_urls.url_generator with the same arguments"""
+        collections = list(collections or [])
+        start, end = time_interval
+        n_days = max(math.ceil((end - start).total_seconds() / 86400), 0)
+        days = np.datetime64(start.date(), "D") + np.arange(n_days)
+        lat_slab = (
+            merra_urls.lat_to_index_num(lat_interval[0]),
+            merra_urls.lat_to_index_num(lat_interval[1]),
+        )
+        lon_slab = (
+            merra_urls.lon_to_index_num(lon_interval[0]),
+            merra_urls.lon_to_index_num(lon_interval[1]),
+        )
+        slab = np.array([0, 23, *lat_slab, *lon_slab])
+        n_collections = len(collections)
+        return cls(
+            dates=np.tile(days, n_collections),
+            collection_ids=np.repeat(np.arange(n_collections), n_days),
+            slabs=np.broadcast_to(slab, (n_days * n_collections, 6)),
+            collections=collections,
+        )
+
+    @classmethod
+    def from_urls(cls, urls: Iterable[str]) -> "DownloadPlan":
+        """Plan for existing URLs, e.g. from url_generator or a failed downloads file"""
+        collections: List[dict] = []
+        ids: Dict[Tuple[str, str, Tuple[str, ...]], int] = {}
+        dates, collection_ids, slabs = [], [], []
+        for url in urls:
+            parsed = merra_urls.parse_url(url)
+            collection = {
+                "collection": parsed["collection"],
+                "short_name": parsed["short_name"],
+                "fields": parsed["fields"],
+            }
+            key = _collection_key(collection)
+            if key not in ids:
+                ids[key] = len(collections)
+                collections.append(collection)
+            dates.append(parsed["date"].date())
+            collection_ids.append(ids[key])
+            slabs.append(
+                [
+                    *(parsed["time"] or (0, 23)),
+                    *(parsed["lat"] or (0, 360)),
+                    *(parsed["lon"] or (0, 575)),
+                ]
+            )
+        return cls(
+            np.array(dates, dtype="datetime64[D]"),
+            np.array(collection_ids, dtype=np.int64),
+            np.array(slabs, dtype=np.int64).reshape(-1, 6),
+            collections,
+        )
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.urls().tolist())
+
+    def __getitem__(self, index) -> "DownloadPlan":
+        """Subset by boolean mask, integer array, or slice"""
+        return DownloadPlan(
+            self.dates[index],
+            self.collection_ids[index],
+            self.slabs[index],
+            self.collections,
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DownloadPlan):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        keys, other_keys = self._joint_keys(other)
+        return bool(np.all(keys == other_keys))
+
+    def __or__(self, other: "DownloadPlan") -> "DownloadPlan":
+        return self.union(other)
+
+    def __sub__(self, other: "DownloadPlan") -> "DownloadPlan":
+        return self.difference(other)
+
+    def __and__(self, other: "DownloadPlan") -> "DownloadPlan":
+        return self.intersection(other)
+
+    # --- rendering ---
+
+    def _date_strings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Production stream, YYYYMMDD, and YYYY/MM strings of each entry. Built once per unique date."""
+        days, inverse = np.unique(self.dates, return_inverse=True)
+        years = days.astype("datetime64[Y]").astype(int) + 1970
+        this_year = datetime.datetime.now().year
+        bad = (years < 1980) | (years > this_year)
+        if bad.any():
+            raise ValueError(
+                f"Year {years[bad][0]} out of range. must be in [1980, {this_year}]"
+            )
+        streams = _STREAMS[np.searchsorted(_STREAM_YEARS, years, side="right")]
+        ymd = np.char.replace(np.datetime_as_string(days, unit="D"), "-", "")
+        year_month = np.char.replace(
+            np.datetime_as_string(days.astype("datetime64[M]")), "-", "/"
+        )
+        return streams[inverse], ymd[inverse], year_month[inverse]
+
+    def _filenames(self, streams: np.ndarray, ymd: np.ndarray) -> np.ndarray:
+        # MERRA2_{stream}.{collection}.{date}.nc4
+        names = np.array([f".{c['collection']}." for c in self.collections])
+        out = np.char.add("MERRA2_", streams)
+        out = np.char.add(out, names[self.collection_ids])
+        out = np.char.add(out, ymd)
+        return np.char.add(out, ".nc4")
+
+    def filenames(self) -> np.ndarray:
+        """Output file name of each entry, as AsyncDownloader names them"""
+        if not len(self):
+            return np.array([], dtype=str)
+        streams, ymd, _ = self._date_strings()
+        return self._filenames(streams, ymd)
+
+    def urls(self) -> np.ndarray:
+        """Vectorised URL rendering. Identical to url_generator's output for the same request."""
+        if not len(self):
+            return np.array([], dtype=str)
+        # only unique (collection, slab) pairs need a query string built in Python
+        _, first, inverse = np.unique(
+            self._packed_requests(), return_index=True, return_inverse=True
+        )
+        queries = np.array(
+            [
+                merra_urls.build_query(
+                    self.collections[cid]["fields"], row[0:2], row[2:4], row[4:6]
+                )
+                for cid, row in zip(
+                    self.collection_ids[first].tolist(), self.slabs[first].tolist()
+                )
+            ]
+        )
+        prefixes = np.array(
+            [
+                f"{merra_urls.BASE_URL}{c['short_name']}.5.12.4/"
+                for c in self.collections
+            ]
+        )
+        streams, ymd, year_month = self._date_strings()
+        out = np.char.add(prefixes[self.collection_ids], year_month)
+        out = np.char.add(out, "/")
+        out = np.char.add(out, self._filenames(streams, ymd))
+        out = np.char.add(out, ".nc4?")
+        return np.char.add(out, queries[inverse])
+
+    def nbytes(self, dtype: Union[str, np.dtype] = "float32") -> np.ndarray:
+        """Estimated response size of each entry, from slab shape and field count. Ignores coordinates and headers, which are small by comparison."""
+        n_fields = np.array([len(c["fields"]) for c in self.collections] or [0])
+        shape = self.slabs[:, 1::2] - self.slabs[:, 0::2] + 1
+        return (
+            shape.prod(axis=1)
+            * n_fields[self.collection_ids]
+            * np.dtype(dtype).itemsize
+        )
+
+    # --- set operations ---
+
+    def _remap(self, collections: Sequence[dict]) -> Tuple[List[dict], "DownloadPlan"]:
+        """Extend collections with any of self's that are missing, and return an equivalent plan that indexes into the extended list"""
+        collections = list(collections)
+        ids = {_collection_key(c): i for i, c in enumerate(collections)}
+        mapping = []
+        for collection in self.collections:
+            key = _collection_key(collection)
+            if key not in ids:
+                ids[key] = len(collections)
+                collections.append(collection)
+            mapping.append(ids[key])
+        mapping_arr = np.array(mapping or [0], dtype=np.int64)
+        return collections, DownloadPlan(
+            self.dates, mapping_arr[self.collection_ids], self.slabs, collections
+        )
+
+    def _packed_requests(self) -> np.ndarray:
+        """Collection and slab of each entry packed into one int64, so set operations can use fast integer sorts. Bits: 15 collection, 5 + 5 time, 9 + 9 lat, 10 + 10 lon."""
+        s = self.slabs
+        return (
+            self.collection_ids << 48
+            | s[:, 0] << 43
+            | s[:, 1] << 38
+            | s[:, 2] << 29
+            | s[:, 3] << 20
+            | s[:, 4] << 10
+            | s[:, 5]
+        )
+
+    def _concatenate(self, other: "DownloadPlan") -> "DownloadPlan":
+        collections, other = other._remap(self.collections)
+        return DownloadPlan(
+            np.concatenate([self.dates, other.dates]),
+            np.concatenate([self.collection_ids, other.collection_ids]),
+            np.concatenate([self.slabs, other.slabs]),
+            collections,
+        )
+
+    def _keys(self) -> np.ndarray:
+        """One int64 per entry, equal for equal entries within this plan"""
+        if not len(self):
+            return np.array([], dtype=np.int64)
+        _, request_ids = np.unique(self._packed_requests(), return_inverse=True)
+        days = self.dates.astype(np.int64)
+        return (days - days.min()) * (request_ids.max() + 1) + request_ids
+
+    def _joint_keys(self, other: "DownloadPlan") -> Tuple[np.ndarray, np.ndarray]:
+        """_keys of self and other, comparable with each other"""
+        keys = self._concatenate(other)._keys()
+        return keys[: len(self)], keys[len(self) :]
+
+    def union(self, other: "DownloadPlan") -> "DownloadPlan":
+        """Entries in either plan, without duplicates. Order is self's entries, then other's new ones."""
+        combined = self._concatenate(other)
+        _, first = np.unique(combined._keys(), return_index=True)
+        return combined[np.sort(first)]
+
+    def difference(self, other: "DownloadPlan") -> "DownloadPlan":
+        """Entries of self that are not in other"""
+        keys, other_keys = self._joint_keys(other)
+        return self[~np.isin(keys, other_keys)]
+
+    def intersection(self, other: "DownloadPlan") -> "DownloadPlan":
+        """Entries of self that are also in other"""
+        keys, other_keys = self._joint_keys(other)
+        return self[np.isin(keys, other_keys)]
+
+    def missing_files(self, directory: Union[str, Path]) -> "DownloadPlan":
+        """Entries whose output file is not in directory. File names don't encode fields or slabs, so a file from a different request for the same collection and date counts as present; use missing_from_manifest when that matters."""
+        try:
+            existing = np.array(os.listdir(directory))
+        except FileNotFoundError:
+            return self
+        return self[~np.isin(self.filenames(), existing)]
+
+    def missing_from_manifest(
+        self, manifest: DownloadManifest, directory: Union[str, Path]
+    ) -> "DownloadPlan":
+        """Entries that manifest doesn't record as complete with an intact file, by the same rule as DownloadManifest.is_complete. Scans directory once instead of stat-ing each file."""
+        try:
+            sizes = {e.name: e.stat().st_size for e in os.scandir(directory)}
+        except FileNotFoundError:
+            return self
+        complete = []
+        for url in manifest:
+            entry = manifest.get(url)
+            if (
+                entry is not None
+                and entry["status"] == COMPLETE
+                and sizes.get(str(entry["filename"])) == entry["size"]
+            ):
+                complete.append(url)
+        if not complete:
+            return self
+        return self[~np.isin(self.urls(), np.array(complete))]
+
+    # --- serialisation ---
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save to a compressed .npz file"""
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                dates=self.dates.astype(np.int64),
+                collection_ids=self.collection_ids,
+                slabs=self.slabs,
+                collections=np.array(json.dumps(self.collections)),
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "DownloadPlan":
+        with np.load(path) as data:
+            return cls(
+                data["dates"].astype("datetime64[D]"),
+                data["collection_ids"],
+                data["slabs"],
+                json.loads(str(data["collections"])),
+            )
+
+
+def schedule_urls(
+    urls: Sequence[str], schedule: str, dtype: Union[str, np.dtype] = "float32"
+) -> List[str]:
+    """Reorder urls by estimated response size (DownloadPlan.nbytes).
+
+    Parameters
+    ----------
+    urls : Sequence[str]
+        MERRA-2 OPeNDAP URLs
+    schedule : str
+        'longest_first': largest responses first, so big files don't start last and stretch out the end of the run.
+        'by_date': dates in order, largest first within each date, so each date's files finish close together and can be processed early.
+    dtype : Union[str, np.dtype], optional
+        assumed dtype of the response values, by default "float32"
+
+    Returns
+    -------
+    List[str]
+        urls in download order. Ties keep their original order.
+    """
+    if schedule not in SCHEDULES:
+        raise ValueError(f"schedule must be one of {SCHEDULES}; given {schedule}")
+    urls = list(urls)
+    plan = DownloadPlan.from_urls(urls)
+    sizes = plan.nbytes(dtype)
+    if schedule == "longest_first":
+        order = np.argsort(-sizes, kind="stable")
+    else:
+        order = np.lexsort((-sizes, plan.dates))
+    return [urls[i] for i in order]
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import merra_urls
+from download_manifest import COMPLETE, DownloadManifest
+from download_plan import DownloadPlan, schedule_urls
+
+COLLECTIONS = [
+    {
+        "collection": "tavg1_2d_slv_Nx",
+        "short_name": "M2T1NXSLV",
+        "fields": ["PS", "T10M"],
+    },
+    {
+        "collection": "inst1_2d_lfo_Nx",
+        "short_name": "M2I1NXLFO",
+        "fields": ["SPEEDLML"],
+    },
+]
+REQUEST = dict(
+    time_interval=(datetime(2000, 12, 30), datetime(2001, 1, 3)),
+    lat_interval=(-2, 2),
+    lon_interval=(-2, 2),
+    collections=COLLECTIONS,
+)
+
+
+def test_urls_match_url_generator():
+    plan = DownloadPlan.from_intervals(**REQUEST)
+    expected = list(merra_urls.url_generator(**REQUEST))
+    assert len(plan) == 8
+    assert plan.urls().tolist() == expected
+    assert list(plan) == expected
+    assert DownloadPlan.from_urls(expected) == plan
+    assert plan.filenames()[0] == "MERRA2_200.tavg1_2d_slv_Nx.20001230.nc4"
+
+
+def test_nbytes():
+    plan = DownloadPlan.from_intervals(**REQUEST)
+    cells = 24 * 9 * 7
+    assert plan.nbytes().tolist() == [cells * 2 * 4] * 4 + [cells * 4] * 4
+    assert plan.nbytes("float64")[0] == cells * 2 * 8
+
+
+def test_set_operations():
+    plan = DownloadPlan.from_intervals(**REQUEST)
+    first_two_days = DownloadPlan.from_intervals(
+        **{**REQUEST, "time_interval": (datetime(2000, 12, 30), datetime(2001, 1, 1))}
+    )
+    # other plan with its collections in a different order
+    lfo_only = DownloadPlan.from_intervals(
+        **{**REQUEST, "collections": COLLECTIONS[1:]}
+    )
+    assert len(plan - first_two_days) == 4
+    assert len(plan & first_two_days) == 4
+    assert len(plan - lfo_only) == 4
+    assert set(plan - lfo_only) == set(plan.urls()[:4])
+    assert list(first_two_days | lfo_only)[:4] == list(first_two_days)
+    assert len(first_two_days | lfo_only) == 6
+    assert set(first_two_days | plan) == set(plan)
+
+
+def test_missing_files_and_manifest(tmp_path):
+    plan = DownloadPlan.from_intervals(**REQUEST)
+    urls = plan.urls()
+    filenames = plan.filenames()
+    (tmp_path / filenames[0]).write_bytes(b"abc")
+    (tmp_path / filenames[1]).write_bytes(b"abc")
+    manifest = DownloadManifest(tmp_path / "manifest.jsonl")
+    manifest.record(urls[0], filenames[0], 3, COMPLETE)
+    manifest.record(urls[1], filenames[1], 999, COMPLETE)  # truncated file
+
+    assert len(plan.missing_files(tmp_path)) == 6
+    todo = plan.missing_from_manifest(manifest, tmp_path)
+    assert list(todo) == [
+        u for u in urls.tolist() if not manifest.is_complete(u, tmp_path)
+    ]
+    assert len(todo) == 7
+
+
+def test_save_load(tmp_path):
+    plan = DownloadPlan.from_intervals(**REQUEST)
+    plan.save(tmp_path / "plan.npz")
+    loaded = DownloadPlan.load(tmp_path / "plan.npz")
+    assert loaded == plan
+    assert np.array_equal(loaded.urls(), plan.urls())
+
+
+def test_schedule_urls():
+    urls = list(merra_urls.url_generator(**REQUEST))
+    # slv has 2 fields, lfo has 1
+    longest = schedule_urls(urls, "longest_first")
+    assert longest == urls
+    assert schedule_urls(urls[::-1], "longest_first") == urls[3::-1] + urls[:3:-1]
+    by_date = schedule_urls(urls, "by_date")
+    assert by_date == [u for pair in zip(urls[:4], urls[4:]) for u in pair]
+    with pytest.raises(ValueError):
+        schedule_urls(urls, "shortest_first")
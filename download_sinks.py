@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import aiofiles
+
+
+class FileSink(object):
+    # files persist between runs, so the downloader's manifest can skip them
+    persistent = True
+
+    def __init__(self, directory: Union[str, Path], buffer_size: int = 2**20) -> None:
+        """Write each response to directory / filename. Chunks are collected into buffer_size blocks before each write, which cuts the number of aiofiles thread hops when the server sends small chunks. Written to a temporary '.part' file and atomically renamed when complete, so a file is never left truncated under its final name.
+
+        Parameters
+        ----------
+        directory : Union[str, Path]
+            output directory
+        buffer_size : int, optional
+            bytes to collect before each write, by default 1 MiB
+        """
+        self.directory = Path(directory)
+        self.buffer_size = buffer_size
+
+    async def write(
+        self, url: str, filename: str, chunks: AsyncIterator[bytes]
+    ) -> Tuple[int, float]:
+        """Consume chunks and store them. Returns bytes stored and seconds spent waiting on storage."""
+        filepath = self.directory / filename
+        part_path = filepath.with_name(filepath.name + ".part")
+        size = 0
+        write_time = 0.0
+        buffer: List[bytes] = []
+        buffered = 0
+        try:
+            async with aiofiles.open(part_path, "wb") as f:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    buffer.append(chunk)
+                    buffered += len(chunk)
+                    size += len(chunk)
+                    if buffered >= self.buffer_size:
+                        t0 = time.monotonic()
+                        await f.write(b"".join(buffer))
+                        write_time += time.monotonic() - t0
+                        buffer, buffered = [], 0
+                if buffer:
+                    t0 = time.monotonic()
+                    await f.write(b"".join(buffer))
+                    write_time += time.monotonic() - t0
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        os.replace(part_path, filepath)  # atomic, so filepath is never truncated
+        return size, write_time
+
+
+class MemorySink(object):
+    persistent = False
+
+    def __init__(self) -> None:
+        """Keep each response in memory, in self.buffers keyed by URL. Pair with merra_etl.merra_buffers_to_parquet to skip intermediate files entirely."""
+        self.buffers: Dict[str, bytes] = {}
+
+    async def write(
+        self, url: str, filename: str, chunks: AsyncIterator[bytes]
+    ) -> Tuple[int, float]:
+        parts = [chunk async for chunk in chunks]
+        self.buffers[url] = b"".join(parts)
+        return len(self.buffers[url]), 0.0
+
+    def pop_all(self) -> Dict[str, bytes]:
+        """Return and forget all stored buffers"""
+        buffers, self.buffers = self.buffers, {}
+        return buffers
+
+
+class CallbackSink(object):
+    persistent = False
+
+    def __init__(
+        self, callback: Callable[[str, bytes], Optional[Awaitable[None]]]
+    ) -> None:
+        """Hand each complete response body to callback(url, body). Coroutine functions are awaited; plain functions are run in a thread so they don't block the event loop. Nothing is kept after the callback returns.
+
+        Parameters
+        ----------
+        callback : Callable[[str, bytes], Optional[Awaitable[None]]]
+            called once per successful download
+        """
+        self.callback = callback
+
+    async def write(
+        self, url: str, filename: str, chunks: AsyncIterator[bytes]
+    ) -> Tuple[int, float]:
+        body = b"".join([chunk async for chunk in chunks])
+        t0 = time.monotonic()
+        if asyncio.iscoroutinefunction(self.callback):
+            await self.callback(url, body)
+        else:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.callback, url, body
+            )
+        return len(body), time.monotonic() - t0
+
+
+Sink = Union[FileSink, MemorySink, CallbackSink]
@@ -0,0 +1,113 @@
+import hashlib
+from pathlib import Path
+from typing import AsyncIterator, Optional, Union
+
+import merra_urls
+
+# netCDF classic, netCDF 64-bit offset, and HDF5 (netCDF4) file signatures
+SIGNATURES = (b"CDF\x01", b"CDF\x02", b"\x89HDF\r\n\x1a\n")
+
+# failure reasons for responses that arrived but aren't usable data files
+BAD_SIGNATURE = "bad_signature"
+TRUNCATED = "truncated"
+BAD_DIMENSIONS = "bad_dimensions"
+INVALID_REASONS = frozenset([BAD_SIGNATURE, TRUNCATED, BAD_DIMENSIONS])
+
+
+class InvalidDownload(Exception):
+    def __init__(self, reason: str, message: str) -> None:
+        super().__init__(message)
+        self.reason = reason
+
+
+class StreamCheck(object):
+    def __init__(
+        self,
+        chunks: AsyncIterator[bytes],
+        expected_size: Optional[int] = None,
+        algorithm: str = "sha256",
+    ) -> None:
+        """Pass chunks through unchanged while hashing them and checking the file signature and total size, so a response is verified in the same pass that stores it.
+
+        Raises InvalidDownload from iteration: as soon as the first bytes don't match a netCDF/HDF5 signature (e.g. an HTML error page), or at the end of the stream if fewer or more than expected_size bytes arrived. Because the error is raised while the sink is still consuming chunks, sinks never finalize an invalid response.
+
+        Parameters
+        ----------
+        chunks : AsyncIterator[bytes]
+            response body chunks
+        expected_size : Optional[int], optional
+            expected total bytes, e.g. from Content-Length, by default None to skip the size check
+        algorithm : str, optional
+            hashlib algorithm name, by default "sha256"
+        """
+        self._chunks = chunks
+        self.expected_size = expected_size
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+        self._head = b""
+        self.size = 0
+
+    @property
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def __aiter__(self) -> "StreamCheck":
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._check_signature(final=True)
+            if self.expected_size is not None and self.size != self.expected_size:
+                raise InvalidDownload(
+                    TRUNCATED,
+                    f"received {self.size} bytes, expected {self.expected_size}",
+                )
+            raise
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if len(self._head) < 8:
+            self._head += chunk[:8]
+            self._check_signature()
+        return chunk
+
+    def _check_signature(self, final: bool = False) -> None:
+        head = self._head
+        for signature in SIGNATURES:
+            if head[: len(signature)] == signature[: len(head)] and (
+                len(head) >= len(signature) or not final
+            ):
+                return
+        raise InvalidDownload(
+            BAD_SIGNATURE, f"not a netCDF or HDF5 file; starts with {head[:8]!r}"
+        )
+
+
+def check_dimensions(filepath: Union[str, Path], url: str) -> Optional[str]:
+    """Check that a downloaded file has the fields and time/lat/lon sizes requested by url. Blocking; run it in a thread.
+
+    Returns
+    -------
+    Optional[str]
+        description of the first problem found, or None if the file is valid
+    """
+    import xarray as xr
+
+    parsed = merra_urls.parse_url(url)
+    try:
+        ds = xr.open_dataset(filepath, decode_times=False)
+    except Exception as e:  # any failure to open means the file is unusable
+        return f"unreadable: {e}"
+    with ds:
+        missing = [field for field in parsed["fields"] if field not in ds]
+        if missing:
+            return f"missing fields {missing}"
+        for dim in ("time", "lat", "lon"):
+            slab = parsed[dim]
+            if slab is None:
+                continue
+            expected = slab[1] - slab[0] + 1
+            if ds.sizes.get(dim) != expected:
+                return f"{dim} has size {ds.sizes.get(dim)}, expected {expected}"
+    return None
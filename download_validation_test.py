@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from download_validation import (
+    BAD_SIGNATURE,
+    TRUNCATED,
+    InvalidDownload,
+    StreamCheck,
+    check_dimensions,
+)
+from fake_opendap_server import synthetic_response
+
+URL = "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2I1NXLFO.5.12.4/2020/03/MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4?PS[0:23][176:184][285:291],SPEEDLML[0:23][176:184][285:291],time,lat[176:184],lon[285:291]"
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def _consume(check):
+    async def run():
+        return [chunk async for chunk in check]
+
+    return asyncio.run(run())
+
+
+def test_stream_check():
+    body = synthetic_response(URL)
+    # signature split across chunks
+    chunks = [body[:2], body[2:100], body[100:]]
+    check = StreamCheck(_aiter(chunks), expected_size=len(body))
+    assert _consume(check) == chunks
+    assert check.hexdigest == hashlib.sha256(body).hexdigest()
+    assert check.size == len(body)
+
+    hdf5 = b"\x89HDF\r\n\x1a\n" + b"\x00" * 100
+    _consume(StreamCheck(_aiter([hdf5])))
+
+
+def test_stream_check_failures():
+    passed = []
+
+    async def run(check):
+        async for chunk in check:
+            passed.append(chunk)
+
+    html = [b"<html>", b"error", b"</html>"]
+    with pytest.raises(InvalidDownload) as err:
+        asyncio.run(run(StreamCheck(_aiter(html))))
+    assert err.value.reason == BAD_SIGNATURE
+    assert passed == []  # fails on the first chunk
+
+    body = synthetic_response(URL)
+    with pytest.raises(InvalidDownload) as err:
+        _consume(StreamCheck(_aiter([body[:-10]]), expected_size=len(body)))
+    assert err.value.reason == TRUNCATED
+
+    for short in (b"", b"CDF"):
+        with pytest.raises(InvalidDownload) as err:
+            _consume(StreamCheck(_aiter([short])))
+        assert err.value.reason == BAD_SIGNATURE
+
+
+def test_check_dimensions(tmp_path):
+    good = tmp_path / "good.nc4"
+    good.write_bytes(synthetic_response(URL))
+    assert check_dimensions(good, URL) is None
+
+    short = tmp_path / "short.nc4"
+    short.write_bytes(synthetic_response(URL.replace("[0:23]", "[0:22]")))
+    assert "time" in check_dimensions(short, URL)  # type: ignore
+
+    missing = tmp_path / "missing.nc4"
+    missing.write_bytes(
+        synthetic_response(URL.replace(",SPEEDLML[0:23][176:184][285:291]", ""))
+    )
+    assert "SPEEDLML" in check_dimensions(missing, URL)  # type: ignore
+
+    garbage = tmp_path / "garbage.nc4"
+    garbage.write_bytes(b"CDF\x01garbage")
+    assert check_dimensions(garbage, URL) is not None
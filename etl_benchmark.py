@@ -0,0 +1,475 @@
+"""Offline benchmarks for the ETL path, run on synthetic MERRA-2-like data held in memory.
+
+Benchmarks:
+* transforms: merra_etl.transforms followed by reduce_precision (the xarray expression chain) against merra_etl.fused_transforms, for each precision reduction method. Reports the best time over --repeat runs, throughput of input data, and peak memory traced by tracemalloc during a separate run.
+* rounding: the precision reduction engines alone, applied to already transformed data: binary_round based reduce_precision ('round', 'fp16') against the mantissa bit rounding of reduce_mantissa ('bitround', 'bitgroom'). Reports the best time and throughput as above, the size of the result written to parquet in grid point order with --compression, and the largest absolute error per variable.
+* write: writing transformed data to grid point ordered parquet files from daily netCDF files (written first, already transformed): through a rechunked dask DataFrame with to_dask_dataframe and repartition (the previous merra_nc4_to_parquet path) against merra_nc4_to_parquet's direct Arrow writer at each of --memory-budgets. Also converts one in-memory tile with to_dataframe and with merra_etl.dataset_to_arrow. Reports the best time, throughput and peak traced memory as above. On the default 41x132 grid, the Arrow writer's peak at a 100 MB budget stayed at 57-64 MB from 10 to 60 days (45-268 MB of input), while the dask path's grew from 75 MB to 245 MB (142 MB at 30 days). At 5 days or fewer the two peaks are within run-to-run noise of each other, and dask's can be lower. A 1000 MB budget trades memory for speed: its peak grows with the input up to the budget.
+* layout: parquet files written in each of the LAYOUTS (codecs, encodings and row group sizes, see parquet_layout.ParquetLayout) after each precision reduction. Reports the total file size, the best write time and throughput, the number of row groups, and the median latency of reading one random grid point's full time series over --reads points, both with a lat/lon filter on the whole directory and through parquet_reader.ParquetReader's spatial index.
+* sites: bilinear interpolation of all variables to --sites random sites with xarray's Dataset.interp against site_interpolation.interpolate_to_sites, computing its weights and with them cached in a WeightCache. Reports the best time and throughput of input data as above.
+
+Example
+-------
+python etl_benchmark.py transforms --days 30 --lat 41 --lon 132
+python etl_benchmark.py rounding --compression zstd
+python etl_benchmark.py write --megabytes-per-file 10
+python etl_benchmark.py layout --precision-reductions none round
+python etl_benchmark.py sites --sites 5000
+"""
+
+import argparse
+import io
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xarray as xr
+
+import merra_etl
+from download_benchmark import print_table
+from fake_opendap_server import FIELD_BASE_VALUES
+from parquet_layout import COORDINATES, ParquetLayout
+from parquet_reader import ParquetReader
+from site_interpolation import WeightCache, interpolate_to_sites
+
+# relative size of the diurnal cycle, spatial gradient and noise around each field's base value
+FIELD_VARIATION = (0.05, 0.05, 0.02)
+
+LAYOUTS = {
+    # pyarrow's own row groups, which ignore grid points
+    "snappy_unaligned": ParquetLayout(row_group_megabytes=None),
+    "snappy": ParquetLayout(),
+    "zstd": ParquetLayout(compression="zstd"),
+    "zstd_bss": ParquetLayout(
+        compression="zstd", dictionary=COORDINATES, byte_stream_split=True
+    ),
+    "zstd_bss_point": ParquetLayout(
+        compression="zstd",
+        dictionary=COORDINATES,
+        byte_stream_split=True,
+        row_group_megabytes=0,
+    ),
+}
+
+
+def synthetic_dataset(days: int, n_lat: int, n_lon: int, seed: int = 0) -> xr.Dataset:
+    """Hourly float32 fields with a diurnal cycle, a smooth spatial gradient and noise, so values vary like real data rather than repeating a short pattern"""
+    rng = np.random.default_rng(seed)
+    n_time = 24 * days
+    hours = np.arange(n_time)[:, None, None]
+    lat = -90 + 0.5 * np.arange(200, 200 + n_lat)
+    lon = -180 + 0.625 * np.arange(100, 100 + n_lon)
+    gradient = np.add.outer(np.linspace(-1, 1, n_lat), np.linspace(-1, 1, n_lon))
+    diurnal_size, gradient_size, noise_size = FIELD_VARIATION
+    data_vars = {}
+    for field, base in FIELD_BASE_VALUES.items():
+        values = base * (
+            1
+            + diurnal_size * np.sin(2 * np.pi * hours / 24)
+            + gradient_size * gradient
+            + noise_size * rng.standard_normal((n_time, n_lat, n_lon))
+        )
+        data_vars[field] = (("time", "lat", "lon"), values.astype(np.float32))
+    return xr.Dataset(
+        data_vars,
+        coords={
+            "time": pd.date_range("2020-01-01 00:30", periods=n_time, freq="h"),
+            "lat": lat,
+            "lon": lon,
+        },
+    )
+
+
+def measure(func: Callable[[], object], repeat: int) -> Tuple[float, float]:
+    """Best wall time of func over repeat runs, and peak traced memory in MB of one more run"""
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 2**20
+
+
+def expression_chain(ds: xr.Dataset, precision_reduction: Optional[str]) -> xr.Dataset:
+    out = merra_etl.transforms(ds.copy())
+    if precision_reduction is not None:
+        merra_etl.reduce_precision(out, fp16=precision_reduction == "fp16")
+    return out
+
+
+def benchmark_transforms(
+    ds: xr.Dataset, precision_reductions: Sequence[str], repeat: int = 3
+) -> List[Dict[str, Union[str, float]]]:
+    methods = {
+        "chain": expression_chain,
+        "fused": merra_etl.fused_transforms,
+    }
+    megabytes = ds.nbytes / 2**20
+    rows = []
+    for precision_reduction in precision_reductions:
+        reduction = None if precision_reduction == "none" else precision_reduction
+        for method, func in methods.items():
+            seconds, peak = measure(lambda: func(ds, reduction), repeat)
+            output = func(ds, reduction)
+            rows.append(
+                {
+                    "method": method,
+                    "precision_reduction": precision_reduction,
+                    "seconds": seconds,
+                    "mb_per_second": megabytes / seconds,
+                    "input_mb": megabytes,
+                    "output_mb": output.nbytes / 2**20,
+                    "peak_mb": peak,
+                }
+            )
+    return rows
+
+
+def reduce(ds: xr.Dataset, precision_reduction: str) -> xr.Dataset:
+    out = ds.copy()
+    if precision_reduction in merra_etl.MANTISSA_METHODS:
+        merra_etl.reduce_mantissa(out, groom=precision_reduction == "bitgroom")
+    elif precision_reduction != "none":
+        merra_etl.reduce_precision(out, fp16=precision_reduction == "fp16")
+    return out
+
+
+def parquet_megabytes(ds: xr.Dataset, compression: str) -> float:
+    """Size of ds written to parquet in grid point order, as the ETL writes it"""
+    table = pa.table(
+        {
+            name: var.transpose("lat", "lon", "time").values.reshape(-1)
+            for name, var in ds.data_vars.items()
+        }
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression)
+    return buffer.tell() / 2**20
+
+
+def benchmark_rounding(
+    ds: xr.Dataset,
+    precision_reductions: Sequence[str],
+    repeat: int = 3,
+    compression: str = "snappy",
+) -> List[Dict[str, Union[str, float]]]:
+    transformed = merra_etl.transforms(ds.copy())
+    megabytes = transformed.nbytes / 2**20
+    rows = []
+    for precision_reduction in precision_reductions:
+        seconds, _ = measure(lambda: reduce(transformed, precision_reduction), repeat)
+        output = reduce(transformed, precision_reduction)
+        row: Dict[str, Union[str, float]] = {
+            "precision_reduction": precision_reduction,
+            "seconds": seconds,
+            "mb_per_second": megabytes / seconds,
+            "parquet_mb": parquet_megabytes(output, compression),
+        }
+        for name in merra_etl.MANTISSA_BITS:
+            error = np.abs(output[name].values - transformed[name].values)
+            row[f"{name}_error"] = float(error.max())
+        rows.append(row)
+    return rows
+
+
+def write_daily_files(ds: xr.Dataset, directory: Path) -> List[Path]:
+    """Write ds as one netCDF file per day, like process_daily's output"""
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for n, day in enumerate(range(0, ds.time.size, 24)):
+        path = directory / f"day{n:04d}.nc4"
+        ds.isel(time=slice(day, day + 24)).to_netcdf(path)
+        files.append(path)
+    return files
+
+
+def write_dask_dataframe(
+    files: Sequence[Path], dir_out: Path, megabytes_per_file: float
+) -> None:
+    """merra_nc4_to_parquet's previous conversion, through a rechunked dask DataFrame. Partitions hold at least one grid point and at most all of them, so small grids (where make_divisions alone gives too few divisions for repartition) work too."""
+    ds = merra_etl.rechunk(merra_etl.open_merra(files))
+    n_points = len(ds.lat) * len(ds.lon)
+    points = int(megabytes_per_file * 2**20 * n_points // ds.nbytes)
+    divisions = merra_etl.make_divisions(
+        ds, points_per_partition=min(max(points, 1), n_points)
+    )
+    ds.to_dask_dataframe().repartition(divisions=divisions).to_parquet(
+        dir_out, compression="snappy", write_index=False
+    )
+
+
+def benchmark_write(
+    ds: xr.Dataset,
+    repeat: int = 3,
+    megabytes_per_file: float = 10,
+    memory_budgets: Sequence[float] = (100, 1000),
+) -> List[Dict[str, Union[str, float]]]:
+    transformed = merra_etl.fused_transforms(ds)
+    megabytes = transformed.nbytes / 2**20
+    rows: List[Dict[str, Union[str, float]]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        files = write_daily_files(transformed, Path(tmp) / "nc4")
+        dir_out = Path(tmp) / "parquet"
+
+        def write(memory_budget: Optional[float]) -> None:
+            shutil.rmtree(dir_out, ignore_errors=True)
+            if memory_budget is None:
+                write_dask_dataframe(files, dir_out, megabytes_per_file)
+            else:
+                merra_etl.merra_nc4_to_parquet(
+                    files,
+                    dir_out,
+                    max_megabytes_per_file=megabytes_per_file,
+                    preprocessed=True,
+                    memory_budget_mb=memory_budget,
+                )
+
+        runs: List[Tuple[str, Optional[float]]] = [("dask_dataframe", None)]
+        runs += [("arrow", budget) for budget in memory_budgets]
+        for method, memory_budget in runs:
+            seconds, peak = measure(lambda: write(memory_budget), repeat)
+            rows.append(
+                {
+                    "method": method,
+                    "memory_budget_mb": memory_budget or "",
+                    "seconds": seconds,
+                    "mb_per_second": megabytes / seconds,
+                    "input_mb": megabytes,
+                    "files": len(list(dir_out.glob("*.parquet"))),
+                    "peak_mb": peak,
+                }
+            )
+
+    # conversion of one in-memory tile alone
+    tile = transformed.isel(lat=slice(0, 8))
+    for method, convert in (
+        (
+            "to_dataframe",
+            lambda: tile.to_dataframe(dim_order=["lat", "lon", "time"]).reset_index(),
+        ),
+        ("to_arrow", lambda: merra_etl.dataset_to_arrow(tile)),
+    ):
+        seconds, peak = measure(convert, repeat)
+        rows.append(
+            {
+                "method": method,
+                "memory_budget_mb": "",
+                "seconds": seconds,
+                "mb_per_second": tile.nbytes / 2**20 / seconds,
+                "input_mb": tile.nbytes / 2**20,
+                "files": 0,
+                "peak_mb": peak,
+            }
+        )
+    return rows
+
+
+def benchmark_layout(
+    ds: xr.Dataset,
+    layouts: Sequence[str],
+    precision_reductions: Sequence[str],
+    repeat: int = 3,
+    megabytes_per_file: float = 10,
+    reads: int = 20,
+) -> List[Dict[str, Union[str, float]]]:
+    transformed = merra_etl.transforms(ds.copy())
+    megabytes = transformed.nbytes / 2**20
+    rng = np.random.default_rng(0)
+    points = list(
+        zip(
+            rng.choice(ds.lat.values, reads),
+            rng.choice(ds.lon.values, reads),
+        )
+    )
+    rows: List[Dict[str, Union[str, float]]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        dir_out = Path(tmp) / "parquet"
+        for precision_reduction in precision_reductions:
+            output = reduce(transformed, precision_reduction)
+            for name in layouts:
+
+                def write() -> None:
+                    shutil.rmtree(dir_out, ignore_errors=True)
+                    merra_etl.dataset_to_parquet(
+                        output,
+                        dir_out,
+                        max_megabytes_per_file=megabytes_per_file,
+                        preprocessed=True,
+                        layout=LAYOUTS[name],
+                    )
+
+                seconds, _ = measure(write, repeat)
+                files = sorted(dir_out.glob("*.parquet"))
+                latencies: Dict[str, List[float]] = {"filter": [], "index": []}
+                reader = ParquetReader(dir_out)
+                for lat, lon in points:
+                    start = time.perf_counter()
+                    pq.read_table(
+                        dir_out, filters=[("lat", "==", lat), ("lon", "==", lon)]
+                    )
+                    latencies["filter"].append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    reader.read_point(lat, lon)
+                    latencies["index"].append(time.perf_counter() - start)
+                rows.append(
+                    {
+                        "precision_reduction": precision_reduction,
+                        "layout": name,
+                        "size_mb": sum(path.stat().st_size for path in files) / 2**20,
+                        "seconds": seconds,
+                        "mb_per_second": megabytes / seconds,
+                        "row_groups": sum(
+                            pq.ParquetFile(path).metadata.num_row_groups
+                            for path in files
+                        ),
+                        "read_ms": 1000 * float(np.median(latencies["filter"])),
+                        "indexed_read_ms": 1000 * float(np.median(latencies["index"])),
+                    }
+                )
+    return rows
+
+
+def benchmark_sites(
+    ds: xr.Dataset, n_sites: int, repeat: int = 3
+) -> List[Dict[str, Union[str, float]]]:
+    transformed = merra_etl.transforms(ds.copy())
+    megabytes = transformed.nbytes / 2**20
+    rng = np.random.default_rng(0)
+    lat, lon = transformed.lat.values, transformed.lon.values
+    sites = np.column_stack(
+        [
+            rng.uniform(lat[0], lat[-1], n_sites),
+            rng.uniform(lon[0], lon[-1], n_sites),
+        ]
+    )
+    cache = WeightCache()
+    cache.weights(sites, lat, lon)
+    methods: Dict[str, Callable[[], object]] = {
+        "xarray_interp": lambda: transformed.interp(
+            lat=xr.DataArray(sites[:, 0], dims="site"),
+            lon=xr.DataArray(sites[:, 1], dims="site"),
+        ),
+        "sparse_weights": lambda: interpolate_to_sites(transformed, sites),
+        "sparse_weights_cached": lambda: interpolate_to_sites(
+            transformed, sites, cache
+        ),
+    }
+    rows: List[Dict[str, Union[str, float]]] = []
+    for method, interpolate in methods.items():
+        seconds, _ = measure(interpolate, repeat)
+        rows.append(
+            {
+                "method": method,
+                "sites": n_sites,
+                "seconds": seconds,
+                "mb_per_second": megabytes / seconds,
+            }
+        )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "benchmark", choices=["transforms", "rounding", "write", "layout", "sites"]
+    )
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--lat", type=int, default=41, help="grid points in latitude")
+    parser.add_argument("--lon", type=int, default=132, help="grid points in longitude")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--precision-reductions",
+        nargs="+",
+        default=None,
+        choices=["none", "round", "fp16", "bitround", "bitgroom"],
+        help="by default none, round and fp16 for transforms, all for rounding, and none, round and bitround for layout",
+    )
+    parser.add_argument(
+        "--compression", default="snappy", help="parquet codec for rounding"
+    )
+    parser.add_argument(
+        "--megabytes-per-file",
+        type=float,
+        default=10,
+        help="max uncompressed size of each parquet file for write and layout",
+    )
+    parser.add_argument(
+        "--memory-budgets",
+        nargs="+",
+        type=float,
+        default=[100, 1000],
+        help="memory_budget_mb values of the Arrow writer for write",
+    )
+    parser.add_argument(
+        "--layouts",
+        nargs="+",
+        default=list(LAYOUTS),
+        choices=list(LAYOUTS),
+        help="parquet layouts for layout",
+    )
+    parser.add_argument(
+        "--reads", type=int, default=20, help="single point reads for layout"
+    )
+    parser.add_argument(
+        "--sites", type=int, default=5000, help="number of sites for sites"
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="also write results as JSON"
+    )
+    args = parser.parse_args()
+
+    ds = synthetic_dataset(args.days, args.lat, args.lon)
+    if args.benchmark == "transforms":
+        precision_reductions = args.precision_reductions or ["none", "round", "fp16"]
+        rows = benchmark_transforms(ds, precision_reductions, args.repeat)
+    elif args.benchmark == "sites":
+        rows = benchmark_sites(ds, args.sites, args.repeat)
+    elif args.benchmark == "layout":
+        precision_reductions = args.precision_reductions or [
+            "none",
+            "round",
+            "bitround",
+        ]
+        rows = benchmark_layout(
+            ds,
+            args.layouts,
+            precision_reductions,
+            args.repeat,
+            args.megabytes_per_file,
+            args.reads,
+        )
+    elif args.benchmark == "write":
+        rows = benchmark_write(
+            ds, args.repeat, args.megabytes_per_file, args.memory_budgets
+        )
+    else:
+        precision_reductions = args.precision_reductions or [
+            "none",
+            "round",
+            "fp16",
+            "bitround",
+            "bitgroom",
+        ]
+        rows = benchmark_rounding(
+            ds, precision_reductions, args.repeat, args.compression
+        )
+    print_table(rows)
+    if args.output is not None:
+        args.output.write_text(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,624 @@
+import contextlib
+import random
+import secrets
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.cookies import SimpleCookie
+from base64 import b64encode
+from urllib.parse import parse_qs, quote, urlsplit
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import merra_urls
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:  # only needed for http2=True
+    h2 = None
+
+# netCDF classic format constants
+_NC_DIMENSION = 10
+_NC_VARIABLE = 11
+_NC_ATTRIBUTE = 12
+_NC_CHAR = 2
+_NC_INT = 4
+_NC_FLOAT = 5
+_NC_DOUBLE = 6
+
+# rough magnitudes so synthetic data survives merra_etl.transforms
+FIELD_BASE_VALUES = {
+    "PS": 95000.0,
+    "TS": 290.0,
+    "T10M": 290.0,
+    "U50M": 3.0,
+    "V50M": 3.0,
+    "PRECTOTCORR": 1e-5,
+    "RHOA": 1.1,
+    "RISFC": 0.5,
+    "GHLAND": 10.0,
+    "Z0M": 0.1,
+}
+
+SESSION_COOKIE = "fake_urs_session"
+
+
+def _pad4(b: bytes) -> bytes:
+    return b + b"\x00" * (-len(b) % 4)
+
+
+def _name(name: str) -> bytes:
+    encoded = name.encode()
+    return struct.pack(">i", len(encoded)) + _pad4(encoded)
+
+
+def _big_endian(values: array) -> bytes:
+    if sys.byteorder == "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def synthetic_netcdf(
+    fields: Sequence[str],
+    time_slab: Tuple[int, int],
+    lat_slab: Tuple[int, int],
+    lon_slab: Tuple[int, int],
+    time_units: str = "minutes since 2000-01-01 00:30:00",
+) -> bytes:
+    """Build a netCDF classic (CDF-1) file shaped like an OPeNDAP MERRA-2 subset, with deterministic synthetic values. Needs only the standard library; can be opened with xr.open_dataset.
+
+    Parameters
+    ----------
+    fields : Sequence[str]
+        variable names, each with dims (time, lat, lon)
+    time_slab, lat_slab, lon_slab : Tuple[int, int]
+        inclusive index ranges, as in merra_urls.parse_url output
+    time_units : str, optional
+        CF units attribute of the time coordinate
+
+    Returns
+    -------
+    bytes
+        file contents
+    """
+    n_time = time_slab[1] - time_slab[0] + 1
+    n_lat = lat_slab[1] - lat_slab[0] + 1
+    n_lon = lon_slab[1] - lon_slab[0] + 1
+    dims = [("time", n_time), ("lat", n_lat), ("lon", n_lon)]
+
+    # (name, dim ids, nc type, attributes, values)
+    variables = [
+        (
+            "time",
+            [0],
+            _NC_INT,
+            {"units": time_units},
+            array("i", (60 * t for t in range(time_slab[0], time_slab[1] + 1))),
+        ),
+        (
+            "lat",
+            [1],
+            _NC_DOUBLE,
+            {"units": "degrees_north"},
+            array("d", (-90 + 0.5 * i for i in range(lat_slab[0], lat_slab[1] + 1))),
+        ),
+        (
+            "lon",
+            [2],
+            _NC_DOUBLE,
+            {"units": "degrees_east"},
+            array("d", (-180 + 0.625 * i for i in range(lon_slab[0], lon_slab[1] + 1))),
+        ),
+    ]
+    pattern = array(
+        "f",
+        (
+            ((t * 7 + i * 3 + j) % 97) / 97
+            for t in range(n_time)
+            for i in range(n_lat)
+            for j in range(n_lon)
+        ),
+    )
+    for field in fields:
+        base = FIELD_BASE_VALUES.get(field, 1.0)
+        values = array("f", (base * (0.9 + 0.2 * p) for p in pattern))
+        variables.append((field, [0, 1, 2], _NC_FLOAT, {}, values))
+
+    header = b"CDF\x01" + struct.pack(">i", 0)
+    header += struct.pack(">ii", _NC_DIMENSION, len(dims))
+    for name, size in dims:
+        header += _name(name) + struct.pack(">i", size)
+    header += struct.pack(">ii", 0, 0)  # no global attributes
+
+    var_headers = []
+    data = []
+    for name, dim_ids, nc_type, attrs, values in variables:
+        var_header = _name(name) + struct.pack(">i", len(dim_ids))
+        var_header += b"".join(struct.pack(">i", d) for d in dim_ids)
+        if attrs:
+            var_header += struct.pack(">ii", _NC_ATTRIBUTE, len(attrs))
+            for attr_name, text in attrs.items():
+                encoded = text.encode()
+                var_header += _name(attr_name)
+                var_header += struct.pack(">ii", _NC_CHAR, len(encoded)) + _pad4(
+                    encoded
+                )
+        else:
+            var_header += struct.pack(">ii", 0, 0)
+        var_headers.append((var_header, nc_type))
+        data.append(_pad4(_big_endian(values)))
+
+    # each variable header ends with type, size, and begin offset (3 int32)
+    header_size = len(header) + 8 + sum(len(h) + 12 for h, _ in var_headers)
+    header += struct.pack(">ii", _NC_VARIABLE, len(variables))
+    offset = header_size
+    for (var_header, nc_type), var_data in zip(var_headers, data):
+        header += var_header + struct.pack(">iii", nc_type, len(var_data), offset)
+        offset += len(var_data)
+    return header + b"".join(data)
+
+
+def synthetic_response(url: str) -> bytes:
+    """Synthetic response body for an OPeNDAP subset URL, such as those from merra_urls.url_generator"""
+    parsed = merra_urls.parse_url(url)
+    time_slab = parsed["time"] or (0, 23)
+    lat_slab = parsed["lat"] or (0, 360)
+    lon_slab = parsed["lon"] or (0, 575)
+    start = "00:30:00" if parsed["collection"].startswith("tavg") else "00:00:00"
+    units = f"minutes since {parsed['date']:%Y-%m-%d} {start}"
+    return synthetic_netcdf(parsed["fields"], time_slab, lat_slab, lon_slab, units)
+
+
+class FakeOpendapServer(object):
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_per_request: float = 0.0,
+        bandwidth: Optional[float] = None,
+        error_rate: float = 0.0,
+        error_statuses: Sequence[int] = (503,),
+        retry_after: Optional[float] = None,
+        max_concurrent: Optional[int] = None,
+        require_auth: bool = False,
+        username: str = "user",
+        password: str = "pass",
+        session_lifetime: Optional[float] = None,
+        seed: Optional[int] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        http2: bool = False,
+        corrupt_rate: float = 0.0,
+        corruptions: Sequence[str] = ("html", "dimensions"),
+        drop_rate: float = 0.0,
+    ) -> None:
+        """Local stand-in for the GES DISC OPeNDAP server, for testing and benchmarking downloaders without network access or credentials. Serves synthetic netCDF responses shaped by the URL's fields and index slabs.
+
+        Parameters
+        ----------
+        latency : float, optional
+            Seconds to wait before sending response headers, by default 0.0
+        latency_per_request : float, optional
+            Extra seconds of latency per request already in flight, to emulate a server slowing under load. By default 0.0
+        bandwidth : Optional[float], optional
+            Max bytes per second sent per response, by default None for unlimited
+        error_rate : float, optional
+            Probability of answering a data request with an error, by default 0.0
+        error_statuses : Sequence[int], optional
+            Error statuses to choose from when injecting errors, by default (503,)
+        retry_after : Optional[float], optional
+            If given, send a Retry-After header with injected 429 and 503 errors, by default None
+        max_concurrent : Optional[int], optional
+            If given, answer 503 to data requests beyond this many in flight, by default None
+        require_auth : bool, optional
+            Emulate the Earthdata Login flow: data requests without a session cookie are redirected to a login endpoint that checks HTTP Basic credentials, sets a session cookie, and redirects back. By default False
+        username, password : str, optional
+            Credentials accepted by the login endpoint
+        session_lifetime : Optional[float], optional
+            Seconds until a session cookie expires, by default None for never
+        seed : Optional[int], optional
+            Seed for error injection, by default None
+        host : str, optional
+            Interface to bind, by default "127.0.0.1"
+        port : int, optional
+            Port to bind, by default 0 for any free port
+        http2 : bool, optional
+            Speak cleartext HTTP/2 with prior knowledge instead of HTTP/1.1, so clients must be configured for HTTP/2 only (e.g. httpx http1=False, http2=True). Requires the h2 package. By default False
+        corrupt_rate : float, optional
+            Probability of answering a data request with status 200 but an unusable body, by default 0.0
+        corruptions : Sequence[str], optional
+            Kinds of bad body to choose from: 'html' for an error page, 'dimensions' for a valid netCDF file one time step short. By default both
+        drop_rate : float, optional
+            Probability of closing the connection halfway through the body of a status 200 data response, counted in stats['dropped'] rather than stats[200]. HTTP/1.1 only. By default 0.0
+
+        Example
+        -------
+        with FakeOpendapServer(latency=0.05, error_rate=0.1) as server:
+            urls = [server.localize(url) for url in merra_urls.url_generator(...)]
+            asyncio.run(AsyncDownloader(Path('./data/')).download(urls))
+        print(server.stats)
+        """
+        self.latency = latency
+        self.latency_per_request = latency_per_request
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.retry_after = retry_after
+        self.max_concurrent = max_concurrent
+        self.require_auth = require_auth
+        self.session_lifetime = session_lifetime
+        self._expected_auth = (
+            "Basic " + b64encode(f"{username}:{password}".encode()).decode()
+        )
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, float] = {}  # token -> expiry time
+        self._body_cache: Dict[str, bytes] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.paths_in_flight: List[str] = []  # data requests being answered
+        self.stats: Counter = Counter()
+
+        self.http2 = http2
+        self.corrupt_rate = corrupt_rate
+        self.corruptions = list(corruptions)
+        self.drop_rate = drop_rate
+        if http2:
+            if h2 is None:
+                raise ImportError("http2=True requires the h2 package")
+            self._httpd = _Http2FrontEnd(self, host, port)
+        else:
+            self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+            self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/opendap/MERRA2/"
+
+    def localize(self, url: str) -> str:
+        """Point a real GES DISC URL at this server"""
+        return url.replace(merra_urls.BASE_URL, self.base_url)
+
+    def localize_all(self, urls: Iterable[str]) -> Iterable[str]:
+        return (self.localize(url) for url in urls)
+
+    def start(self) -> "FakeOpendapServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "FakeOpendapServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _body(self, path_and_query: str) -> bytes:
+        with self._lock:
+            body = self._body_cache.get(path_and_query)
+        if body is None:
+            body = synthetic_response(path_and_query)
+            with self._lock:
+                self._body_cache[path_and_query] = body
+        return body
+
+    def _valid_session(self, cookie_header: Optional[str]) -> bool:
+        if not self.require_auth:
+            return True
+        if not cookie_header:
+            return False
+        cookie = SimpleCookie(cookie_header)
+        if SESSION_COOKIE not in cookie:
+            return False
+        with self._lock:
+            expiry = self._sessions.get(cookie[SESSION_COOKIE].value)
+        return expiry is not None and expiry > time.monotonic()
+
+    def _new_session(self) -> str:
+        token = secrets.token_hex(16)
+        lifetime = (
+            self.session_lifetime if self.session_lifetime is not None else float("inf")
+        )
+        with self._lock:
+            self._sessions[token] = time.monotonic() + lifetime
+        return token
+
+    def _should_drop(self) -> bool:
+        with self._lock:
+            drop = self.drop_rate > 0 and self._rng.random() < self.drop_rate
+            if drop:
+                self.stats["dropped"] += 1
+        return drop
+
+    def _paced(self, body: bytes) -> Iterator[bytes]:
+        """Split body into chunks, sleeping after each to hold the configured bandwidth"""
+        chunk_size = 1 << 16
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i : i + chunk_size]
+            yield chunk
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+
+    @contextlib.contextmanager
+    def _respond(
+        self, path_and_query: str, headers: Dict[str, str]
+    ) -> Iterator[Tuple[int, Dict[str, str], bytes]]:
+        """Transport-independent request handling, shared by the HTTP/1.1 and HTTP/2 front ends. Yields (status, headers, body) for a GET with lowercase request headers. Data requests wait out the configured latency before yielding and count as in flight until the with block exits, so callers send the body inside it."""
+        path = urlsplit(path_and_query).path
+        query = parse_qs(urlsplit(path_and_query).query)
+        response: Tuple[int, Dict[str, str], bytes]
+        if path == "/urs/oauth/authorize":
+            if headers.get("authorization") != self._expected_auth:
+                response = 401, {"WWW-Authenticate": 'Basic realm="fake-urs"'}, b""
+            else:
+                state = query.get("state", ["/"])[0]
+                location = f"/opendap/redirect?code={secrets.token_hex(8)}&state={quote(state, safe='')}"
+                response = 302, {"Location": location}, b""
+        elif path == "/opendap/redirect":
+            state = query.get("state", ["/"])[0]
+            cookie = f"{SESSION_COOKIE}={self._new_session()}; Path=/; HttpOnly"
+            if self.session_lifetime is not None:
+                cookie += f"; Max-Age={int(self.session_lifetime)}"
+            response = 302, {"Location": state, "Set-Cookie": cookie}, b""
+        elif not path.startswith("/opendap/MERRA2/"):
+            response = 404, {}, b""
+        elif not self._valid_session(headers.get("cookie")):
+            location = f"/urs/oauth/authorize?state={quote(path_and_query, safe='')}"
+            response = 302, {"Location": location}, b""
+        else:
+            with self._data_response(path_and_query) as response:
+                yield response
+                self._count(response)
+            return
+        yield response
+        self._count(response)
+
+    def _count(self, response: Tuple[int, Dict[str, str], bytes]) -> None:
+        status, _, body = response
+        with self._lock:
+            self.stats[status] += 1
+            if status == 200:
+                self.stats["bytes_sent"] += len(body)
+
+    @contextlib.contextmanager
+    def _data_response(
+        self, path_and_query: str
+    ) -> Iterator[Tuple[int, Dict[str, str], bytes]]:
+        requested = path_and_query
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            in_flight = self.in_flight
+            self.paths_in_flight.append(requested)
+            inject_error = self._rng.random() < self.error_rate
+            error_status = self._rng.choice(self.error_statuses)
+            corruption = (
+                self._rng.choice(self.corruptions)
+                if self.corrupt_rate and self._rng.random() < self.corrupt_rate
+                else None
+            )
+        try:
+            time.sleep(self.latency + self.latency_per_request * (in_flight - 1))
+            if self.max_concurrent is not None and in_flight > self.max_concurrent:
+                inject_error, error_status = True, 503
+            if inject_error:
+                headers = {}
+                if self.retry_after is not None and error_status in (429, 503):
+                    headers["Retry-After"] = str(self.retry_after)
+                yield error_status, headers, b"<html>Service Unavailable</html>"
+                return
+            if corruption == "html":
+                body = b"<!DOCTYPE html><html><body>Internal error</body></html>"
+                yield 200, {"Content-Type": "text/html"}, body
+                return
+            if corruption == "dimensions":
+                path_and_query = path_and_query.replace("[0:23]", "[0:22]")
+            try:
+                body = self._body(path_and_query)
+            except ValueError:
+                yield 404, {}, b""
+                return
+            yield 200, {"Content-Type": "application/x-netcdf"}, body
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.paths_in_flight.remove(requested)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+            def log_message(self, format, *args):  # silence per-request logging
+                pass
+
+            def setup(self) -> None:
+                super().setup()
+                with server._lock:
+                    server.stats["connections"] += 1
+
+            def do_GET(self) -> None:
+                headers = {key.lower(): value for key, value in self.headers.items()}
+                try:
+                    with server._respond(self.path, headers) as (status, extra, body):
+                        drop = status == 200 and server._should_drop()
+                        self.send_response(status)
+                        for key, value in extra.items():
+                            self.send_header(key, value)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        if drop:
+                            self.wfile.write(body[: len(body) // 2])
+                            # skips counting the response as sent
+                            raise ConnectionAbortedError
+                        for chunk in server._paced(body):
+                            self.wfile.write(chunk)
+                except ConnectionAbortedError:
+                    self.close_connection = True
+
+        return Handler
+
+
+class _Http2Connection(object):
+    def __init__(self, sock: socket.socket) -> None:
+        """One HTTP/2 connection. Frames are read on one thread; each stream is answered from its own thread. All access to the h2 state machine and socket writes happen under self.cond, which is notified when the peer opens flow-control windows."""
+        self.sock = sock
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def flush(self) -> None:
+        """Send pending frames. Call with self.cond held."""
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+
+class _Http2FrontEnd(object):
+    def __init__(self, server: "FakeOpendapServer", host: str, port: int) -> None:
+        """Minimal cleartext HTTP/2 front end (prior knowledge, no HTTP/1.1 upgrade) answering requests with FakeOpendapServer._respond"""
+        self.server = server
+        self._sock = socket.create_server((host, port))
+        self._sock.settimeout(0.1)
+        self.server_address = self._sock.getsockname()
+        self._stopping = threading.Event()
+
+    def serve_forever(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            sock.settimeout(None)
+            threading.Thread(
+                target=self._serve_connection, args=(sock,), daemon=True
+            ).start()
+
+    def shutdown(self) -> None:
+        self._stopping.set()
+
+    def server_close(self) -> None:
+        self._sock.close()
+
+    def _serve_connection(self, sock: socket.socket) -> None:
+        with self.server._lock:
+            self.server.stats["connections"] += 1
+        c = _Http2Connection(sock)
+        try:
+            with c.cond:
+                c.conn.initiate_connection()
+                c.flush()
+            while not c.closed:
+                data = sock.recv(1 << 16)
+                if not data:
+                    break
+                with c.cond:
+                    for event in c.conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(
+                                target=self._serve_stream,
+                                args=(c, event.stream_id, event.headers),
+                                daemon=True,
+                            ).start()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            c.closed = True
+                    c.flush()
+                    c.cond.notify_all()
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            with c.cond:
+                c.closed = True
+                c.cond.notify_all()
+            sock.close()
+
+    def _serve_stream(
+        self, c: _Http2Connection, stream_id: int, raw_headers: List[Tuple[str, str]]
+    ) -> None:
+        headers: Dict[str, str] = {}
+        for key, value in raw_headers:
+            # HTTP/2 clients may split cookies into several headers
+            sep = "; " if key == "cookie" else ", "
+            headers[key] = f"{headers[key]}{sep}{value}" if key in headers else value
+        try:
+            with self.server._respond(headers[":path"], headers) as (
+                status,
+                extra,
+                body,
+            ):
+                response_headers = [(":status", str(status))]
+                response_headers += [(k.lower(), v) for k, v in extra.items()]
+                response_headers.append(("content-length", str(len(body))))
+                with c.cond:
+                    c.conn.send_headers(
+                        stream_id, response_headers, end_stream=not body
+                    )
+                    c.flush()
+                for chunk in self.server._paced(body):
+                    while chunk:
+                        with c.cond:
+                            # wait for the client to open its flow-control window
+                            while (
+                                not c.closed
+                                and c.conn.local_flow_control_window(stream_id) <= 0
+                            ):
+                                c.cond.wait()
+                            if c.closed:
+                                return
+                            n = min(
+                                len(chunk),
+                                c.conn.local_flow_control_window(stream_id),
+                                c.conn.max_outbound_frame_size,
+                            )
+                            c.conn.send_data(stream_id, chunk[:n])
+                            c.flush()
+                        chunk = chunk[n:]
+                if body:
+                    with c.cond:
+                        c.conn.end_stream(stream_id)
+                        c.flush()
+        except (OSError, h2.exceptions.ProtocolError):
+            pass  # stream reset or connection closed by the client
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run a local fake MERRA-2 OPeNDAP server"
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--require-auth", action="store_true")
+    args = parser.parse_args()
+    fake = FakeOpendapServer(
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        require_auth=args.require_auth,
+        port=args.port,
+    )
+    print(f"Serving at {fake.base_url}")
+    fake._httpd.serve_forever()
@@ -0,0 +1,54 @@
+import io
+import urllib.error
+import urllib.request
+from http.cookiejar import CookieJar
+
+import pytest
+import xarray as xr
+
+from fake_opendap_server import FakeOpendapServer, synthetic_response
+
+URL = "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2I1NXLFO.5.12.4/2020/03/MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4?PS[0:23][176:184][285:291],SPEEDLML[0:23][176:184][285:291],time,lat[176:184],lon[285:291]"
+
+
+def test_synthetic_response():
+    ds = xr.open_dataset(io.BytesIO(synthetic_response(URL)))
+    assert dict(ds.sizes) == {"time": 24, "lat": 9, "lon": 7}
+    assert list(ds.data_vars) == ["PS", "SPEEDLML"]
+    assert ds.lat.values[0] == -2.0
+    assert str(ds.time.values[0]).startswith("2020-03-31T00:00")
+
+
+def test_auth_flow():
+    with FakeOpendapServer(require_auth=True) as server:
+        url = server.localize(URL)
+        anonymous = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar())
+        )
+        with pytest.raises(urllib.error.HTTPError) as err:
+            anonymous.open(url)
+        assert err.value.code == 401
+
+        passwords = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(
+            None, server.base_url.split("/opendap/")[0], "user", "pass"
+        )
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPBasicAuthHandler(passwords),
+            urllib.request.HTTPCookieProcessor(CookieJar()),
+        )
+        with opener.open(url) as resp:
+            assert resp.read(4) == b"CDF\x01"
+        with opener.open(url) as resp:  # session cookie, no redirect
+            assert resp.status == 200
+        assert server.stats[302] == 4  # 1 anonymous, 3 for one login
+
+
+def test_error_injection():
+    with FakeOpendapServer(
+        error_rate=1.0, error_statuses=[429], retry_after=7
+    ) as server:
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(server.localize(URL))
+        assert err.value.code == 429
+        assert err.value.headers["Retry-After"] == "7"
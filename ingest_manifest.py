@@ -0,0 +1,67 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Union
+
+
+class IngestManifest(object):
+    def __init__(self, path: Union[str, Path]) -> None:
+        """Persistent record of which daily files have been converted into a parquet output directory, used by merra_etl.append_nc4_to_parquet to process only new dates.
+
+        Each ingest run is one batch, stored as one JSON line: the dates and input files it covered and, for each parquet file it wrote, the range of flattened (lat, lon) grid point indices in that file. Batch 0 also stores the grid and the collections (sets of variables) every date must have. Like DownloadManifest, it's append-only and a truncated final line (from an interrupted run) is ignored.
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            Path to manifest file. Will be created on first write if needed. Start the name with an underscore when it lives in the parquet directory, so parquet readers skip it.
+
+        Example
+        -------
+        manifest = IngestManifest(Path('./data/parquet/_ingest_manifest.jsonl'))
+        manifest.dates  # -> {'2020-01-01', '2020-01-02', ...}
+        """
+        self.path = Path(path)
+        self.batches: List[Dict] = []
+        if self.path.exists():
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    self.batches.append(json.loads(line))
+                except json.JSONDecodeError:  # partially written last line
+                    continue
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    @property
+    def dates(self) -> Set[str]:
+        return {date for batch in self.batches for date in batch["dates"]}
+
+    @property
+    def next_batch(self) -> int:
+        return max((batch["batch"] for batch in self.batches), default=-1) + 1
+
+    def record(self, batch: Dict) -> None:
+        """Append a completed batch to the manifest. Call only after all of its parquet files are written.
+
+        Parameters
+        ----------
+        batch : Dict
+            JSON serializable batch entry with at least 'batch', 'dates', 'files' and 'parts' keys
+        """
+        self.batches.append(batch)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            print(json.dumps(batch), file=f)
+
+    def replace(self, batches: Iterable[Dict]) -> None:
+        """Rewrite the manifest with the given batches. Written to a temporary file first, then atomically renamed over the old manifest."""
+        self.batches = list(batches)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for batch in self.batches:
+                print(json.dumps(batch), file=f)
+        os.replace(tmp_path, self.path)
@@ -1,7 +1,31 @@
+import io
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import dask.array as da
 import xarray as xr
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
-from typing import Optional, Union, Sequence
+from typing import Any, Dict, Iterable, List, Optional, Union, Sequence, Tuple
+
+from bit_information import BitInformation
+from ingest_manifest import IngestManifest
+from parquet_layout import ParquetLayout
+from parquet_reader import SpatialIndex
+
+# Peak memory of a tile in the out-of-core path, relative to its size as stored: the
+# per-file slabs, the combined dataset, transform temporaries and the Arrow table being written
+TILE_WORKING_SET = 4
+
+# ingest bookkeeping in parquet output directories. Leading underscores keep parquet readers from picking them up
+INGEST_MANIFEST = "_ingest_manifest.jsonl"
+_COMPACT_DIR = "_compact"
+# parquet files written by append_nc4_to_parquet: part.<batch>.<n>.parquet
+_BATCH_PART = re.compile(r"part\.(\d+)\.\d+\.parquet")
 
 
 def binary_round(
@@ -57,6 +81,16 @@ def binary_round(
     return (ds * multiplier).round() * divisor
 
 
+# decimal digits of precision kept by reduce_precision, for the rounding and fp16 methods
+ROUND_PRECISION = {
+    1: ["GHLAND", "RISFC", "TS", "T10M", "WDIR50M"],
+    2: ["PRECTOTCORR"],
+    3: ["RHOA", "WS50M"],
+}
+FP16_FIELDS = ["GHLAND", "RHOA", "PRECTOTCORR", "RISFC", "TS", "T10M"]
+FP16_PRECISION = {1: ["WDIR50M"], 3: ["WS50M"]}
+
+
 def transforms(ds: xr.Dataset) -> xr.Dataset:
     """Column transforms for MERRA-2 data. Note that modifications are performed IN PLACE, but I can't drop variables in place so have to return a new xr.Dataset without those variables.
     * Change temperature units from K to degrees C
@@ -95,25 +129,334 @@ def reduce_precision(ds: xr.Dataset, fp16=False) -> None:
     fp16 : bool, optional
         If True, use fp16 conversion method. If False, use fixed precision rounding method. By default False
     """
-    ds[["lat", "lon"]].astype(np.float32)
     ds["PS"] = binary_round(ds["PS"], decimal_digits=-1).astype(np.int32)
     mask = ds["PRECTOTCORR"] <= -14  # assumes log10 applied first!
     ds["PRECTOTCORR"] = xr.where(
         mask, 0, ds["PRECTOTCORR"]
     )  # threshold tiny floats to 0
+    # variables of collections that weren't downloaded are skipped
     if fp16:
-        f16 = ["GHLAND", "RHOA", "PRECTOTCORR", "RISFC", "TS", "T10M"]
-        ds.update(ds[f16].astype(np.float16).astype(np.float32))
-        for dec, cols in {1: ["WDIR50M"], 3: ["WS50M"]}.items():
-            ds.update(binary_round(ds[cols], decimal_digits=dec))
+        fields = [name for name in FP16_FIELDS if name in ds]
+        ds.update(ds[fields].astype(np.float16).astype(np.float32))
+        prec = FP16_PRECISION
     else:
-        prec = {
-            1: ["GHLAND", "RISFC", "TS", "T10M", "WDIR50M"],
-            2: ["PRECTOTCORR"],
-            3: ["RHOA", "WS50M"],
-        }
-        for dec, cols in prec.items():
-            ds.update(binary_round(ds[cols], decimal_digits=dec))
+        prec = ROUND_PRECISION
+    for dec, cols in prec.items():
+        cols = [name for name in cols if name in ds]
+        ds.update(binary_round(ds[cols], decimal_digits=dec))
+
+
+def _bits(decimal_digits: int) -> int:
+    """binary_round's conversion from decimal digits to bits"""
+    return int(np.ceil(decimal_digits * np.log(10) / np.log(2)))
+
+
+def _round_inplace(x: np.ndarray, bits: int) -> None:
+    """binary_round, IN PLACE. Scaling by a power of 2 is exact, so the result is the same in float32 as in float64"""
+    np.multiply(x, 2.0 ** bits, out=x)
+    np.rint(x, out=x)
+    np.multiply(x, 2.0 ** -bits, out=x)
+
+
+def _mantissa_view(x: np.ndarray, keepbits: int) -> Tuple[np.ndarray, int]:
+    """Unsigned integer view of a float array's bit patterns, and the number of mantissa bits to drop"""
+    if x.dtype not in (np.float32, np.float64):
+        raise ValueError(f"Mantissa rounding needs float32 or float64, got {x.dtype}")
+    if keepbits < 0:
+        raise ValueError(f"keepbits must be non-negative, got {keepbits}")
+    return x.view(f"u{x.dtype.itemsize}"), max(np.finfo(x.dtype).nmant - keepbits, 0)
+
+
+def bitround(x: np.ndarray, keepbits: int) -> np.ndarray:
+    """Round floats to keepbits mantissa bits IN PLACE (round to nearest, ties to even), using integer operations on the bit patterns. Unlike binary_round, precision is relative: every value keeps keepbits significant bits after its leading bit, whatever its magnitude, and large values can't overflow. Dropped bits are zero, so they compress well.
+
+    Example: bitround(np.array([1.1234567], dtype=np.float32), 7) -> np.ndarray(1.125)
+
+    Parameters
+    ----------
+    x : np.ndarray
+        float32 or float64 array, modified in place
+    keepbits : int
+        number of explicit mantissa bits to keep, out of 23 for float32 or 52 for float64
+
+    Returns
+    -------
+    np.ndarray
+        x
+    """
+    bits, drop = _mantissa_view(x, keepbits)
+    if drop == 0:
+        return x
+    uint = bits.dtype.type
+    # add just under half of the dropped range, plus the last kept bit so ties go to even.
+    # Carries into the exponent are correct rounding up. Infinities are unchanged; NaN
+    # payloads can change, but quiet NaNs stay NaN
+    scratch = np.right_shift(bits, uint(drop))
+    np.bitwise_and(scratch, uint(1), out=scratch)
+    np.add(scratch, uint((1 << (drop - 1)) - 1), out=scratch)
+    np.add(bits, scratch, out=bits)
+    np.bitwise_and(bits, ~uint((1 << drop) - 1), out=bits)
+    return x
+
+
+def bitgroom(x: np.ndarray, keepbits: int) -> np.ndarray:
+    """Bit grooming IN PLACE: keep keepbits mantissa bits, alternately setting the dropped bits of consecutive values to zero ("shaving") and to one ("setting"), so rounding errors average out rather than all pulling towards zero. Cheaper than bitround, but the maximum error is a whole unit of the last kept bit rather than half. Zeros and non-finite values aren't set.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        C-contiguous float32 or float64 array, modified in place
+    keepbits : int
+        number of explicit mantissa bits to keep, out of 23 for float32 or 52 for float64
+
+    Returns
+    -------
+    np.ndarray
+        x
+    """
+    if not x.flags.c_contiguous:
+        raise ValueError("bitgroom needs a C-contiguous array")
+    bits, drop = _mantissa_view(x, keepbits)
+    if drop == 0:
+        return x
+    dropped = bits.dtype.type((1 << drop) - 1)
+    shave, set_ = bits.reshape(-1)[::2], bits.reshape(-1)[1::2]
+    np.bitwise_and(shave, ~dropped, out=shave)
+    values = x.reshape(-1)[1::2]
+    np.bitwise_or(set_, dropped, out=set_, where=np.isfinite(values) & (values != 0))
+    return x
+
+
+# mantissa bits kept by the 'bitround' and 'bitgroom' methods. Chosen so that values up
+# to each variable's typical magnitude keep ROUND_PRECISION's absolute precision, e.g.
+# TS below 2 ** 6 C to 2 ** -4 C takes 5 + 4 bits. Smaller values keep more.
+MANTISSA_BITS = {
+    "GHLAND": 12,  # |W m-2| < 2 ** 9
+    "RISFC": 10,  # |Ri| < 2 ** 6
+    "TS": 10,  # skin temperature can pass 2 ** 6 C
+    "T10M": 9,
+    "WDIR50M": 12,  # degrees < 2 ** 9
+    "PRECTOTCORR": 10,  # |log10| < 2 ** 4, to 2 decimal digits
+    "RHOA": 10,  # kg m-3 < 2, to 3 decimal digits
+    "WS50M": 15,  # m s-1 < 2 ** 6, to 3 decimal digits
+}
+MANTISSA_METHODS = ("bitround", "bitgroom")
+# a method name, or a precision profile ({variable: mantissa bits}, see precision_profile)
+# to apply with bitround. None for no precision reduction
+PrecisionReduction = Optional[Union[str, Dict[str, int]]]
+
+
+def _reduce_mantissa_copy(x: np.ndarray, keepbits: int, groom: bool) -> np.ndarray:
+    # copy first: dask blocks and the caller's arrays may be shared
+    x = np.array(x)
+    return bitgroom(x, keepbits) if groom else bitround(x, keepbits)
+
+
+def reduce_mantissa(
+    ds: xr.Dataset, groom: bool = False, keepbits: Optional[Dict[str, int]] = None
+) -> None:
+    """Alternative to reduce_precision that keeps a number of mantissa bits per variable (see bitround and bitgroom) rather than a fixed number of bits after the binary point. Variables are replaced IN PLACE. PS and PRECTOTCORR thresholding are handled as in reduce_precision.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dataset of MERRA-2, after transforms
+    groom : bool, optional
+        If True, use bitgroom. If False, use bitround. By default False
+    keepbits : Optional[Dict[str, int]], optional
+        mantissa bits to keep per variable, by default None for MANTISSA_BITS
+    """
+    ds["PS"] = binary_round(ds["PS"], decimal_digits=-1).astype(np.int32)
+    mask = ds["PRECTOTCORR"] <= -14  # assumes log10 applied first!
+    ds["PRECTOTCORR"] = xr.where(mask, 0, ds["PRECTOTCORR"])
+    for name, bits in (MANTISSA_BITS if keepbits is None else keepbits).items():
+        if name not in ds:
+            continue
+        ds[name] = xr.apply_ufunc(
+            _reduce_mantissa_copy,
+            ds[name],
+            kwargs={"keepbits": bits, "groom": groom},
+            dask="parallelized",
+            output_dtypes=[ds[name].dtype],
+            keep_attrs=True,
+        )
+
+
+def precision_profile(
+    files_in: Iterable[Path],
+    information_level: float = 0.99,
+    sample_days: int = 10,
+    confidence: float = 0.99,
+) -> Dict[str, int]:
+    """Choose how many mantissa bits of each variable to keep from the data itself, instead of the hand-tuned ROUND_PRECISION and MANTISSA_BITS tables. Streams over up to sample_days dates spread evenly through the archive, one date at a time, applies transforms, and measures the bit information between neighbouring hours of each variable (see bit_information.BitInformation). Each variable keeps the mantissa bits holding information_level of its information; the rest are noise, so dropping them costs nothing real and saves space.
+
+    Pass the result as precision_reduction to merra_nc4_to_parquet or the other converters. It's a plain dict, so it can be saved as JSON and reused for later runs over the same region and collections.
+
+    Parameters
+    ----------
+    files_in : Iterable[Path]
+        daily MERRA-2 files, such as Path(<directory>).glob(<PATTERN>). Only dates with files for every collection are sampled.
+    information_level : float, optional
+        fraction of each variable's information to keep, by default 0.99
+    sample_days : int, optional
+        max number of dates to read, by default 10
+    confidence : float, optional
+        confidence level for telling information apart from noise, by default 0.99
+
+    Returns
+    -------
+    Dict[str, int]
+        mantissa bits to keep, for each float variable after transforms except PS, which reduce_mantissa rounds to an integer
+
+    Example
+    -------
+    profile = precision_profile(Path('./data/').glob('*.nc4'))  # -> {'TS': 9, 'WS50M': 11, ...}
+    merra_nc4_to_parquet(files, dir_out, precision_reduction=profile)
+    """
+    dates = _daily_files(files_in)
+    if not dates:
+        raise ValueError("No daily files given")
+    n_collections = max(len(collections) for collections in dates.values())
+    complete = sorted(
+        date for date, collections in dates.items() if len(collections) == n_collections
+    )
+    n_samples = min(sample_days, len(complete))
+    samples = np.unique(
+        np.linspace(0, len(complete) - 1, n_samples).round().astype(int)
+    )
+
+    information: Dict[str, BitInformation] = {}
+    for i in samples:
+        with open_merra(list(dates[complete[i]].values())) as ds:
+            ds = transforms(ds.load())
+        for name, var in ds.data_vars.items():
+            if name == "PS" or var.dtype.kind != "f":
+                continue
+            if name not in information:
+                information[name] = BitInformation(var.dtype)
+            information[name].update(var.values, axis=var.dims.index("time"))
+    return {
+        name: info.keepbits(information_level, confidence)
+        for name, info in information.items()
+    }
+
+
+def fused_transforms(
+    ds: xr.Dataset,
+    precision_reduction: PrecisionReduction = "round",
+    block_size: int = 2 ** 16,
+) -> xr.Dataset:
+    """Single-pass equivalent of transforms followed by reduce_precision. Works through the data in blocks of block_size values: for each block, every output variable is computed straight into its preallocated output array, with block-sized scratch space, before moving on. The expression chain instead allocates several full-size temporaries per operation. ds is not modified.
+
+    Output values are the same as from the expression chain. Rounded variables keep their input dtype (float32 for MERRA-2), where binary_round promotes them to float64.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        MERRA-2 dataset with all variables on the same dims. Loaded into memory if it isn't already.
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', or 'fp16', as for reduce_precision, or 'bitround', 'bitgroom' or a precision profile, as for reduce_mantissa. By default 'round'
+    block_size : int, optional
+        values per block. Blocks of every variable should fit in cache together. By default 2 ** 16
+
+    Returns
+    -------
+    xr.Dataset
+        transformed dataset, with variables in the same order as from transforms
+    """
+    dims = ds["TS"].dims
+    shape = ds["TS"].shape
+    src = {
+        name: np.ascontiguousarray(var.transpose(*dims).values).reshape(-1)
+        for name, var in ds.data_vars.items()
+    }
+    names = [name for name in ds.data_vars if name not in ("U50M", "V50M", "Z0M")]
+    names += ["WS50M", "WDIR50M"]
+
+    mantissa: Dict[str, int] = {}
+    if precision_reduction == "fp16":
+        fp16, prec = FP16_FIELDS, FP16_PRECISION
+    elif precision_reduction in MANTISSA_METHODS:
+        fp16, prec = [], {}
+        mantissa = {k: v for k, v in MANTISSA_BITS.items() if k in names}
+    elif isinstance(precision_reduction, dict):
+        fp16, prec = [], {}
+        mantissa = {k: v for k, v in precision_reduction.items() if k in names}
+    elif precision_reduction is not None:
+        fp16, prec = [], ROUND_PRECISION
+    else:
+        fp16, prec = [], {}
+    # as in reduce_precision and reduce_mantissa, missing variables are skipped
+    fp16 = [name for name in fp16 if name in names]
+    rounded = {
+        name: _bits(dec) for dec, cols in prec.items() for name in cols if name in names
+    }
+    reduce = bitgroom if precision_reduction == "bitgroom" else bitround
+    computed = ["TS", "T10M", "PRECTOTCORR"]
+    # otherwise untransformed variables that precision reduction changes
+    copied = [
+        name
+        for name in names
+        if name in src
+        and name not in computed
+        and (name in rounded or name in fp16 or name in mantissa)
+    ]
+    out = {name: src[name] for name in names if name in src}  # passed through
+    for name in computed + copied:
+        out[name] = np.empty_like(src[name])
+    out["WS50M"] = np.empty_like(src["U50M"])
+    out["WDIR50M"] = np.empty_like(src["U50M"])
+    if precision_reduction is not None:
+        out["PS"] = np.empty(src["PS"].shape, dtype=np.int32)
+
+    wind_scratch = np.empty(block_size, dtype=src["U50M"].dtype)
+    ps_scratch = np.empty(block_size, dtype=src["PS"].dtype)
+    fp16_scratch = np.empty(block_size, dtype=np.float16)
+    for start in range(0, len(src["TS"]), block_size):
+        block = slice(start, start + block_size)
+        for name in ("TS", "T10M"):  # K -> C
+            np.subtract(src[name][block], 273.15, out=out[name][block])
+        u, v = src["U50M"][block], src["V50M"][block]
+        ws, wdir = out["WS50M"][block], out["WDIR50M"][block]
+        tmp = wind_scratch[: len(ws)]
+        np.multiply(v, v, out=ws)
+        np.multiply(u, u, out=tmp)
+        np.add(ws, tmp, out=ws)
+        np.sqrt(ws, out=ws)
+        # angle from North, positive going clockwise
+        np.arctan2(u, v, out=wdir)
+        np.add(wdir, 2 * np.pi, out=wdir)
+        np.mod(wdir, 2 * np.pi, out=wdir)
+        np.multiply(wdir, 180 / np.pi, out=wdir)
+        precip = out["PRECTOTCORR"][block]
+        np.add(src["PRECTOTCORR"][block], 2 ** -48, out=precip)
+        np.log10(precip, out=precip)
+        if precision_reduction is None:
+            continue
+
+        ps = ps_scratch[: len(ws)]
+        np.copyto(ps, src["PS"][block])
+        _round_inplace(ps, _bits(-1))
+        np.copyto(out["PS"][block], ps, casting="unsafe")
+        np.copyto(precip, 0, where=precip <= -14)  # threshold tiny floats to 0
+        for name in copied:
+            np.copyto(out[name][block], src[name][block])
+        for name in fp16:
+            half = fp16_scratch[: len(ws)]
+            np.copyto(half, out[name][block], casting="same_kind")
+            np.copyto(out[name][block], half)
+        for name, bits in rounded.items():
+            _round_inplace(out[name][block], bits)
+        for name, bits in mantissa.items():
+            reduce(out[name][block], bits)
+
+    return xr.Dataset(
+        {
+            name: (dims, out[name].reshape(shape), ds[name].attrs if name in ds else {})
+            for name in names
+        },
+        coords=ds.coords,
+    )
 
 
 def make_divisions(
@@ -194,9 +537,28 @@ def rechunk(ds: xr.Dataset, megabytes_per_chunk: Union[int, float] = 100) -> xr.
         raise ValueError(
             f"Each grid point is larger than the given chunk size.\nPoint size: {mb_per_point:.2f}MB\n megabytes_per_chunk: {megabytes_per_chunk:.2f}\nThis algorithm hardcodes a full time slice."
         )
+    lat_step, lon_step = _spatial_steps(
+        len(ds.lat),
+        len(ds.lon),
+        mb_per_point,
+        len(ds.variables) - len(ds.coords),  # ds.variables includes coords
+        megabytes_per_chunk,
+    )
+    return ds.chunk(chunks={"lat": lat_step, "lon": lon_step, "time": None})
+
+
+def _spatial_steps(
+    n_lat: int,
+    n_lon: int,
+    mb_per_point: float,
+    n_variables: int,
+    megabytes_per_chunk: Union[int, float],
+) -> Tuple[int, int]:
+    """Lat and lon chunk sizes for rechunk's spatial tiling, given the size of every variable's full time series at one grid point"""
+    total_points = n_lat * n_lon
     points_per_chunk = (
-        megabytes_per_chunk / mb_per_point * (len(ds.variables) - len(ds.coords))
-    )  # chunks are per-variable. ds.variables includes coords, so they must be removed
+        megabytes_per_chunk / mb_per_point * n_variables
+    )  # chunks are per-variable
     if points_per_chunk < total_points:
         # this binary tiling algorithm is conservative on number of chunks, so I made step size aggressive to compensate.
         log_n_chunks = np.ceil(
@@ -204,20 +566,71 @@ def rechunk(ds: xr.Dataset, megabytes_per_chunk: Union[int, float] = 100) -> xr.
         )  # nearest power of 2, rounded up
         log_lat_chunks = log_n_chunks // 2
         log_lon_chunks = log_n_chunks - log_lat_chunks
-        lat_step = np.ceil(len(ds.lat) / (2 ** log_lat_chunks))
-        lon_step = np.ceil(len(ds.lon) / (2 ** log_lon_chunks))
-        return ds.chunk(chunks={"lat": lat_step, "lon": lon_step, "time": None})
+        lat_step = np.ceil(n_lat / (2 ** log_lat_chunks))
+        lon_step = np.ceil(n_lon / (2 ** log_lon_chunks))
+        return int(lat_step), int(lon_step)
     else:
-        return ds.chunk(chunks={"lat": None, "lon": None, "time": None})
+        return n_lat, n_lon
+
+
+def open_merra(files_in: Sequence[Path]) -> xr.Dataset:
+    """Open daily MERRA-2 netCDF files, from one or more collections, as a single lazy dataset"""
+    return xr.open_mfdataset(
+        files_in,
+        combine="by_coords",
+        data_vars="minimal",
+        coords="minimal",
+        compat="no_conflicts",
+    )
+
+
+def open_merra_buffers(buffers: Iterable[bytes]) -> xr.Dataset:
+    """In-memory equivalent of open_merra. Each buffer is the body of one daily netCDF response, such as those collected by download_sinks.MemorySink."""
+    datasets = [xr.open_dataset(io.BytesIO(buffer)) for buffer in buffers]
+    return xr.combine_by_coords(
+        datasets, data_vars="minimal", coords="minimal", compat="no_conflicts"
+    )
+
+
+def process_daily(
+    files_in: Sequence[Path],
+    file_out: Path,
+    precision_reduction: PrecisionReduction = "round",
+) -> Path:
+    """Apply transforms and reduce_precision (as fused_transforms) to one day of MERRA-2 data and write it to netCDF. Lets the ETL run one day at a time while later days are still downloading; combine the outputs with merra_nc4_to_parquet(..., preprocessed=True).
+
+    Parameters
+    ----------
+    files_in : Sequence[Path]
+        daily files for a single date, one per collection
+    file_out : Path
+        output netCDF file. Written to a temporary file first and renamed, so an existing file_out is always complete.
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'
+
+    Returns
+    -------
+    Path
+        file_out
+    """
+    with open_merra(files_in) as ds:
+        ds = fused_transforms(ds.load(), precision_reduction)
+    tmp_path = file_out.with_name(file_out.name + ".part")
+    ds.to_netcdf(tmp_path)
+    tmp_path.replace(file_out)
+    return file_out
 
 
 def merra_nc4_to_parquet(
     files_in: Sequence[Path],
     dir_out: Path,
-    precision_reduction: Optional[str] = "round",
+    precision_reduction: PrecisionReduction = "round",
     max_megabytes_per_file: int = 100,
+    preprocessed: bool = False,
+    memory_budget_mb: float = 1000,
+    layout: Optional[ParquetLayout] = None,
 ) -> None:
-    """API to convert a folder of daily netCDF MERRA-2 data to columnar parquet files. This method only works for data that fits in memory.
+    """API to convert a folder of daily netCDF MERRA-2 data to columnar parquet files. Works through the grid one spatial tile at a time, sized to memory_budget_mb: reads only that tile's slab from every daily file, and converts it straight to Arrow to write it (see tiled_nc4_to_parquet and dataset_to_arrow). Bigger tiles mean fewer, larger reads from each file. To add new dates to an existing output without reprocessing the archive, use append_nc4_to_parquet. To read back one grid point or a bounding box without scanning every file, use parquet_reader.ParquetReader, which uses the spatial index saved with the output.
 
     Parameters
     ----------
@@ -225,31 +638,708 @@ def merra_nc4_to_parquet(
         sequence of file paths, such as Path(<directory>).glob(<PATTERN>)
     dir_out : Path
         directory where parquet files will be written
-    precision_reduction : Optional[str], optional
-        One of None, 'round', or 'fp16', by default 'round'
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'. 'round' and 'fp16' keep fixed absolute precision (see reduce_precision); 'bitround' and 'bitgroom' keep MANTISSA_BITS significant bits with integer bit operations, which is faster (see reduce_mantissa)
     max_megabytes_per_file : int, optional
         max uncompressed size of each output parquet file, in megabytes. Actual files will be smaller due to compression. By default 100
+    preprocessed : bool, optional
+        If True, files_in were written by process_daily, so transforms and precision reduction are skipped and precision_reduction is ignored. By default False
+    memory_budget_mb : float, optional
+        approximate peak memory in megabytes, as in tiled_nc4_to_parquet. By default 1000
+    layout : Optional[ParquetLayout], optional
+        codecs, encodings and row group sizes of the parquet files, by default None for ParquetLayout(). Row groups hold whole grid points.
 
     Returns
     -------
     None
     """
-    ds = xr.open_mfdataset(
+    tiled_nc4_to_parquet(
         files_in,
-        combine="by_coords",
-        concat_dim="time",
-        data_vars="minimal",
-        coords="minimal",
-        compat="no_conflicts",
+        dir_out,
+        memory_budget_mb,
+        precision_reduction=precision_reduction,
+        max_megabytes_per_file=max_megabytes_per_file,
+        preprocessed=preprocessed,
+        layout=layout,
     )
 
-    ds = rechunk(ds)
-    ds = transforms(ds)
-    if precision_reduction is not None:
-        fp16 = precision_reduction == "fp16"
-        reduce_precision(ds, fp16=fp16)
-    divisions = make_divisions(ds, mb_per_partition=max_megabytes_per_file)
-    ddf = ds.to_dask_dataframe()
-    ddf.repartition(divisions=divisions).to_parquet(
-        dir_out, compression="snappy", write_index=False
+
+def spatial_tiles(
+    n_lat: int, n_lon: int, points_per_tile: int
+) -> List[Tuple[slice, slice]]:
+    """Split a lat/lon grid into tiles of at most points_per_tile grid points. Tiles are bands of whole latitude rows when a row fits, otherwise pieces of a single row, so concatenating the tiles in order visits grid points in (lat, lon) order and each tile is a contiguous hyperslab of every daily file.
+
+    Parameters
+    ----------
+    n_lat : int
+        number of latitudes in the grid
+    n_lon : int
+        number of longitudes in the grid
+    points_per_tile : int
+        max grid points per tile
+
+    Returns
+    -------
+    List[Tuple[slice, slice]]
+        (lat slice, lon slice) index ranges for each tile
+    """
+    points_per_tile = max(1, int(points_per_tile))
+    if points_per_tile >= n_lon:
+        rows = points_per_tile // n_lon
+        return [
+            (slice(i, min(i + rows, n_lat)), slice(0, n_lon))
+            for i in range(0, n_lat, rows)
+        ]
+    return [
+        (slice(i, i + 1), slice(j, min(j + points_per_tile, n_lon)))
+        for i in range(n_lat)
+        for j in range(0, n_lon, points_per_tile)
+    ]
+
+
+def _open_archive(files_in: Sequence[Path]) -> List[List[xr.Dataset]]:
+    """Open daily files lazily, grouped by collection (set of variables) and sorted by time. Only headers and coordinates are read. xarray's file cache bounds how many files are actually held open."""
+    collections: Dict[frozenset, List[xr.Dataset]] = {}
+    grid = None
+    for path in files_in:
+        ds = xr.open_dataset(path)
+        if grid is None:
+            grid = (ds.sizes["lat"], ds.sizes["lon"])
+        elif (ds.sizes["lat"], ds.sizes["lon"]) != grid:
+            raise ValueError(
+                f"All files must cover the same grid. {path} is {ds.sizes['lat']}x{ds.sizes['lon']}, expected {grid[0]}x{grid[1]}"
+            )
+        collections.setdefault(frozenset(ds.data_vars), []).append(ds)
+    if grid is None:
+        raise ValueError("No input files given")
+    return [
+        sorted(daily, key=lambda ds: ds.time.values[0])
+        for daily in collections.values()
+    ]
+
+
+def _bytes_per_point(archive: List[List[xr.Dataset]]) -> float:
+    """Stored size of one grid point's full time series, plus its lat, lon and time output columns"""
+    first = archive[0][0]
+    n_points = first.sizes["lat"] * first.sizes["lon"]
+    data_bytes = sum(
+        var.nbytes for daily in archive for ds in daily for var in ds.data_vars.values()
+    )
+    time_steps = max(sum(ds.sizes["time"] for ds in daily) for daily in archive)
+    return data_bytes / n_points + 3 * 8 * time_steps
+
+
+def _read_tile(
+    archive: List[List[xr.Dataset]],
+    lat: slice,
+    lon: slice,
+    precision_reduction: PrecisionReduction,
+    preprocessed: bool,
+) -> xr.Dataset:
+    """Read one spatial tile from every daily file and combine them, as open_merra does for whole files, then apply transforms and precision reduction unless preprocessed. Slabs are read and joined as plain numpy arrays; concatenating and merging per-file Datasets costs more than the reads."""
+    first = archive[0][0]
+    time = np.concatenate([ds.time.values for ds in archive[0]])
+    data_vars = {}
+    for daily in archive:
+        if not np.array_equal(np.concatenate([ds.time.values for ds in daily]), time):
+            raise ValueError("All collections must cover the same time steps")
+        for name, var in daily[0].data_vars.items():
+            slabs = [ds[name].variable.isel(lat=lat, lon=lon).values for ds in daily]
+            data_vars[name] = xr.Variable(
+                var.dims, np.concatenate(slabs, axis=var.dims.index("time")), var.attrs
+            )
+    ds = xr.Dataset(
+        data_vars,
+        coords={
+            "time": xr.Variable("time", time, first.time.attrs),
+            "lat": first.lat.variable[lat],
+            "lon": first.lon.variable[lon],
+        },
+    )
+    if not preprocessed:
+        ds = fused_transforms(ds, precision_reduction)
+    return ds
+
+
+def tiled_nc4_to_parquet(
+    files_in: Sequence[Path],
+    dir_out: Path,
+    memory_budget_mb: float,
+    precision_reduction: PrecisionReduction = "round",
+    max_megabytes_per_file: int = 100,
+    preprocessed: bool = False,
+    layout: Optional[ParquetLayout] = None,
+) -> List[Path]:
+    """Back end of merra_nc4_to_parquet, with tiles sized to a memory budget rather than to the output files. Works through the grid one spatial tile at a time: reads only that tile's slab from every daily file, applies transforms and precision reduction, and writes the tile's rows before moving on. Nothing is rechunked or shuffled, and peak memory is set by memory_budget_mb rather than by the size of the archive.
+
+    Output rows are ordered by grid point (lat, lon) and then time, and files are split on grid point boundaries, so each point's full time series is in a single file. A SpatialIndex of the files is saved alongside them for parquet_reader.ParquetReader.
+
+    Parameters
+    ----------
+    files_in : Sequence[Path]
+        sequence of file paths, such as Path(<directory>).glob(<PATTERN>). All files must cover the same lat/lon grid.
+    dir_out : Path
+        directory where parquet files will be written. part.*.parquet files from an earlier run that this run didn't overwrite are deleted, so a scan of the directory only sees this run's rows.
+    memory_budget_mb : float
+        approximate peak memory in megabytes. Tiles are sized so their working set (TILE_WORKING_SET times their stored size) fits.
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'
+    max_megabytes_per_file : int, optional
+        max uncompressed size of each output parquet file, in megabytes. By default 100
+    preprocessed : bool, optional
+        If True, files_in were written by process_daily, so transforms and precision reduction are skipped. By default False
+    layout : Optional[ParquetLayout], optional
+        codecs, encodings and row group sizes of the parquet files, by default None for ParquetLayout()
+
+    Returns
+    -------
+    List[Path]
+        parquet files written, in grid point order
+
+    Raises
+    ------
+    ValueError
+        When a single grid point's time series doesn't fit in memory_budget_mb
+    """
+    lats, lons, parts = _write_tiles(
+        files_in,
+        dir_out,
+        memory_budget_mb,
+        precision_reduction,
+        max_megabytes_per_file,
+        preprocessed,
+        layout,
+    )
+    _remove_stale_parts(dir_out, parts)
+    SpatialIndex.from_parts(lats, lons, parts).save(dir_out)
+    return [path for path, _, _ in parts]
+
+
+def _remove_stale_parts(dir_out: Path, parts: List[Tuple[Path, int, int]]) -> None:
+    """Delete part.*.parquet files in dir_out other than the parts just written, e.g. left by an earlier run over a bigger grid or with smaller files"""
+    written = {Path(path).name for path, _, _ in parts}
+    for path in Path(dir_out).glob("part.*.parquet"):
+        if path.name not in written:
+            path.unlink()
+
+
+def _write_tiles(
+    files_in: Sequence[Path],
+    dir_out: Path,
+    memory_budget_mb: float,
+    precision_reduction: PrecisionReduction,
+    max_megabytes_per_file: int,
+    preprocessed: bool,
+    layout: Optional[ParquetLayout] = None,
+    prefix: str = "part",
+) -> Tuple[np.ndarray, np.ndarray, List[Tuple[Path, int, int]]]:
+    """Back end of tiled_nc4_to_parquet. Returns the grid's lat and lon values, and each file written with the range of flattened (lat, lon) grid point indices it holds"""
+    layout = layout or ParquetLayout()
+    archive = _open_archive(files_in)
+    try:
+        lats, lons = archive[0][0].lat.values, archive[0][0].lon.values
+        bytes_per_point = _bytes_per_point(archive)
+        points_per_tile = int(
+            memory_budget_mb * 2 ** 20 // (bytes_per_point * TILE_WORKING_SET)
+        )
+        if points_per_tile < 1:
+            raise ValueError(
+                f"Each grid point needs about {bytes_per_point * TILE_WORKING_SET / 2 ** 20:.2f}MB, more than the memory budget of {memory_budget_mb:.2f}MB"
+            )
+        points_per_file = max(1, int(max_megabytes_per_file * 2 ** 20 // bytes_per_point))
+
+        dir_out = Path(dir_out)
+        dir_out.mkdir(parents=True, exist_ok=True)
+        parts: List[Tuple[Path, int, int]] = []
+        for lat, lon in spatial_tiles(len(lats), len(lons), points_per_tile):
+            ds = _read_tile(archive, lat, lon, precision_reduction, preprocessed)
+            table = dataset_to_arrow(ds)
+            del ds
+            # tiles are contiguous in row-major grid order
+            first_point = lat.start * len(lons) + lon.start
+            n_points = (lat.stop - lat.start) * (lon.stop - lon.start)
+            rows_per_point = table.num_rows // n_points
+            for start in range(0, n_points, points_per_file):
+                stop = min(start + points_per_file, n_points)
+                path = dir_out / f"{prefix}.{len(parts)}.parquet"
+                rows = table.slice(
+                    start * rows_per_point, (stop - start) * rows_per_point
+                )
+                layout.write(rows, path, rows_per_point)
+                parts.append((path, first_point + start, first_point + stop))
+            del table
+    finally:
+        for daily in archive:
+            for ds in daily:
+                ds.close()
+    return lats, lons, parts
+
+
+def _daily_files(
+    files_in: Iterable[Path], grid: Optional[Tuple[Sequence, Sequence]] = None
+) -> Dict[str, Dict[frozenset, Path]]:
+    """Group daily files by date and collection (set of variables), read from file headers. If grid is given, every file must cover those lat and lon values."""
+    dates: Dict[str, Dict[frozenset, Path]] = {}
+    for path in files_in:
+        with xr.open_dataset(path) as ds:
+            if grid is not None and not (
+                np.array_equal(ds.lat.values, grid[0])
+                and np.array_equal(ds.lon.values, grid[1])
+            ):
+                raise ValueError(f"{path} covers a different grid than the output")
+            date = str(ds.time.values[0])[:10]
+            dates.setdefault(date, {})[frozenset(ds.data_vars)] = Path(path)
+    return dates
+
+
+def append_nc4_to_parquet(
+    files_in: Sequence[Path],
+    dir_out: Path,
+    memory_budget_mb: float = 1000,
+    precision_reduction: PrecisionReduction = "round",
+    max_megabytes_per_file: int = 100,
+    preprocessed: bool = False,
+    compact: bool = False,
+    layout: Optional[ParquetLayout] = None,
+) -> List[Path]:
+    """Incremental version of tiled_nc4_to_parquet. Converts only dates that aren't yet in dir_out, so a daily or monthly job costs time proportional to the new data rather than the whole archive.
+
+    Ingested dates and input files are tracked in an IngestManifest in dir_out. Each run writes its new dates as a new batch of parquet files, named part.<batch>.<n>.parquet. A date is only ingested once files for all of its collections are present; incomplete dates are left for a later run. A batch is recorded after all of its files are written, so files of a run interrupted before then are deleted by the next run, which redoes their dates. With compact=True, appended batches are then merged into the first batch's spatial partitions (see compact_parquet), so each grid point's full time series is back in a single file.
+
+    Parameters
+    ----------
+    files_in : Sequence[Path]
+        sequence of file paths, such as Path(<directory>).glob(<PATTERN>). May include already ingested files; those are skipped without being opened.
+    dir_out : Path
+        directory where parquet files will be written. Must be empty or previously written by this function.
+    memory_budget_mb : float, optional
+        approximate peak memory in megabytes, as in tiled_nc4_to_parquet. By default 1000
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'. Use the same setting for every run.
+    max_megabytes_per_file : int, optional
+        max uncompressed size of each new parquet file, in megabytes. By default 100
+    preprocessed : bool, optional
+        If True, files_in were written by process_daily, so transforms and precision reduction are skipped. By default False
+    compact : bool, optional
+        If True, merge all appended batches into the first batch's files afterwards. By default False
+    layout : Optional[ParquetLayout], optional
+        codecs, encodings and row group sizes of the parquet files, by default None for ParquetLayout(). Use the same layout for every run.
+
+    Returns
+    -------
+    List[Path]
+        parquet files written or rewritten by this run
+
+    Raises
+    ------
+    ValueError
+        When dir_out holds parquet files that aren't in its ingest manifest, or new files cover a different grid
+
+    Example
+    -------
+    append_nc4_to_parquet(Path('./data/nc4').glob('*.nc4'), Path('./data/parquet'), compact=True)
+    """
+    dir_out = Path(dir_out)
+    _finish_compaction(dir_out)
+    manifest = IngestManifest(dir_out / INGEST_MANIFEST)
+    _remove_orphan_parts(dir_out, manifest)
+    if not manifest.batches and any(dir_out.glob("*.parquet")):
+        raise ValueError(
+            f"{dir_out} has parquet files that weren't written by append_nc4_to_parquet"
+        )
+    ingested = {name for batch in manifest.batches for name in batch["files"]}
+    new_files = [Path(path) for path in files_in if Path(path).name not in ingested]
+    if manifest.batches:
+        base = manifest.batches[0]
+        daily = _daily_files(new_files, (base["lat"], base["lon"]))
+        collections = {frozenset(fields) for fields in base["collections"]}
+    else:
+        daily = _daily_files(new_files)
+        collections = {
+            fields for by_collection in daily.values() for fields in by_collection
+        }
+    done = manifest.dates
+    new_dates = sorted(
+        date
+        for date, by_collection in daily.items()
+        if date not in done and collections <= set(by_collection)
+    )
+
+    written: List[Path] = []
+    if new_dates:
+        batch = manifest.next_batch
+        files = [
+            daily[date][fields]
+            for date in new_dates
+            for fields in sorted(collections, key=sorted)
+        ]
+        lats, lons, parts = _write_tiles(
+            files,
+            dir_out,
+            memory_budget_mb,
+            precision_reduction,
+            max_megabytes_per_file,
+            preprocessed,
+            layout,
+            prefix=f"part.{batch}",
+        )
+        entry = {
+            "batch": batch,
+            "dates": new_dates,
+            "files": sorted(path.name for path in files),
+            "parts": [[path.name, start, stop] for path, start, stop in parts],
+        }
+        if batch == 0:
+            entry.update(
+                lat=lats.tolist(),
+                lon=lons.tolist(),
+                collections=sorted(sorted(fields) for fields in collections),
+            )
+        manifest.record(entry)
+        _index_batches(dir_out, manifest.batches)
+        written = [path for path, _, _ in parts]
+    if compact and len(manifest) > 1:
+        written = compact_parquet(dir_out, layout)
+    return written
+
+
+def _remove_orphan_parts(dir_out: Path, manifest: IngestManifest) -> None:
+    """Delete parquet files of batches that aren't in the manifest, left by an append interrupted before it recorded its batch"""
+    recorded = {batch["batch"] for batch in manifest.batches}
+    for path in dir_out.glob("part.*.parquet"):
+        match = _BATCH_PART.fullmatch(path.name)
+        if match is not None and int(match.group(1)) not in recorded:
+            path.unlink()
+
+
+def _index_batches(dir_out: Path, batches: List[Dict]) -> None:
+    """Save the SpatialIndex of the parquet files of all ingest batches"""
+    parts = [
+        (dir_out / name, start, stop)
+        for batch in batches
+        for name, start, stop in batch["parts"]
+    ]
+    SpatialIndex.from_parts(batches[0]["lat"], batches[0]["lon"], parts).save(dir_out)
+
+
+def compact_parquet(
+    dir_out: Path, layout: Optional[ParquetLayout] = None
+) -> List[Path]:
+    """Merge batches appended by append_nc4_to_parquet into the first batch's spatial partitions. Each first-batch file gains the rows of the grid points it covers from every later batch, sorted by lat, lon and time, and the appended files are deleted. Memory use is about one first-batch file plus the appended files overlapping it.
+
+    Rewritten files are staged in a _compact subdirectory and only swapped in after a journal is written, so an interrupted compaction is either discarded or finished by the next call to this function or append_nc4_to_parquet.
+
+    Parameters
+    ----------
+    dir_out : Path
+        directory written by append_nc4_to_parquet
+    layout : Optional[ParquetLayout], optional
+        layout of the rewritten files, by default None for ParquetLayout()
+
+    Returns
+    -------
+    List[Path]
+        rewritten parquet files
+    """
+    dir_out = Path(dir_out)
+    _finish_compaction(dir_out)
+    manifest = IngestManifest(dir_out / INGEST_MANIFEST)
+    if len(manifest) < 2:
+        return []
+    layout = layout or ParquetLayout()
+    base, appended = manifest.batches[0], manifest.batches[1:]
+    n_lon = len(base["lon"])
+    lats, lons = np.asarray(base["lat"]), np.asarray(base["lon"])
+    pieces = sorted(
+        (start, stop, name)
+        for batch in appended
+        for name, start, stop in batch["parts"]
+    )
+
+    tmp_dir = dir_out / _COMPACT_DIR
+    tmp_dir.mkdir()
+    loaded: Dict[str, Tuple[pa.Table, np.ndarray]] = {}
+    for name, start, stop in base["parts"]:
+        tables = [pq.read_table(dir_out / name)]
+        columns = tables[0].schema.names
+        for piece_start, piece_stop, piece_name in pieces:
+            if piece_start >= stop or piece_stop <= start:
+                continue
+            if piece_name not in loaded:
+                table = pq.read_table(dir_out / piece_name)
+                points = np.searchsorted(
+                    lats, table["lat"].to_numpy()
+                ) * n_lon + np.searchsorted(lons, table["lon"].to_numpy())
+                loaded[piece_name] = (table, points)
+            table, points = loaded[piece_name]
+            first, last = np.searchsorted(points, [start, stop])
+            tables.append(table.slice(first, last - first).select(columns))
+            # partitions are in grid order, so it isn't needed again
+            if piece_stop <= stop:
+                del loaded[piece_name]
+        merged = pa.concat_tables(tables).sort_by(
+            [("lat", "ascending"), ("lon", "ascending"), ("time", "ascending")]
+        )
+        layout.write(merged, tmp_dir / name, merged.num_rows // (stop - start))
+
+    combined = dict(
+        base,
+        dates=sorted(manifest.dates),
+        files=sorted(name for batch in manifest.batches for name in batch["files"]),
+    )
+    journal = {
+        "manifest": [combined],
+        "delete": [name for _, _, name in pieces],
+    }
+    tmp_path = tmp_dir / "journal.json.tmp"
+    tmp_path.write_text(json.dumps(journal))
+    os.replace(tmp_path, tmp_dir / "journal.json")
+    _finish_compaction(dir_out)
+    return [dir_out / name for name, _, _ in base["parts"]]
+
+
+def _finish_compaction(dir_out: Path) -> None:
+    """Complete a compaction that was interrupted after writing its journal, or discard one interrupted before. Idempotent."""
+    tmp_dir = dir_out / _COMPACT_DIR
+    journal_path = tmp_dir / "journal.json"
+    if journal_path.exists():
+        journal = json.loads(journal_path.read_text())
+        IngestManifest(dir_out / INGEST_MANIFEST).replace(journal["manifest"])
+        for path in tmp_dir.glob("*.parquet"):
+            os.replace(path, dir_out / path.name)
+        for name in journal["delete"]:
+            (dir_out / name).unlink(missing_ok=True)
+        _index_batches(dir_out, journal["manifest"])
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+
+def merra_nc4_to_zarr(
+    files_in: Sequence[Path],
+    store: Union[str, Path],
+    precision_reduction: PrecisionReduction = "round",
+    megabytes_per_chunk: Union[int, float] = 100,
+    memory_budget_mb: float = 2000,
+    max_workers: Optional[int] = None,
+    compressors: Optional[Sequence[Any]] = None,
+    filters: Optional[Sequence[Any]] = None,
+    encoding: Optional[Dict[str, Dict[str, Any]]] = None,
+    consolidated: bool = True,
+    preprocessed: bool = False,
+) -> None:
+    """Convert daily netCDF MERRA-2 data to a Zarr store for array-based analysis. Chunks hold a variable's full time series over a spatial tile (the rechunk tiling), so reading one grid point's time series or one time step's field touches few chunks.
+
+    The store's metadata is written first, then chunk-sized tiles are read from every daily file, transformed and written into their region of the store by a thread pool. Nothing is rechunked through dask, and at most memory_budget_mb of tiles are in memory at once.
+
+    Parameters
+    ----------
+    files_in : Sequence[Path]
+        sequence of file paths, such as Path(<directory>).glob(<PATTERN>). All files must cover the same lat/lon grid.
+    store : Union[str, Path]
+        Zarr store path. Overwritten if it exists.
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'
+    megabytes_per_chunk : Union[int, float], optional
+        approximate uncompressed size of each variable's chunks, as in rechunk. By default 100
+    memory_budget_mb : float, optional
+        approximate peak memory in megabytes. Limits the number of tiles in flight. By default 2000
+    max_workers : Optional[int], optional
+        max threads writing tiles, by default None for os.cpu_count()
+    compressors : Optional[Sequence[Any]], optional
+        Zarr compressors for every data variable, e.g. [zarr.codecs.BloscCodec(cname="zstd", shuffle="bitshuffle")]. By default None for Zarr's default
+    filters : Optional[Sequence[Any]], optional
+        Zarr filters for every data variable, by default None
+    encoding : Optional[Dict[str, Dict[str, Any]]], optional
+        per-variable encoding overrides, e.g. {"PS": {"filters": [zarr.codecs.numcodecs.Delta(dtype="int32")]}}. Delta filters are only lossless for integer variables. By default None
+    consolidated : bool, optional
+        If True, write consolidated metadata so opening the store takes one read. By default True
+    preprocessed : bool, optional
+        If True, files_in were written by process_daily, so transforms and precision reduction are skipped. By default False
+
+    Raises
+    ------
+    ValueError
+        When one tile's working set doesn't fit in memory_budget_mb
+
+    Example
+    -------
+    merra_nc4_to_zarr(Path('./data/nc4').glob('*.nc4'), Path('./data/merra2.zarr'), compressors=[BloscCodec(cname="zstd", shuffle="bitshuffle")])
+    xr.open_zarr(Path('./data/merra2.zarr'))
+    """
+    archive = _open_archive(files_in)
+    try:
+        # output variables, dtypes and time axis, from a single grid point
+        sample = _read_tile(
+            archive, slice(0, 1), slice(0, 1), precision_reduction, preprocessed
+        )
+        lats, lons = archive[0][0].lat.values, archive[0][0].lon.values
+        n_time = sample.sizes["time"]
+        bytes_per_point = n_time * sum(
+            var.dtype.itemsize for var in sample.data_vars.values()
+        )
+        lat_step, lon_step = _spatial_steps(
+            len(lats),
+            len(lons),
+            bytes_per_point / 2 ** 20,
+            len(sample.data_vars),
+            megabytes_per_chunk,
+        )
+        tile_bytes = lat_step * lon_step * bytes_per_point * TILE_WORKING_SET
+        workers = min(
+            max_workers or os.cpu_count() or 1,
+            int(memory_budget_mb * 2 ** 20 // tile_bytes),
+        )
+        if workers < 1:
+            raise ValueError(
+                f"Each tile needs about {tile_bytes / 2 ** 20:.2f}MB, more than the memory budget of {memory_budget_mb:.2f}MB. Reduce megabytes_per_chunk."
+            )
+
+        chunks = (n_time, lat_step, lon_step)
+        template = xr.Dataset(
+            {
+                name: (
+                    ("time", "lat", "lon"),
+                    da.empty(
+                        (n_time, len(lats), len(lons)), dtype=var.dtype, chunks=chunks
+                    ),
+                    var.attrs,
+                )
+                for name, var in sample.data_vars.items()
+            },
+            coords={"time": sample.time.values, "lat": lats, "lon": lons},
+        )
+        var_encoding: Dict[str, Dict[str, Any]] = {}
+        for name in template.data_vars:
+            var_encoding[name] = {"chunks": chunks}
+            if compressors is not None:
+                var_encoding[name]["compressors"] = compressors
+            if filters is not None:
+                var_encoding[name]["filters"] = filters
+            var_encoding[name].update((encoding or {}).get(name, {}))
+        template.to_zarr(
+            store,
+            mode="w",
+            compute=False,
+            encoding=var_encoding,
+            consolidated=consolidated,
+        )
+
+        def write_tile(tile: Tuple[slice, slice]) -> None:
+            lat, lon = tile
+            ds = _read_tile(archive, lat, lon, precision_reduction, preprocessed)
+            ds.drop_vars(["time", "lat", "lon"]).drop_encoding().to_zarr(
+                store,
+                region={"time": slice(None), "lat": lat, "lon": lon},
+                consolidated=False,
+            )
+
+        tiles = [
+            (
+                slice(i, min(i + lat_step, len(lats))),
+                slice(j, min(j + lon_step, len(lons))),
+            )
+            for i in range(0, len(lats), lat_step)
+            for j in range(0, len(lons), lon_step)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(write_tile, tiles):  # re-raises worker exceptions
+                pass
+    finally:
+        for daily in archive:
+            for ds in daily:
+                ds.close()
+
+
+def merra_buffers_to_parquet(
+    buffers: Iterable[bytes],
+    dir_out: Path,
+    precision_reduction: PrecisionReduction = "round",
+    max_megabytes_per_file: int = 100,
+    layout: Optional[ParquetLayout] = None,
+) -> None:
+    """Same as merra_nc4_to_parquet, but reads daily netCDF responses from memory instead of files. Lets ephemeral jobs go from download_sinks.MemorySink straight to parquet with no intermediate nc4 files. All buffers must fit in memory at once.
+
+    Parameters
+    ----------
+    buffers : Iterable[bytes]
+        netCDF file contents, such as MemorySink.buffers.values()
+    dir_out : Path
+        directory where parquet files will be written
+    precision_reduction : PrecisionReduction, optional
+        One of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from precision_profile, by default 'round'
+    max_megabytes_per_file : int, optional
+        max uncompressed size of each output parquet file, in megabytes. By default 100
+    layout : Optional[ParquetLayout], optional
+        codecs, encodings and row group sizes of the parquet files, by default None for ParquetLayout()
+
+    Returns
+    -------
+    None
+    """
+    dataset_to_parquet(
+        open_merra_buffers(buffers),
+        dir_out,
+        precision_reduction=precision_reduction,
+        max_megabytes_per_file=max_megabytes_per_file,
+        layout=layout,
+    )
+
+
+def dataset_to_arrow(
+    ds: xr.Dataset, dim_order: Sequence[str] = ("lat", "lon", "time")
+) -> pa.Table:
+    """Flatten a dataset into an Arrow table with one row per (lat, lon, time), straight from its numpy arrays. Same columns and rows as ds.to_dataframe(dim_order).reset_index(), without building a pandas index or DataFrame: coordinate columns are broadcast with np.repeat and np.tile, and each variable already laid out in dim_order is wrapped without copying. Others are copied once, by the transpose.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        loaded dataset whose variables all have the dims in dim_order
+    dim_order : Sequence[str], optional
+        dims from slowest to fastest varying, by default ("lat", "lon", "time"), so each grid point's time series is contiguous
+
+    Returns
+    -------
+    pa.Table
+        coordinate columns in dim_order, then the data variables
+    """
+    sizes = [ds.sizes[dim] for dim in dim_order]
+    n_rows = int(np.prod(sizes))
+    columns: Dict[str, Any] = {}
+    for i, dim in enumerate(dim_order):
+        inner = int(np.prod(sizes[i + 1 :]))
+        columns[dim] = np.tile(
+            np.repeat(ds[dim].values, inner), n_rows // (sizes[i] * inner)
+        )
+    for name, var in ds.data_vars.items():
+        values = np.ascontiguousarray(var.transpose(*dim_order).values)
+        columns[name] = pa.array(values.reshape(-1))
+    return pa.table(columns)
+
+
+def dataset_to_parquet(
+    ds: xr.Dataset,
+    dir_out: Path,
+    precision_reduction: PrecisionReduction = "round",
+    max_megabytes_per_file: int = 100,
+    preprocessed: bool = False,
+    layout: Optional[ParquetLayout] = None,
+) -> None:
+    """Back end of merra_buffers_to_parquet. See merra_nc4_to_parquet for parameters. Transforms and writes one file's spatial tile of grid points at a time, converting it straight to Arrow (see dataset_to_arrow)."""
+    n_lat, n_lon = ds.lat.size, ds.lon.size
+    points_per_file = max(
+        1, int(max_megabytes_per_file * 2 ** 20 * n_lat * n_lon // ds.nbytes)
     )
+    layout = layout or ParquetLayout()
+    dir_out = Path(dir_out)
+    dir_out.mkdir(parents=True, exist_ok=True)
+    parts: List[Tuple[Path, int, int]] = []
+    for n, (lat, lon) in enumerate(spatial_tiles(n_lat, n_lon, points_per_file)):
+        tile = ds.isel(lat=lat, lon=lon).load()
+        if not preprocessed:
+            tile = fused_transforms(tile, precision_reduction)
+        path = dir_out / f"part.{n}.parquet"
+        layout.write(dataset_to_arrow(tile), path, ds.time.size)
+        first_point = lat.start * n_lon + lon.start
+        parts.append((path, first_point, first_point + tile.lat.size * tile.lon.size))
+    _remove_stale_parts(dir_out, parts)
+    SpatialIndex.from_parts(ds.lat.values, ds.lon.values, parts).save(dir_out)
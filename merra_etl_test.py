@@ -0,0 +1,382 @@
+import json
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import xarray as xr
+import zarr
+from zarr.codecs import BloscCodec
+from zarr.codecs.numcodecs import Delta
+
+import merra_etl
+
+
+def test_spatial_tiles():
+    for points in (1, 3, 7, 9, 20, 100):
+        tiles = merra_etl.spatial_tiles(4, 9, points)
+        cells = [
+            (i, j) for lat, lon in tiles for i in range(4)[lat] for j in range(9)[lon]
+        ]
+        assert cells == [(i, j) for i in range(4) for j in range(9)]  # row-major
+        assert (
+            max(len(range(4)[lat]) * len(range(9)[lon]) for lat, lon in tiles) <= points
+        )
+
+
+def test_tiled_matches_in_memory(tmp_path, write_daily_files, read_sorted):
+    files = write_daily_files(tmp_path / "nc4")
+    merra_etl.merra_buffers_to_parquet(
+        [f.read_bytes() for f in files],
+        tmp_path / "memory",
+        max_megabytes_per_file=0.05,
+    )
+    merra_etl.merra_nc4_to_parquet(
+        files, tmp_path / "tiled", max_megabytes_per_file=0.02, memory_budget_mb=0.2
+    )
+    written = sorted((tmp_path / "tiled").glob("*.parquet"))
+    assert len(written) > 1
+
+    expected = read_sorted(tmp_path / "memory")
+    tiled = read_sorted(tmp_path / "tiled")
+    pd.testing.assert_frame_equal(tiled, expected, check_dtype=False)
+
+    # each grid point's series is in one file, and files are in grid point order
+    paths = merra_etl.tiled_nc4_to_parquet(
+        files, tmp_path / "ordered", 0.2, max_megabytes_per_file=0.02
+    )
+    points = [pd.read_parquet(p, columns=["lat", "lon"]) for p in paths]
+    keys = [list(df.drop_duplicates().itertuples(index=False)) for df in points]
+    flat = [key for part in keys for key in part]
+    assert flat == sorted(set(flat))
+
+    # rewriting in fewer files leaves none of the earlier run's behind
+    for write in (
+        lambda: merra_etl.merra_nc4_to_parquet(files, tmp_path / "tiled"),
+        lambda: merra_etl.merra_buffers_to_parquet(
+            [f.read_bytes() for f in files], tmp_path / "memory"
+        ),
+    ):
+        write()
+    for directory in ("tiled", "memory"):
+        assert len(list((tmp_path / directory).glob("*.parquet"))) == 1
+        pd.testing.assert_frame_equal(
+            read_sorted(tmp_path / directory), expected, check_dtype=False
+        )
+
+
+def test_tiled_memory_is_bounded(tmp_path, write_daily_files):
+    # first conversion pays one-time import and cache allocations
+    small = write_daily_files(tmp_path / "small")
+    merra_etl.tiled_nc4_to_parquet(small, tmp_path / "warmup", 1)
+
+    files = write_daily_files(tmp_path / "nc4", (20, 40), (-110, -90))
+    budget_mb = sum(f.stat().st_size for f in files) / 2 ** 20 / 2
+    tracemalloc.start()
+    merra_etl.tiled_nc4_to_parquet(files, tmp_path / "parquet", budget_mb)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak / 2 ** 20 < budget_mb
+    assert len(pd.read_parquet(tmp_path / "parquet")) == 4 * 24 * 41 * 33
+
+    with pytest.raises(ValueError):
+        merra_etl.tiled_nc4_to_parquet(files, tmp_path / "tiny", 0.001)
+
+
+def test_append_and_compact(
+    tmp_path, monkeypatch, write_daily_files, read_sorted, collections
+):
+    files = write_daily_files(tmp_path / "nc4")
+    merra_etl.merra_nc4_to_parquet(
+        files, tmp_path / "expected", max_megabytes_per_file=0.05
+    )
+    expected = read_sorted(tmp_path / "expected")
+    out = tmp_path / "parquet"
+
+    first_two = [f for f in files if any(f".2020010{d}." in f.name for d in "12")]
+    base = merra_etl.append_nc4_to_parquet(
+        first_two, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+    )
+    assert len(base) > 1 and all(p.name.startswith("part.0.") for p in base)
+
+    # day 5 has only one collection so far, so it waits for a later run
+    partial = write_daily_files(
+        tmp_path / "nc4",
+        time_interval=(datetime(2020, 1, 5), datetime(2020, 1, 6)),
+        collections=collections[:1],
+    )
+    appended = merra_etl.append_nc4_to_parquet(
+        files + partial, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+    )
+    assert appended and all(p.name.startswith("part.1.") for p in appended)
+    assert merra_etl.append_nc4_to_parquet(files + partial, out) == []
+    manifest = merra_etl.IngestManifest(out / merra_etl.INGEST_MANIFEST)
+    assert manifest.dates == {f"2020-01-0{i}" for i in range(1, 5)}
+    pd.testing.assert_frame_equal(read_sorted(out), expected, check_dtype=False)
+
+    # compaction interrupted after its journal is written is finished by the next run
+    finish = merra_etl._finish_compaction
+    calls = []
+
+    def interrupted(dir_out):
+        calls.append(dir_out)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        finish(dir_out)
+
+    monkeypatch.setattr(merra_etl, "_finish_compaction", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        merra_etl.compact_parquet(out)
+    monkeypatch.setattr(merra_etl, "_finish_compaction", finish)
+    journal = json.loads((out / "_compact" / "journal.json").read_text())
+    assert len(journal["delete"]) == len(appended)
+
+    assert merra_etl.append_nc4_to_parquet(files, out) == []
+    assert sorted(out.glob("*.parquet")) == sorted(base)
+    assert not (out / "_compact").exists()
+    assert len(merra_etl.IngestManifest(out / merra_etl.INGEST_MANIFEST)) == 1
+    pd.testing.assert_frame_equal(read_sorted(out), expected, check_dtype=False)
+    for path in base:  # each file is in grid point then time order
+        df = pd.read_parquet(path)
+        pd.testing.assert_frame_equal(
+            df, df.sort_values(["lat", "lon", "time"]).reset_index(drop=True)
+        )
+
+    with pytest.raises(ValueError):
+        merra_etl.append_nc4_to_parquet(files, tmp_path / "expected")
+
+
+def test_append_interrupted_before_record(
+    tmp_path, monkeypatch, write_daily_files, read_sorted
+):
+    files = write_daily_files(tmp_path / "nc4")
+    expected_dir = tmp_path / "expected"
+    merra_etl.merra_nc4_to_parquet(files, expected_dir, max_megabytes_per_file=0.05)
+    expected = read_sorted(expected_dir)
+    out = tmp_path / "parquet"
+    first_two = [f for f in files if any(f".2020010{d}." in f.name for d in "12")]
+    record = merra_etl.IngestManifest.record
+
+    def interrupted(self, batch):
+        raise KeyboardInterrupt
+
+    # both the first batch and an appended one leave orphaned parts when interrupted
+    for run_files, n_batches in ((first_two, 1), (files, 2)):
+        monkeypatch.setattr(merra_etl.IngestManifest, "record", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            merra_etl.append_nc4_to_parquet(
+                run_files, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+            )
+        assert any(out.glob(f"part.{n_batches - 1}.*.parquet"))
+        monkeypatch.setattr(merra_etl.IngestManifest, "record", record)
+        written = merra_etl.append_nc4_to_parquet(
+            run_files, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+        )
+        manifest = merra_etl.IngestManifest(out / merra_etl.INGEST_MANIFEST)
+        assert len(manifest) == n_batches
+        recorded = {name for batch in manifest.batches for name, _, _ in batch["parts"]}
+        assert {path.name for path in out.glob("*.parquet")} == recorded
+        assert set(written) <= {out / name for name in recorded}
+    pd.testing.assert_frame_equal(read_sorted(out), expected, check_dtype=False)
+
+    # files not named like an appended batch still aren't touched
+    with pytest.raises(ValueError):
+        merra_etl.append_nc4_to_parquet(files, expected_dir)
+    assert read_sorted(expected_dir).equals(expected)
+
+
+def test_zarr(tmp_path, write_daily_files):
+    files = write_daily_files(tmp_path / "nc4", (20, 40), (-110, -90))
+    with merra_etl.open_merra(files) as ds:
+        expected = merra_etl.transforms(ds.load())
+    merra_etl.reduce_precision(expected)
+
+    store = tmp_path / "merra2.zarr"
+    merra_etl.merra_nc4_to_zarr(
+        files,
+        store,
+        megabytes_per_chunk=0.1,
+        max_workers=4,
+        compressors=[BloscCodec(cname="zstd", shuffle="bitshuffle")],
+        encoding={"PS": {"filters": [Delta(dtype="int32")]}},
+    )
+    zarr.open_consolidated(store)  # metadata was consolidated
+    with xr.open_zarr(store) as ds:
+        xr.testing.assert_equal(ds.load(), expected.transpose(*ds.dims))
+        assert ds.PS.dtype == np.int32
+        chunks = ds.TS.encoding["chunks"]
+        assert chunks[0] == 4 * 24  # full time series
+        assert chunks[1] * chunks[2] < 41 * 33  # tiled in space
+        assert ds.TS.encoding["compressors"][0].shuffle.value == "bitshuffle"
+        assert ds.PS.encoding["filters"]
+
+    with pytest.raises(ValueError):
+        merra_etl.merra_nc4_to_zarr(files, store, memory_budget_mb=0.1)
+
+
+@pytest.mark.parametrize(
+    "precision_reduction", [None, "round", "fp16", "bitround", "bitgroom"]
+)
+def test_fused_transforms(tmp_path, precision_reduction, write_daily_files):
+    files = write_daily_files(tmp_path / "nc4")
+    with merra_etl.open_merra(files) as ds:
+        ds = ds.load()
+    expected = merra_etl.transforms(ds.copy())
+    if precision_reduction in merra_etl.MANTISSA_METHODS:
+        merra_etl.reduce_mantissa(expected, groom=precision_reduction == "bitgroom")
+    elif precision_reduction is not None:
+        merra_etl.reduce_precision(expected, fp16=precision_reduction == "fp16")
+
+    # blocks that don't divide the data evenly
+    fused = merra_etl.fused_transforms(ds, precision_reduction, block_size=1000)
+    assert list(fused.data_vars) == list(expected.data_vars)
+    xr.testing.assert_equal(fused.coords.to_dataset(), expected.coords.to_dataset())
+    for name, var in expected.data_vars.items():
+        np.testing.assert_array_equal(fused[name].values, var.values)
+        assert fused[name].dtype == (
+            np.int32 if name == "PS" and precision_reduction else np.float32
+        )
+    assert "U50M" in ds  # input is unchanged
+
+
+@pytest.mark.parametrize(
+    "precision_reduction", [None, "round", "fp16", "bitround", "bitgroom"]
+)
+def test_fused_transforms_subset(
+    tmp_path, precision_reduction, write_daily_files, collections
+):
+    # without the lnd and flx collections' variables
+    files = write_daily_files(tmp_path / "nc4")
+    with merra_etl.open_merra(files) as ds:
+        ds = ds.drop_vars(["GHLAND", "RISFC"]).load()
+    expected = merra_etl.transforms(ds.copy())
+    if precision_reduction in merra_etl.MANTISSA_METHODS:
+        merra_etl.reduce_mantissa(expected, groom=precision_reduction == "bitgroom")
+    elif precision_reduction is not None:
+        merra_etl.reduce_precision(expected, fp16=precision_reduction == "fp16")
+    fused = merra_etl.fused_transforms(ds, precision_reduction, block_size=1000)
+    assert "GHLAND" not in fused
+    xr.testing.assert_equal(fused, expected)
+
+
+def test_bitround():
+    # ties go to the even neighbour
+    x = np.array([1.0, 1.125, 1.375, 1.625, 1.875, -1.375], dtype=np.float32)
+    assert merra_etl.bitround(x, 2) is x  # in place
+    np.testing.assert_array_equal(x, [1.0, 1.0, 1.5, 1.5, 2.0, -1.5])
+    special = np.array([0.0, np.inf, -np.inf, np.nan], dtype=np.float32)
+    np.testing.assert_array_equal(merra_etl.bitround(special.copy(), 5), special)
+
+    values = np.random.default_rng(0).normal(scale=100, size=10_000)
+    for dtype, mantissa in ((np.float32, 23), (np.float64, 52)):
+        original = values.astype(dtype)
+        for keepbits in (0, 7, mantissa):
+            rounded = merra_etl.bitround(original.copy(), keepbits)
+            error = np.abs(rounded - original) / np.abs(original)
+            assert error.max() <= 2.0 ** (-keepbits - 1)
+            trailing = rounded.view(f"u{rounded.itemsize}") & (
+                (1 << mantissa - keepbits) - 1
+            )
+            assert not trailing.any()
+
+    with pytest.raises(ValueError):
+        merra_etl.bitround(np.ones(3, dtype=np.float16), 5)
+
+
+def test_bitgroom():
+    x = np.full(6, 1.1234567, dtype=np.float32)
+    x[4] = 0
+    merra_etl.bitgroom(x, 7)
+    # shaved towards zero, then set away from it
+    np.testing.assert_array_equal(x[::2], np.float32([1.1171875, 1.1171875, 0]))
+    assert (x[1::2] > 1.1171875 + 2 ** -7 - 2 ** -20).all()
+    with pytest.raises(ValueError):
+        merra_etl.bitgroom(x[::2], 7)
+
+
+def test_precision_profile(tmp_path, write_daily_files, read_sorted):
+    files = write_daily_files(tmp_path / "nc4")
+    profile = merra_etl.precision_profile(files, sample_days=2)
+    assert set(profile) == {
+        "TS",
+        "T10M",
+        "PRECTOTCORR",
+        "RHOA",
+        "RISFC",
+        "GHLAND",
+        "WS50M",
+        "WDIR50M",
+    }
+    assert all(0 <= bits <= 23 for bits in profile.values())
+    coarse = merra_etl.precision_profile(files, information_level=0.5)
+    assert all(coarse[name] <= profile[name] for name in profile)
+
+    # a saved profile drives both conversion paths
+    profile = json.loads(json.dumps(coarse))
+    merra_etl.merra_buffers_to_parquet(
+        [f.read_bytes() for f in files],
+        tmp_path / "memory",
+        profile,
+        max_megabytes_per_file=0.05,
+    )
+    merra_etl.merra_nc4_to_parquet(
+        files, tmp_path / "tiled", profile, memory_budget_mb=0.2
+    )
+    expected = read_sorted(tmp_path / "memory")
+    pd.testing.assert_frame_equal(
+        read_sorted(tmp_path / "tiled"), expected, check_dtype=False
+    )
+    with merra_etl.open_merra(files) as ds:
+        ds = merra_etl.transforms(ds.load())
+    rounded = merra_etl.bitround(ds["WS50M"].values.copy(), profile["WS50M"])
+    assert set(expected["WS50M"]) == set(rounded.ravel())
+
+
+def test_dataset_to_arrow(tmp_path, write_daily_files):
+    files = write_daily_files(tmp_path / "nc4")
+    with merra_etl.open_merra(files) as ds:
+        ds = merra_etl.fused_transforms(ds.load())
+    table = merra_etl.dataset_to_arrow(ds)
+    expected = ds.to_dataframe(dim_order=["lat", "lon", "time"]).reset_index()
+    pd.testing.assert_frame_equal(table.to_pandas(), expected)
+
+    # variables already in row order are wrapped, not copied
+    ordered = ds.transpose("lat", "lon", "time")
+    for var in ordered.data_vars.values():
+        var.values = np.ascontiguousarray(var.values)
+    table = merra_etl.dataset_to_arrow(ordered)
+    address = table["TS"].chunks[0].buffers()[1].address
+    assert address == ordered["TS"].values.__array_interface__["data"][0]
+
+
+def test_parquet_layout(tmp_path, write_daily_files, read_sorted):
+    files = write_daily_files(tmp_path / "nc4")
+    merra_etl.merra_nc4_to_parquet(files, tmp_path / "default")
+    layout = merra_etl.ParquetLayout(
+        compression="zstd",
+        dictionary=("lat", "lon", "time"),
+        byte_stream_split=True,
+        row_group_megabytes=0,
+    )
+    merra_etl.merra_nc4_to_parquet(
+        files, tmp_path / "tuned", memory_budget_mb=0.2, layout=layout
+    )
+    expected = read_sorted(tmp_path / "default")
+    pd.testing.assert_frame_equal(read_sorted(tmp_path / "tuned"), expected)
+
+    # one grid point per row group, so a point's series is one row group read
+    n_time = expected["time"].nunique()
+    for path in (tmp_path / "tuned").glob("*.parquet"):
+        metadata = pq.ParquetFile(path).metadata
+        column = metadata.row_group(0).column(metadata.schema.names.index("TS"))
+        assert column.compression == "ZSTD"
+        assert "BYTE_STREAM_SPLIT" in column.encodings
+        table = pq.read_table(path)
+        for i in range(metadata.num_row_groups):
+            group = table.slice(i * n_time, n_time)
+            assert metadata.row_group(i).num_rows == n_time
+            assert (
+                len(set(zip(group["lat"].to_pylist(), group["lon"].to_pylist()))) == 1
+            )
@@ -0,0 +1,212 @@
+import asyncio
+import multiprocessing
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Awaitable, DefaultDict, Dict, Iterable, List, Optional, Set, Union
+
+import merra_urls
+import merra_etl
+from async_downloader import AsyncDownloader
+from download_manifest import DownloadManifest
+
+
+def _date_key(url: str) -> str:
+    return merra_urls.parse_url(url)["date"].strftime("%Y%m%d")
+
+
+class DailyPipeline(object):
+    def __init__(
+        self,
+        download_dir: Union[str, Path],
+        processed_dir: Union[str, Path],
+        precision_reduction: merra_etl.PrecisionReduction = "round",
+        max_workers: Optional[int] = None,
+        queue_size: int = 4,
+        **downloader_kwargs,
+    ) -> None:
+        """Download and process MERRA-2 data concurrently. As soon as every collection's file for a date is on disk, that date goes onto a bounded queue, and a process pool applies merra_etl.process_daily to it while downloads continue. End to end time approaches max(download, ETL) rather than their sum.
+
+        If the ETL falls behind, the queue fills up and downloads wait for room, so finished-but-unprocessed files can't pile up without limit. A date whose ETL raises is reported in incomplete_dates, like one with failed downloads, and the other dates carry on.
+
+        Parameters
+        ----------
+        download_dir : Union[str, Path]
+            directory for downloaded daily files
+        processed_dir : Union[str, Path]
+            directory for processed daily netCDF files. Dates with an existing output file are not processed again.
+        precision_reduction : merra_etl.PrecisionReduction, optional
+            passed to merra_etl.process_daily; one of None, 'round', 'fp16', 'bitround' or 'bitgroom', or a precision profile from merra_etl.precision_profile, by default 'round'. Use a profile rather than working out precision per date, so every date keeps the same bits.
+        max_workers : Optional[int], optional
+            number of ETL processes, by default None for os.cpu_count()
+        queue_size : int, optional
+            max number of complete dates waiting for an ETL process, by default 4
+        **downloader_kwargs
+            passed to AsyncDownloader. schedule defaults to 'by_date', so each date's files finish together.
+
+        Example
+        -------
+        pipeline = DailyPipeline(Path('./data/nc4'), Path('./data/daily'))
+        processed = asyncio.run(pipeline.run(urls))
+        merra_etl.merra_nc4_to_parquet(processed, Path('./data/parquet'), preprocessed=True)
+        """
+        self.download_dir = Path(download_dir)
+        self.processed_dir = Path(processed_dir)
+        self.precision_reduction = precision_reduction
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        downloader_kwargs.setdefault("schedule", "by_date")
+        self.downloader = AsyncDownloader(
+            self.download_dir, on_complete=self._file_complete, **downloader_kwargs
+        )
+        self.processed: List[Path] = []
+        self.incomplete_dates: List[str] = []
+
+        self._queue: Optional[asyncio.Queue] = None
+        # distinct files per date; different URLs can share a file name
+        self._expected: Dict[str, int] = {}
+        self._done: DefaultDict[str, Set[Path]] = defaultdict(set)
+        self._failed: Set[str] = set()
+
+    def _output_path(self, date: str) -> Path:
+        return self.processed_dir / f"MERRA2.{date}.nc"
+
+    def _mark_done(self, date: str, filepath: Path) -> bool:
+        """Record a downloaded file. Returns True if it was the last one its date needed."""
+        if filepath in self._done[date]:
+            return False
+        self._done[date].add(filepath)
+        return len(self._done[date]) == self._expected[date]
+
+    async def _file_complete(self, url: str, filepath: Path) -> None:
+        date = _date_key(url)
+        if self._mark_done(date, filepath):
+            await self._queue.put(date)  # type: ignore
+
+    def _collect(
+        self, done: Set[asyncio.Future], dates: Dict[asyncio.Future, str]
+    ) -> None:
+        for task in done:
+            date = dates.pop(task)
+            try:
+                self.processed.append(task.result())
+            except Exception as e:
+                print(f"ETL failed for {date}: {e!r}")
+                self._failed.add(date)
+
+    async def _process_dates(self, pool: ProcessPoolExecutor, n_workers: int) -> None:
+        loop = asyncio.get_running_loop()
+        running: Set[asyncio.Future] = set()
+        dates: Dict[asyncio.Future, str] = {}
+        while True:
+            # wait for a free worker before taking the next date, so the queue stays full when the ETL is the bottleneck
+            while len(running) >= n_workers:
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                self._collect(done, dates)
+            date = await self._queue.get()  # type: ignore
+            if date is None:
+                break
+            task = loop.run_in_executor(
+                pool,
+                merra_etl.process_daily,
+                sorted(self._done[date]),
+                self._output_path(date),
+                self.precision_reduction,
+            )
+            running.add(task)
+            dates[task] = date
+        if running:
+            done, _ = await asyncio.wait(running)
+            self._collect(done, dates)
+
+    async def _supervised(self, work: Awaitable, consumer: asyncio.Future) -> None:
+        """Await work, but stop it if the consumer dies first: nothing would drain the queue, so work could wait on it forever"""
+        task = asyncio.ensure_future(work)
+        await asyncio.wait({task, consumer}, return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            consumer.result()  # the consumer only returns after work is done, so this raises
+        await task
+
+    async def _produce(self, ready_dates: List[str], to_download: List[str]) -> None:
+        for date in ready_dates:
+            await self._queue.put(date)  # type: ignore
+        if to_download:
+            await self.downloader.download(to_download)
+        await self._queue.put(None)  # type: ignore
+
+    async def run(self, urls: Iterable[str]) -> List[Path]:
+        """Download urls and process each date as it completes.
+
+        Parameters
+        ----------
+        urls : Iterable[str]
+            URLs from merra_urls.url_generator. Reordered by date so each date's collections finish close together.
+
+        Returns
+        -------
+        List[Path]
+            processed daily files, sorted by date. Dates with failed downloads or ETL errors are listed in self.incomplete_dates.
+        """
+        self.processed_dir.mkdir(parents=True, exist_ok=True)
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        # sort is stable, so collections keep their order within each date
+        urls = sorted(dict.fromkeys(urls), key=_date_key)
+        files: DefaultDict[str, Set[Path]] = defaultdict(set)
+        for url in urls:
+            files[_date_key(url)].add(self.downloader.filepath_for_url(url))
+        self._expected = {date: len(paths) for date, paths in files.items()}
+        self._done = defaultdict(set)
+        self._failed = set()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+
+        already_processed = {
+            date for date in self._expected if self._output_path(date).exists()
+        }
+        self.processed = [self._output_path(date) for date in already_processed]
+        # files finished by a previous run won't trigger the download callback
+        manifest = None
+        if self.downloader.manifest_name is not None:
+            manifest = DownloadManifest(
+                self.download_dir / self.downloader.manifest_name
+            )
+        to_download = []
+        ready_dates = []
+        for url in urls:
+            date = _date_key(url)
+            if date in already_processed:
+                continue
+            if manifest is not None and manifest.is_complete(url, self.download_dir):
+                if self._mark_done(date, self.downloader.filepath_for_url(url)):
+                    ready_dates.append(date)
+            else:
+                to_download.append(url)
+
+        n_workers = self.max_workers or os.cpu_count() or 1
+        # spawn, because forked workers can deadlock on locks held by threads in this process, e.g. dask's
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            consumer = asyncio.ensure_future(self._process_dates(pool, n_workers))
+            try:
+                await self._supervised(
+                    self._produce(ready_dates, to_download), consumer
+                )
+                await consumer
+            finally:
+                consumer.cancel()
+
+        self.incomplete_dates = sorted(
+            date
+            for date, n in self._expected.items()
+            if date not in already_processed
+            and (len(self._done[date]) < n or date in self._failed)
+        )
+        if self.incomplete_dates:
+            print(
+                f"{len(self.incomplete_dates)} dates were not processed due to failed downloads or ETL errors."
+            )
+        return sorted(self.processed)
@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import merra_etl
+import merra_urls
+from fake_opendap_server import FakeOpendapServer
+from merra_pipeline import DailyPipeline
+
+
+def test_pipeline(tmp_path, collections):
+    urls = list(
+        merra_urls.url_generator(
+            time_interval=(datetime(2020, 1, 1), datetime(2020, 1, 5)),
+            lat_interval=(26, 30),
+            lon_interval=(-100, -95),
+            collections=collections,
+        )
+    )
+    with FakeOpendapServer() as server:
+        pipeline = DailyPipeline(
+            tmp_path / "nc4", tmp_path / "daily", max_workers=2, max_per_second=100
+        )
+        processed = asyncio.run(pipeline.run(server.localize_all(urls)))
+        assert [p.name for p in processed] == [
+            f"MERRA2.2020010{i}.nc" for i in range(1, 5)
+        ]
+        assert not pipeline.incomplete_dates
+
+        # rerun finds everything done
+        requests = server.stats[200]
+        assert asyncio.run(pipeline.run(server.localize_all(urls))) == processed
+        assert server.stats[200] == requests
+
+    merra_etl.merra_nc4_to_parquet(
+        processed, tmp_path / "parquet", max_megabytes_per_file=0.05, preprocessed=True
+    )
+    df = pd.read_parquet(tmp_path / "parquet")
+    assert len(df) == 4 * 24 * 9 * 9
+    assert "WS50M" in df.columns and "U50M" not in df.columns
+
+
+def test_pipeline_repeated_files(tmp_path, collections):
+    def urls_for(collections):
+        return list(
+            merra_urls.url_generator(
+                time_interval=(datetime(2020, 1, 1), datetime(2020, 1, 3)),
+                lat_interval=(26, 30),
+                lon_interval=(-100, -95),
+                collections=collections,
+            )
+        )
+
+    urls = urls_for(collections)
+    # a repeated URL, and a different URL for the same file: same fields, other order
+    reordered = dict(collections[0], fields=collections[0]["fields"][::-1])
+    urls += urls[:1] + urls_for([reordered])[:1]
+    with FakeOpendapServer() as server:
+        pipeline = DailyPipeline(
+            tmp_path / "nc4",
+            tmp_path / "daily",
+            max_workers=1,
+            # one at a time, since the two URLs for the same file would race on it
+            max_at_once=1,
+            max_per_second=100,
+        )
+        processed = asyncio.run(
+            asyncio.wait_for(pipeline.run(server.localize_all(urls)), 60)
+        )
+        assert [p.name for p in processed] == [
+            "MERRA2.20200101.nc",
+            "MERRA2.20200102.nc",
+        ]
+        assert not pipeline.incomplete_dates
+        assert server.stats[200] == len(urls) - 1
+
+        # a rerun counts files completed in the manifest the same way
+        (tmp_path / "daily" / "MERRA2.20200101.nc").unlink()
+        processed = asyncio.run(pipeline.run(server.localize_all(urls)))
+        assert len(processed) == 2 and not pipeline.incomplete_dates
+        assert server.stats[200] == len(urls) - 1
+
+
+def test_pipeline_etl_errors(tmp_path, collections):
+    urls = list(
+        merra_urls.url_generator(
+            time_interval=(datetime(2020, 1, 1), datetime(2020, 1, 5)),
+            lat_interval=(26, 30),
+            lon_interval=(-100, -95),
+            collections=collections,
+        )
+    )
+    # process_daily can't write its temporary file for this date
+    (tmp_path / "daily" / "MERRA2.20200102.nc.part").mkdir(parents=True)
+    with FakeOpendapServer() as server:
+        pipeline = DailyPipeline(
+            tmp_path / "nc4",
+            tmp_path / "daily",
+            max_workers=1,
+            queue_size=1,
+            max_per_second=100,
+        )
+        processed = asyncio.run(
+            asyncio.wait_for(pipeline.run(server.localize_all(urls)), 60)
+        )
+        assert [p.name for p in processed] == [
+            f"MERRA2.2020010{i}.nc" for i in (1, 3, 4)
+        ]
+        assert pipeline.incomplete_dates == ["20200102"]
+
+        # a consumer that dies stops the downloads instead of leaving them blocked on the queue
+        async def crash(pool, n_workers):
+            raise RuntimeError("consumer crashed")
+
+        pipeline = DailyPipeline(
+            tmp_path / "nc4_2", tmp_path / "daily_2", queue_size=1, max_per_second=100
+        )
+        pipeline._process_dates = crash
+        with pytest.raises(RuntimeError, match="consumer crashed"):
+            asyncio.run(asyncio.wait_for(pipeline.run(server.localize_all(urls)), 60))
@@ -1,4 +1,6 @@
 import datetime
+import re
+from urllib.parse import urlsplit, unquote
 
 BASE_URL = "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/"
 
@@ -11,21 +13,12 @@ def url_generator(
 ):
     # URLs have form root + short_name + const + date + stream + collection + date + const + field_params
     # collections: list of dicts {'collection': 'tavg1_2d_slv_Nx', 'short_name': 'M2T1NXSLV', 'fields': ['U50M', 'V50M']}
-    hour_str = "[0:23]"
-    lat_str = (
-        f"[{lat_to_index_num(lat_interval[0])}:{lat_to_index_num(lat_interval[1])}]"
-    )
-    lon_str = (
-        f"[{lon_to_index_num(lon_interval[0])}:{lon_to_index_num(lon_interval[1])}]"
-    )
+    lat_slab = (lat_to_index_num(lat_interval[0]), lat_to_index_num(lat_interval[1]))
+    lon_slab = (lon_to_index_num(lon_interval[0]), lon_to_index_num(lon_interval[1]))
     for collection in collections:
         date = time_interval[0]
         date_inc = datetime.timedelta(days=1)
-        param_str = f"{hour_str}{lat_str}{lon_str},"
-        query_str = (
-            param_str.join(collection["fields"])
-            + f"{param_str}time,lat{lat_str},lon{lon_str}"
-        )
+        query_str = build_query(collection["fields"], (0, 23), lat_slab, lon_slab)
 
         while date < time_interval[1]:
             short_name = collection["short_name"]
@@ -38,6 +31,15 @@ def url_generator(
             date += date_inc
 
 
+def build_query(fields, time_slab, lat_slab, lon_slab):
+    """OPeNDAP constraint expression for fields over inclusive index slabs, in the form url_generator uses"""
+    hour_str = f"[{time_slab[0]}:{time_slab[1]}]"
+    lat_str = f"[{lat_slab[0]}:{lat_slab[1]}]"
+    lon_str = f"[{lon_slab[0]}:{lon_slab[1]}]"
+    param_str = f"{hour_str}{lat_str}{lon_str},"
+    return param_str.join(fields) + f"{param_str}time,lat{lat_str},lon{lon_str}"
+
+
 def lat_to_index_num(lat):
     """Input latitude in [-90, 90].
     MERRA-2 latitude is 0.5 degree resolution, indexed [0:360]"""
@@ -68,3 +70,45 @@ def production_stream(year):
         return "300"
     else:
         return "400"
+
+
+_QUERY_ITEM = re.compile(r"(\w+)((?:\[\d+:\d+\])*)")
+_SLAB = re.compile(r"\[(\d+):(\d+)\]")
+_FILENAME = re.compile(r"MERRA2_(\d+)\.(\w+)\.(\d{8})\.nc4")
+
+
+def parse_url(url):
+    """Inverse of url_generator, for a single URL. Index slabs are inclusive (start, stop) pairs, as in the OPeNDAP constraint expression.
+
+    Returns dict with keys: short_name, collection, stream, date, fields (list of variable names), time (slab), lat (slab), lon (slab).
+    Slabs are None if not present in the URL."""
+    parts = urlsplit(url)
+    path_parts = parts.path.split("/")
+    match = _FILENAME.search(path_parts[-1])
+    if match is None:
+        raise ValueError(f"Not a MERRA-2 file URL: {url}")
+    stream, collection, date_str = match.groups()
+    out = {
+        "short_name": path_parts[-4].split(".")[0],
+        "collection": collection,
+        "stream": stream,
+        "date": datetime.datetime.strptime(date_str, "%Y%m%d"),
+        "fields": [],
+        "time": None,
+        "lat": None,
+        "lon": None,
+    }
+    for item in unquote(parts.query).split(","):
+        match = _QUERY_ITEM.fullmatch(item)
+        if match is None:
+            continue
+        name, slab_str = match.groups()
+        slabs = [(int(a), int(b)) for a, b in _SLAB.findall(slab_str)]
+        if name in ("time", "lat", "lon"):
+            if slabs:
+                out[name] = slabs[0]
+        else:
+            out["fields"].append(name)
+            if len(slabs) == 3:
+                out["time"], out["lat"], out["lon"] = slabs
+    return out
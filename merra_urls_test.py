@@ -39,3 +39,16 @@ def test_url_generator():
         == "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2I1NXLFO.5.12.4/2020/03/MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4?PS[0:23][176:184][285:291],SPEEDLML[0:23][176:184][285:291],time,lat[176:184],lon[285:291]"
     )
 
+
+def test_parse_url():
+    url = "https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2I1NXLFO.5.12.4/2020/03/MERRA2_400.inst1_2d_lfo_Nx.20200331.nc4.nc4?PS[0:23][176:184][285:291],SPEEDLML[0:23][176:184][285:291],time,lat[176:184],lon[285:291]"
+    assert merra_urls.parse_url(url) == {
+        "short_name": "M2I1NXLFO",
+        "collection": "inst1_2d_lfo_Nx",
+        "stream": "400",
+        "date": datetime(2020, 3, 31),
+        "fields": ["PS", "SPEEDLML"],
+        "time": (0, 23),
+        "lat": (176, 184),
+        "lon": (285, 291),
+    }
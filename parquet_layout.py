@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# output columns that index each row rather than hold data
+COORDINATES = ("lat", "lon", "time")
+
+
+class ParquetLayout(object):
+    def __init__(
+        self,
+        compression: str = "snappy",
+        compression_level: Optional[int] = None,
+        column_compression: Optional[Dict[str, str]] = None,
+        dictionary: Union[bool, Sequence[str]] = True,
+        byte_stream_split: Union[bool, Sequence[str]] = False,
+        column_encoding: Optional[Dict[str, str]] = None,
+        row_group_megabytes: Optional[float] = 8,
+    ) -> None:
+        """Codecs, encodings and row group sizes for the parquet files written by merra_etl. Row groups hold whole grid points, so a reader after one point's time series only has to decode the row group containing it.
+
+        Which options compress best depends on the data. Floats with precision reduced to a few thousand distinct values compress well with dictionary encoding (the default); full precision floats compress better with BYTE_STREAM_SPLIT, which groups the bytes of each value by significance. Compare options on your own data with `python etl_benchmark.py layout`.
+
+        Parameters
+        ----------
+        compression : str, optional
+            codec for every column without an entry in column_compression, such as 'snappy', 'zstd', 'lz4', 'gzip' or 'none'. By default 'snappy'
+        compression_level : Optional[int], optional
+            level for codecs that have one, such as zstd, by default None for the codec's default
+        column_compression : Optional[Dict[str, str]], optional
+            per-column codecs, overriding compression. By default None
+        dictionary : Union[bool, Sequence[str]], optional
+            dictionary encode all columns (True), none (False) or only those listed, such as COORDINATES. Columns fall back to plain encoding if their dictionary grows too large. By default True
+        byte_stream_split : Union[bool, Sequence[str]], optional
+            BYTE_STREAM_SPLIT encode all float and integer data columns (True), none (False) or only those listed. For dictionary encoded columns, used when the dictionary falls back. By default False
+        column_encoding : Optional[Dict[str, str]], optional
+            explicit encodings per column, such as {'PS': 'DELTA_BINARY_PACKED'}. Needs dictionary=False. By default None
+        row_group_megabytes : Optional[float], optional
+            approximate uncompressed size of each row group, rounded down to whole grid points, with at least one. 0 gives one grid point per row group. None leaves row groups to pyarrow, ignoring grid points. By default 8
+
+        Raises
+        ------
+        ValueError
+            If column_encoding is used with dictionary encoding
+
+        Example
+        -------
+        layout = ParquetLayout(compression='zstd', dictionary=COORDINATES, byte_stream_split=True, row_group_megabytes=0)
+        merra_nc4_to_parquet(files, dir_out, precision_reduction=None, layout=layout)
+        """
+        if column_encoding and dictionary is not False:
+            raise ValueError(
+                "column_encoding needs dictionary=False; use byte_stream_split to combine BYTE_STREAM_SPLIT with dictionary encoding"
+            )
+        self.compression = compression
+        self.compression_level = compression_level
+        self.column_compression = dict(column_compression or {})
+        self.dictionary = (
+            dictionary if isinstance(dictionary, bool) else list(dictionary)
+        )
+        self.byte_stream_split = (
+            byte_stream_split
+            if isinstance(byte_stream_split, bool)
+            else list(byte_stream_split)
+        )
+        self.column_encoding = dict(column_encoding or {})
+        self.row_group_megabytes = row_group_megabytes
+
+    def points_per_row_group(self, table: pa.Table, rows_per_point: int) -> int:
+        """Grid points in each row group of table. 0 if row groups are left to pyarrow."""
+        if self.row_group_megabytes is None:
+            return 0
+        n_points = max(1, table.num_rows // rows_per_point)
+        bytes_per_point = table.nbytes / n_points
+        return max(1, int(self.row_group_megabytes * 2**20 // bytes_per_point))
+
+    def write_options(self, table: pa.Table, rows_per_point: int) -> Dict:
+        """Keyword arguments for pq.write_table to write table in this layout"""
+        names = table.column_names
+        options: Dict = {
+            "compression": {
+                name: self.column_compression.get(name, self.compression)
+                for name in names
+            },
+            "use_dictionary": self.dictionary,
+        }
+        if self.compression_level is not None:
+            options["compression_level"] = self.compression_level
+        if self.byte_stream_split is True:
+            options["use_byte_stream_split"] = [
+                field.name
+                for field in table.schema
+                if field.name not in COORDINATES
+                and (
+                    pa.types.is_floating(field.type) or pa.types.is_integer(field.type)
+                )
+            ]
+        else:
+            options["use_byte_stream_split"] = self.byte_stream_split
+        if self.column_encoding:
+            options["column_encoding"] = self.column_encoding
+        points = self.points_per_row_group(table, rows_per_point)
+        if points:
+            options["row_group_size"] = points * rows_per_point
+        return options
+
+    def write(
+        self, table: pa.Table, path: Union[str, Path], rows_per_point: int
+    ) -> None:
+        """Write table, whose rows are grouped by grid point with rows_per_point rows each, to a parquet file.
+
+        Parameters
+        ----------
+        table : pa.Table
+            rows in grid point order, such as from merra_etl.dataset_to_arrow
+        path : Union[str, Path]
+            output file
+        rows_per_point : int
+            rows (time steps) per grid point
+        """
+        pq.write_table(table, path, **self.write_options(table, rows_per_point))
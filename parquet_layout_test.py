@@ -0,0 +1,83 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from parquet_layout import COORDINATES, ParquetLayout
+
+N_POINTS, N_TIME = 12, 48
+
+
+def grid_table():
+    rng = np.random.default_rng(0)
+    n_rows = N_POINTS * N_TIME
+    return pa.table(
+        {
+            "lat": np.repeat(np.arange(N_POINTS, dtype=np.float64), N_TIME),
+            "lon": np.zeros(n_rows),
+            "time": np.tile(np.arange(N_TIME), N_POINTS),
+            "TS": rng.normal(size=n_rows).astype(np.float32),
+            "PS": rng.integers(90000, 100000, n_rows, dtype=np.int32),
+        }
+    )
+
+
+def test_write_options():
+    table = grid_table()
+    options = ParquetLayout().write_options(table, N_TIME)
+    assert set(options["compression"].values()) == {"snappy"}
+    assert options["use_dictionary"] is True
+    # whole points, as many as fit in 8MB
+    assert options["row_group_size"] % N_TIME == 0
+    assert options["row_group_size"] > N_POINTS * N_TIME
+
+    layout = ParquetLayout(
+        compression="zstd",
+        compression_level=9,
+        column_compression={"time": "snappy"},
+        dictionary=COORDINATES,
+        byte_stream_split=True,
+    )
+    options = layout.write_options(table, N_TIME)
+    assert options["compression"]["TS"] == "zstd"
+    assert options["compression"]["time"] == "snappy"
+    assert options["compression_level"] == 9
+    assert options["use_dictionary"] == list(COORDINATES)
+    assert options["use_byte_stream_split"] == ["TS", "PS"]
+
+    assert "row_group_size" not in ParquetLayout(
+        row_group_megabytes=None
+    ).write_options(table, N_TIME)
+
+    with pytest.raises(ValueError):
+        ParquetLayout(column_encoding={"PS": "DELTA_BINARY_PACKED"})
+
+
+@pytest.mark.parametrize(
+    "layout",
+    [
+        ParquetLayout(),
+        ParquetLayout(row_group_megabytes=0),
+        ParquetLayout(row_group_megabytes=N_TIME * 5 * 30 / 2**20),
+        ParquetLayout(
+            compression="zstd", dictionary=COORDINATES, byte_stream_split=True
+        ),
+        ParquetLayout(
+            compression="lz4",
+            dictionary=False,
+            column_encoding={"PS": "DELTA_BINARY_PACKED", "TS": "BYTE_STREAM_SPLIT"},
+        ),
+    ],
+)
+def test_write(tmp_path, layout):
+    table = grid_table()
+    path = tmp_path / "part.0.parquet"
+    layout.write(table, path, N_TIME)
+    assert pq.read_table(path).equals(table)
+
+    # row groups hold whole grid points
+    metadata = pq.ParquetFile(path).metadata
+    sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    assert all(size % N_TIME == 0 for size in sizes)
+    if layout.row_group_megabytes == 0:
+        assert sizes == [N_TIME] * N_POINTS
@@ -0,0 +1,302 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# file in the parquet directory. Starts with an underscore so parquet readers skip it
+SPATIAL_INDEX = "_spatial_index.json"
+
+# MERRA-2 grid spacing in degrees
+LAT_STEP, LON_STEP = 0.5, 0.625
+
+Time = Union[str, np.datetime64, pd.Timestamp]
+
+
+def _datetime64(value: Optional[Time]) -> Optional[np.datetime64]:
+    return None if value is None else np.datetime64(pd.Timestamp(value), "us")
+
+
+class SpatialIndex(object):
+    def __init__(
+        self, lat: Sequence[float], lon: Sequence[float], files: Sequence[Dict]
+    ) -> None:
+        """Map from each grid point to the parquet files, row groups and rows holding its time series, so a reader can fetch one point without scanning the directory. Written by merra_etl next to its parquet output (see SPATIAL_INDEX) and read by ParquetReader.
+
+        Grid points are numbered in row-major (lat, lon) order, as in merra_etl.spatial_tiles. Every file holds a contiguous range of points, each with the same number of rows (its time steps), in point then time order. For each file the index keeps that range, the rows per point, the number of rows in each row group and the file's time range, all read from parquet footers when the index is built. Memory is a few numbers per file, whatever the size of the data.
+
+        Parameters
+        ----------
+        lat : Sequence[float]
+            grid latitudes, ascending
+        lon : Sequence[float]
+            grid longitudes, ascending
+        files : Sequence[Dict]
+            per file: 'name', 'start' and 'stop' (flattened grid point range), 'rows_per_point', 'row_groups' (rows in each row group) and 'time' (first and last time as ISO strings, or None)
+        """
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.files = list(files)
+
+    @classmethod
+    def from_parts(
+        cls,
+        lat: Sequence[float],
+        lon: Sequence[float],
+        parts: Iterable[Tuple[Path, int, int]],
+    ) -> "SpatialIndex":
+        """Build the index of parquet files from their footers.
+
+        Parameters
+        ----------
+        lat : Sequence[float]
+            grid latitudes, ascending
+        lon : Sequence[float]
+            grid longitudes, ascending
+        parts : Iterable[Tuple[Path, int, int]]
+            each parquet file with the range of flattened grid point indices it holds, as returned by merra_etl's writers
+        """
+        files = []
+        for path, start, stop in parts:
+            metadata = pq.read_metadata(path)
+            row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+            time_column = metadata.schema.names.index("time")
+            stats = [group.column(time_column).statistics for group in row_groups]
+            if stats and all(s is not None and s.has_min_max for s in stats):
+                time = [
+                    str(min(_datetime64(s.min) for s in stats)),
+                    str(max(_datetime64(s.max) for s in stats)),
+                ]
+            else:
+                time = None
+            files.append(
+                {
+                    "name": Path(path).name,
+                    "start": int(start),
+                    "stop": int(stop),
+                    "rows_per_point": metadata.num_rows // (stop - start),
+                    "row_groups": [group.num_rows for group in row_groups],
+                    "time": time,
+                }
+            )
+        return cls(lat, lon, files)
+
+    @classmethod
+    def load(cls, dir_out: Union[str, Path]) -> "SpatialIndex":
+        """Read the index of a parquet directory written by merra_etl"""
+        index = json.loads((Path(dir_out) / SPATIAL_INDEX).read_text())
+        return cls(index["lat"], index["lon"], index["files"])
+
+    def save(self, dir_out: Union[str, Path]) -> None:
+        """Write the index into its parquet directory. Written to a temporary file first, then atomically renamed over the old index."""
+        path = Path(dir_out) / SPATIAL_INDEX
+        tmp_path = path.with_name(path.name + ".tmp")
+        index = {
+            "lat": self.lat.tolist(),
+            "lon": self.lon.tolist(),
+            "files": self.files,
+        }
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, path)
+
+    def nearest_point(self, lat: float, lon: float) -> int:
+        """Flattened index of the grid point nearest to (lat, lon)
+
+        Raises
+        ------
+        ValueError
+            When (lat, lon) is more than half a grid cell outside the grid
+        """
+        if not (
+            self.lat[0] - LAT_STEP / 2 <= lat <= self.lat[-1] + LAT_STEP / 2
+            and self.lon[0] - LON_STEP / 2 <= lon <= self.lon[-1] + LON_STEP / 2
+        ):
+            raise ValueError(
+                f"({lat}, {lon}) is outside the grid, lat [{self.lat[0]}, {self.lat[-1]}] and lon [{self.lon[0]}, {self.lon[-1]}]"
+            )
+        i = int(np.abs(self.lat - lat).argmin())
+        j = int(np.abs(self.lon - lon).argmin())
+        return i * len(self.lon) + j
+
+    def bbox_points(
+        self, lat_interval: Tuple[float, float], lon_interval: Tuple[float, float]
+    ) -> np.ndarray:
+        """Flattened indices, ascending, of grid points with lat and lon inside the closed intervals"""
+        lat = np.flatnonzero(
+            (self.lat >= lat_interval[0]) & (self.lat <= lat_interval[1])
+        )
+        lon = np.flatnonzero(
+            (self.lon >= lon_interval[0]) & (self.lon <= lon_interval[1])
+        )
+        return np.add.outer(lat * len(self.lon), lon).reshape(-1)
+
+    def locate(
+        self,
+        points: np.ndarray,
+        start: Optional[Time] = None,
+        end: Optional[Time] = None,
+    ) -> List[Tuple[str, List[int], np.ndarray]]:
+        """Where the rows of the given grid points are stored.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            flattened grid point indices, ascending
+        start : Optional[Time], optional
+            skip files that end before start, by default None
+        end : Optional[Time], optional
+            skip files that start at or after end, by default None
+
+        Returns
+        -------
+        List[Tuple[str, List[int], np.ndarray]]
+            per file holding any of the points: its name, the row groups to read, and the points' rows within the table those row groups make
+        """
+        start, end = _datetime64(start), _datetime64(end)
+        found = []
+        for entry in self.files:
+            if entry["time"] is not None and (
+                (start is not None and np.datetime64(entry["time"][1]) < start)
+                or (end is not None and np.datetime64(entry["time"][0]) >= end)
+            ):
+                continue
+            first, last = np.searchsorted(points, [entry["start"], entry["stop"]])
+            if first == last:
+                continue
+            per_point = entry["rows_per_point"]
+            rows = (
+                (points[first:last, None] - entry["start"]) * per_point
+                + np.arange(per_point)
+            ).reshape(-1)
+            group_starts = np.cumsum([0] + entry["row_groups"])
+            groups = np.searchsorted(group_starts, rows, side="right") - 1
+            wanted = np.unique(groups)
+            # where each wanted row group starts in the table they're read into
+            offsets = np.zeros(len(group_starts) - 1, dtype=np.int64)
+            offsets[wanted] = np.cumsum(
+                [0] + [entry["row_groups"][g] for g in wanted[:-1]]
+            )
+            local = rows - group_starts[groups] + offsets[groups]
+            found.append((entry["name"], wanted.tolist(), local))
+        return found
+
+
+class ParquetReader(object):
+    def __init__(self, dir_out: Union[str, Path]) -> None:
+        """Point and bounding box queries on a parquet directory written by merra_etl, reading only the row groups and columns needed through its SpatialIndex. A single point's series is typically one row group per file, so a query takes milliseconds however large the directory is. Reuse a reader for many queries: the index and parquet footers are loaded once.
+
+        Parameters
+        ----------
+        dir_out : Union[str, Path]
+            directory written by merra_nc4_to_parquet, append_nc4_to_parquet or merra_buffers_to_parquet
+
+        Example
+        -------
+        reader = ParquetReader(Path('./data/parquet'))
+        reader.read_point(39.74, -105.18, '2020-01-01', '2021-01-01', ['WS50M', 'WDIR50M'])
+        """
+        self.dir_out = Path(dir_out)
+        self.index = SpatialIndex.load(self.dir_out)
+        self._metadata: Dict[str, pq.FileMetaData] = {}
+
+    def _read(
+        self,
+        points: np.ndarray,
+        start: Optional[Time],
+        end: Optional[Time],
+        variables: Optional[Sequence[str]],
+    ) -> pd.DataFrame:
+        columns = None if variables is None else ["lat", "lon", "time", *variables]
+        tables = []
+        for name, row_groups, rows in self.index.locate(points, start, end):
+            if name not in self._metadata:
+                self._metadata[name] = pq.read_metadata(self.dir_out / name)
+            with pq.ParquetFile(
+                self.dir_out / name, metadata=self._metadata[name]
+            ) as parquet_file:
+                table = parquet_file.read_row_groups(row_groups, columns=columns)
+            tables.append(table.take(rows))
+        if not tables:
+            if columns is None:
+                columns = pq.read_schema(
+                    self.dir_out / self.index.files[0]["name"]
+                ).names
+            return pd.DataFrame(columns=columns)
+        table = pa.concat_tables(tables)
+        time = table["time"].to_numpy()
+        mask = np.ones(len(time), dtype=bool)
+        if start is not None:
+            mask &= time >= _datetime64(start)
+        if end is not None:
+            mask &= time < _datetime64(end)
+        df = table.filter(pa.array(mask)).to_pandas()
+        if len(tables) > 1:  # appended batches each hold part of the series
+            df = df.sort_values(["lat", "lon", "time"], ignore_index=True)
+        return df
+
+    def read_point(
+        self,
+        lat: float,
+        lon: float,
+        start: Optional[Time] = None,
+        end: Optional[Time] = None,
+        variables: Optional[Sequence[str]] = None,
+    ) -> pd.DataFrame:
+        """Time series of the grid point nearest to (lat, lon).
+
+        Parameters
+        ----------
+        lat : float
+            latitude in degrees
+        lon : float
+            longitude in degrees
+        start : Optional[Time], optional
+            first time to include, by default None for the start of the data
+        end : Optional[Time], optional
+            time to stop before, by default None for the end of the data
+        variables : Optional[Sequence[str]], optional
+            columns to read besides lat, lon and time, by default None for all
+
+        Returns
+        -------
+        pd.DataFrame
+            rows in time order, with lat, lon and time columns and the variables
+
+        Raises
+        ------
+        ValueError
+            When (lat, lon) is outside the grid
+        """
+        point = self.index.nearest_point(lat, lon)
+        return self._read(np.array([point]), start, end, variables)
+
+    def read_bbox(
+        self,
+        lat_interval: Tuple[float, float],
+        lon_interval: Tuple[float, float],
+        start: Optional[Time] = None,
+        end: Optional[Time] = None,
+        variables: Optional[Sequence[str]] = None,
+    ) -> pd.DataFrame:
+        """Time series of all grid points inside a bounding box.
+
+        Parameters
+        ----------
+        lat_interval : Tuple[float, float]
+            (min, max) latitude, inclusive
+        lon_interval : Tuple[float, float]
+            (min, max) longitude, inclusive
+        start, end, variables
+            as in read_point
+
+        Returns
+        -------
+        pd.DataFrame
+            rows in lat, lon and then time order
+        """
+        points = self.index.bbox_points(lat_interval, lon_interval)
+        return self._read(points, start, end, variables)
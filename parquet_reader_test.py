@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import merra_etl
+from parquet_layout import ParquetLayout
+from parquet_reader import SPATIAL_INDEX, ParquetReader, SpatialIndex
+
+
+def expected_rows(df, lat, lon, start=None, end=None):
+    rows = df[(df["lat"] == lat) & (df["lon"] == lon)]
+    if start is not None:
+        rows = rows[rows["time"] >= pd.Timestamp(start)]
+    if end is not None:
+        rows = rows[rows["time"] < pd.Timestamp(end)]
+    return rows.reset_index(drop=True)
+
+
+def test_read_point(tmp_path, write_daily_files, read_sorted):
+    files = write_daily_files(tmp_path / "nc4")
+    out = tmp_path / "parquet"
+    # several files, several row groups in each
+    layout = ParquetLayout(row_group_megabytes=0.01)
+    merra_etl.merra_nc4_to_parquet(
+        files, out, max_megabytes_per_file=0.05, memory_budget_mb=0.2, layout=layout
+    )
+    index = SpatialIndex.load(out)
+    assert len(index.files) > 1 and max(len(f["row_groups"]) for f in index.files) > 1
+    df = read_sorted(out)
+    reader = ParquetReader(out)
+
+    lat, lon = df["lat"].iloc[-1], df["lon"].iloc[-1]
+    point = reader.read_point(lat + 0.2, lon - 0.3)  # nearest grid point
+    pd.testing.assert_frame_equal(
+        point.reindex(columns=df.columns), expected_rows(df, lat, lon)
+    )
+    point = reader.read_point(lat, lon, "2020-01-02", "2020-01-03 12:00", ["TS"])
+    assert list(point.columns) == ["lat", "lon", "time", "TS"]
+    expected = expected_rows(df, lat, lon, "2020-01-02", "2020-01-03 12:00")
+    assert len(point) == 36
+    pd.testing.assert_frame_equal(point, expected[point.columns])
+    assert reader.read_point(lat, lon, "2021-01-01").empty
+
+    box = reader.read_bbox((27, 28.5), (-99, -97), variables=["TS", "PS"])
+    inside = df[df["lat"].between(27, 28.5) & df["lon"].between(-99, -97)]
+    assert len(inside) > 0
+    pd.testing.assert_frame_equal(box, inside[box.columns].reset_index(drop=True))
+
+    with pytest.raises(ValueError):
+        reader.read_point(0, 0)
+
+
+def test_read_appended(tmp_path, write_daily_files, read_sorted):
+    files = write_daily_files(tmp_path / "nc4")
+    out = tmp_path / "parquet"
+    first_two = [f for f in files if any(f".2020010{d}." in f.name for d in "12")]
+    merra_etl.append_nc4_to_parquet(
+        first_two, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+    )
+    merra_etl.append_nc4_to_parquet(
+        files, out, memory_budget_mb=0.2, max_megabytes_per_file=0.02
+    )
+    df = read_sorted(out)
+    lat, lon = df["lat"].iloc[0], df["lon"].iloc[0]
+    for compact in (False, True):
+        if compact:
+            merra_etl.compact_parquet(out)
+        reader = ParquetReader(out)
+        pd.testing.assert_frame_equal(
+            reader.read_point(lat, lon).reindex(columns=df.columns),
+            expected_rows(df, lat, lon),
+        )
+        # later days are only in the second batch
+        located = reader.index.locate(
+            np.array([reader.index.nearest_point(lat, lon)]), start="2020-01-03"
+        )
+        assert len(located) == 1
+
+    # in-memory conversion is indexed too
+    merra_etl.merra_buffers_to_parquet(
+        [f.read_bytes() for f in files],
+        tmp_path / "memory",
+        max_megabytes_per_file=0.05,
+    )
+    assert (tmp_path / "memory" / SPATIAL_INDEX).exists()
+    pd.testing.assert_frame_equal(
+        ParquetReader(tmp_path / "memory")
+        .read_point(lat, lon)
+        .reindex(columns=df.columns),
+        expected_rows(df, lat, lon),
+    )
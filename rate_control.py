@@ -0,0 +1,204 @@
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+# failure reasons that indicate the server is overloaded, rather than e.g. a bad URL
+CONGESTION_SIGNALS = frozenset([429, 502, 503, 504, "timeout", "connection_error"])
+
+
+def check_limits(max_at_once: int, max_per_second: float) -> None:
+    """Raise ValueError unless at least one request may be in flight and the rate is positive"""
+    if max_at_once < 1:
+        raise ValueError(f"max_at_once must be at least 1; given {max_at_once}")
+    if max_per_second <= 0:
+        raise ValueError(f"max_per_second must be positive; given {max_per_second}")
+
+
+class FixedController(object):
+    def __init__(self, max_at_once: int = 10, max_per_second: float = 3.0) -> None:
+        """Static concurrency and rate limits. Equivalent to passing max_at_once and max_per_second to aiometer.
+
+        Parameters
+        ----------
+        max_at_once : int, optional
+            Max concurrent connections, by default 10
+        max_per_second : float, optional
+            Max rate of new connections, by default 3.0
+
+        Raises
+        ------
+        ValueError
+            When max_at_once is below 1 or max_per_second isn't positive
+        """
+        check_limits(max_at_once, max_per_second)
+        self.max_at_once = max_at_once
+        self.max_per_second = max_per_second
+
+    def record(self, outcome: Optional[Union[int, str]], latency: float) -> None:
+        """Report the result of a request. Ignored by FixedController.
+
+        Parameters
+        ----------
+        outcome : Optional[Union[int, str]]
+            None for success, else the failure reason used as a key in AsyncDownloader.failed_downloads
+        latency : float
+            Seconds from request start until the response was fully read or failed
+        """
+        pass
+
+    def metrics(self) -> Dict[str, float]:
+        return {"max_at_once": self.max_at_once, "max_per_second": self.max_per_second}
+
+
+class AIMDController(FixedController):
+    def __init__(
+        self,
+        initial_at_once: int = 4,
+        initial_per_second: float = 2.0,
+        min_at_once: int = 1,
+        max_at_once: int = 50,
+        min_per_second: float = 0.2,
+        max_per_second: float = 20.0,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.2,
+    ) -> None:
+        """Additive increase, multiplicative decrease (AIMD) concurrency and rate limits, as in TCP congestion control.
+
+        Limits grow by additive_increase once per 'round' (one round is max_at_once completed requests, roughly one round trip time) while no congestion signals are seen and latency stays within latency_tolerance times the best latency seen so far. On a congestion signal (429, 502, 503, 504, timeout or connection error), limits are multiplied by multiplicative_decrease. Only one decrease is applied per round, so a burst of failures from requests that were already in flight doesn't collapse the limits to their minimum.
+
+        Parameters
+        ----------
+        initial_at_once : int, optional
+            Starting concurrency limit, by default 4
+        initial_per_second : float, optional
+            Starting rate limit, by default 2.0
+        min_at_once : int, optional
+            Floor for concurrency limit, by default 1
+        max_at_once : int, optional
+            Ceiling for concurrency limit, by default 50
+        min_per_second : float, optional
+            Floor for rate limit, by default 0.2
+        max_per_second : float, optional
+            Ceiling for rate limit, by default 20.0
+        additive_increase : float, optional
+            Amount added to both limits per healthy round, by default 1.0
+        multiplicative_decrease : float, optional
+            Factor applied to both limits on congestion, by default 0.5
+        latency_tolerance : float, optional
+            Latency is 'healthy' if its moving average is below this multiple of the lowest moving average seen, by default 2.0
+        smoothing : float, optional
+            Weight of each new observation in the exponential moving average of latency, by default 0.2
+
+        Example
+        -------
+        controller = AIMDController(initial_at_once=2, max_at_once=20)
+        downloader = AsyncDownloader(Path('./data/'), controller=controller)
+        asyncio.run(downloader.download(urls))
+        print(controller.metrics())
+
+        Raises
+        ------
+        ValueError
+            When a limit's floor is below 1 request at once or isn't a positive rate, a floor is above its ceiling, or multiplicative_decrease isn't in (0, 1)
+        """
+        # limits never go below their floors, so checking those covers every limit
+        check_limits(min_at_once, min_per_second)
+        if min_at_once > max_at_once or min_per_second > max_per_second:
+            raise ValueError(
+                f"limits' floors must not exceed their ceilings; given at once [{min_at_once}, {max_at_once}] and per second [{min_per_second}, {max_per_second}]"
+            )
+        if not 0 < multiplicative_decrease < 1:
+            raise ValueError(
+                f"multiplicative_decrease must be in (0, 1); given {multiplicative_decrease}"
+            )
+        self._min_at_once = min_at_once
+        self._ceil_at_once = max_at_once
+        self._min_per_second = min_per_second
+        self._ceil_per_second = max_per_second
+        self._increase = additive_increase
+        self._decrease = multiplicative_decrease
+        self._latency_tolerance = latency_tolerance
+        self._smoothing = smoothing
+
+        # tracked as floats so fractional increases accumulate; exposed as int
+        self._at_once = float(min(max(initial_at_once, min_at_once), max_at_once))
+        self.max_per_second = min(
+            max(initial_per_second, min_per_second), max_per_second
+        )
+
+        self.latency_ewma: Optional[float] = None
+        self.best_latency_ewma: Optional[float] = None
+        self.n_increases = 0
+        self.n_decreases = 0
+        self._round_completed = 0
+        self._round_length = self.max_at_once
+        self._round_congested = False
+        self.history: List[Tuple[float, int, float]] = [
+            (time.monotonic(), self.max_at_once, self.max_per_second)
+        ]
+
+    @property
+    def max_at_once(self) -> int:  # type: ignore[override]
+        return int(self._at_once)
+
+    def _latency_healthy(self) -> bool:
+        if self.latency_ewma is None or self.best_latency_ewma is None:
+            return True
+        return self.latency_ewma <= self._latency_tolerance * self.best_latency_ewma
+
+    def _update_latency(self, latency: float) -> None:
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += self._smoothing * (latency - self.latency_ewma)
+        if self.best_latency_ewma is None or self.latency_ewma < self.best_latency_ewma:
+            self.best_latency_ewma = self.latency_ewma
+
+    def _set_limits(self, at_once: float, per_second: float) -> None:
+        self._at_once = min(max(at_once, self._min_at_once), self._ceil_at_once)
+        self.max_per_second = min(
+            max(per_second, self._min_per_second), self._ceil_per_second
+        )
+        self.history.append((time.monotonic(), self.max_at_once, self.max_per_second))
+
+    def record(self, outcome: Optional[Union[int, str]], latency: float) -> None:
+        congested = outcome in CONGESTION_SIGNALS
+        if outcome is None:
+            self._update_latency(latency)
+
+        if congested and not self._round_congested:
+            self._round_congested = True
+            self.n_decreases += 1
+            # requests already in flight were started under the old limit
+            self._round_length = self.max_at_once
+            self._set_limits(
+                self._at_once * self._decrease, self.max_per_second * self._decrease
+            )
+            self._round_completed = 0
+            return
+
+        self._round_completed += 1
+        if self._round_completed < self._round_length:
+            return
+        # end of round
+        if not self._round_congested and self._latency_healthy():
+            self.n_increases += 1
+            self._set_limits(
+                self._at_once + self._increase, self.max_per_second + self._increase
+            )
+        self._round_completed = 0
+        self._round_length = self.max_at_once
+        self._round_congested = False
+
+    def metrics(self) -> Dict[str, float]:
+        out = super().metrics()
+        out.update(
+            {
+                "latency_ewma": self.latency_ewma or 0.0,
+                "best_latency_ewma": self.best_latency_ewma or 0.0,
+                "increases": self.n_increases,
+                "decreases": self.n_decreases,
+            }
+        )
+        return out
@@ -0,0 +1,84 @@
+import pytest
+
+from async_downloader import AsyncDownloader
+from rate_control import AIMDController, FixedController
+from sharded_downloader import ShardedDownloader
+
+
+def test_fixed_controller():
+    controller = FixedController(max_at_once=5, max_per_second=2.0)
+    controller.record(503, 1.0)
+    assert controller.max_at_once == 5
+    assert controller.max_per_second == 2.0
+
+
+def test_aimd_increase():
+    controller = AIMDController(initial_at_once=2, initial_per_second=1.0)
+    for _ in range(2):  # one full round of successes
+        controller.record(None, 1.0)
+    assert controller.max_at_once == 3
+    assert controller.max_per_second == 2.0
+    assert controller.n_increases == 1
+
+
+def test_aimd_decrease_once_per_round():
+    controller = AIMDController(initial_at_once=8, initial_per_second=4.0)
+    for _ in range(8):  # burst of failures from requests already in flight
+        controller.record(503, 1.0)
+    assert controller.max_at_once == 4
+    assert controller.max_per_second == 2.0
+    assert controller.n_decreases == 1
+
+    # 404 is not a congestion signal
+    controller.record(404, 1.0)
+    assert controller.n_decreases == 1
+
+
+def test_aimd_bounds():
+    controller = AIMDController(
+        initial_at_once=2, min_at_once=2, max_at_once=3, min_per_second=1.0
+    )
+    for _ in range(10):
+        controller.record("timeout", 1.0)
+        controller.record(None, 1.0)
+        controller.record(None, 1.0)
+    assert controller.max_at_once == 2
+    assert controller.max_per_second == 1.0
+    for _ in range(20):
+        controller.record(None, 1.0)
+    assert controller.max_at_once == 3
+
+
+def test_aimd_latency_holds_increase():
+    controller = AIMDController(initial_at_once=1, smoothing=1.0)
+    controller.record(None, 1.0)
+    assert controller.max_at_once == 2
+    controller.record(None, 10.0)  # latency degraded well beyond tolerance
+    controller.record(None, 10.0)
+    assert controller.max_at_once == 2
+
+
+@pytest.mark.parametrize(
+    "max_at_once, max_per_second", [(0, 1.0), (-1, 1.0), (1, 0.0), (1, -2.0)]
+)
+def test_invalid_limits(max_at_once, max_per_second):
+    with pytest.raises(ValueError):
+        FixedController(max_at_once, max_per_second)
+    with pytest.raises(ValueError):
+        AIMDController(min_at_once=max_at_once, min_per_second=max_per_second)
+    with pytest.raises(ValueError):
+        AsyncDownloader(".", max_at_once=max_at_once, max_per_second=max_per_second)
+    with pytest.raises(ValueError):
+        ShardedDownloader(".", max_at_once=max_at_once, max_per_second=max_per_second)
+
+
+def test_aimd_floor_above_ceiling():
+    with pytest.raises(ValueError):
+        AIMDController(min_at_once=10, max_at_once=5)
+    with pytest.raises(ValueError):
+        AIMDController(min_per_second=5.0, max_per_second=1.0)
+
+
+def test_aimd_invalid_decrease():
+    with pytest.raises(ValueError):
+        AIMDController(multiplicative_decrease=1.5)
@@ -0,0 +1,103 @@
+import random
+import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Union
+
+
+def parse_retry_after(
+    value: Optional[str], now: Optional[datetime.datetime] = None
+) -> Optional[float]:
+    """Parse an HTTP Retry-After header, which is either a number of seconds or an HTTP date.
+
+    Parameters
+    ----------
+    value : Optional[str]
+        header value, such as '120' or 'Wed, 21 Oct 2015 07:28:00 GMT'
+    now : Optional[datetime.datetime], optional
+        current time (timezone aware) to measure HTTP dates against, by default None for the current UTC time
+
+    Returns
+    -------
+    Optional[float]
+        seconds to wait, or None if value is missing or malformed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return max((when - now).total_seconds(), 0.0)
+
+
+class RetryPolicy(object):
+    def __init__(
+        self,
+        retries: int = 1,
+        budgets: Optional[Dict[Union[int, str], int]] = None,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_retry_after: float = 300.0,
+        rng: Optional[random.Random] = None,
+    ) -> None:
+        """When and how often to retry each failed URL. Delays use 'full jitter' exponential backoff: a uniform random delay in [0, min(max_delay, base_delay * 2**attempt)], so failures that happened together don't retry together. A server's Retry-After header takes precedence over the backoff delay.
+
+        Parameters
+        ----------
+        retries : int, optional
+            Default number of retries per URL, by default 1
+        budgets : Optional[Dict[Union[int, str], int]], optional
+            Retries per URL for specific failure reasons, overriding retries. Keys are the same reasons used in AsyncDownloader.failed_downloads, e.g. {404: 0, 503: 5, 'timeout': 3, 'connection_error': 3}. By default None
+        base_delay : float, optional
+            Backoff delay scale in seconds, by default 1.0
+        max_delay : float, optional
+            Upper bound on backoff delay in seconds, by default 60.0
+        max_retry_after : float, optional
+            Upper bound on delays requested by Retry-After headers in seconds, by default 300.0
+        rng : Optional[random.Random], optional
+            Random number generator for jitter, by default None for a new unseeded generator
+        """
+        self.retries = retries
+        self.budgets = dict(budgets) if budgets else {}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self._rng = rng if rng is not None else random.Random()
+
+    def budget(self, reason: Union[int, str]) -> int:
+        return self.budgets.get(reason, self.retries)
+
+    def should_retry(self, reason: Union[int, str], attempt: int) -> bool:
+        """attempt is the number of the attempt that just failed, starting at 0"""
+        return attempt < self.budget(reason)
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait before the next attempt.
+
+        Parameters
+        ----------
+        attempt : int
+            number of the attempt that just failed, starting at 0
+        retry_after : Optional[float], optional
+            seconds requested by the server's Retry-After header, by default None
+
+        Returns
+        -------
+        float
+            delay in seconds
+        """
+        if retry_after is not None:
+            # small jitter so many URLs told the same Retry-After don't all return at once
+            return min(retry_after, self.max_retry_after) + self._rng.uniform(
+                0, self.base_delay
+            )
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
@@ -0,0 +1,31 @@
+import random
+import datetime
+
+from retry_policy import RetryPolicy, parse_retry_after
+
+
+def test_parse_retry_after():
+    now = datetime.datetime(2015, 10, 21, 7, 27, 0, tzinfo=datetime.timezone.utc)
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=now) == 60.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:26:00 GMT", now=now) == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+def test_budgets():
+    policy = RetryPolicy(retries=2, budgets={404: 0, "timeout": 4})
+    assert [policy.should_retry(503, i) for i in range(3)] == [True, True, False]
+    assert not policy.should_retry(404, 0)
+    assert policy.should_retry("timeout", 3)
+    assert not policy.should_retry("timeout", 4)
+
+
+def test_delay():
+    policy = RetryPolicy(base_delay=1.0, max_delay=10.0, rng=random.Random(0))
+    for attempt in range(8):
+        delays = [policy.delay(attempt) for _ in range(100)]
+        assert 0 <= min(delays)
+        assert max(delays) <= min(10.0, 2**attempt)
+    assert 30.0 <= policy.delay(0, retry_after=30.0) <= 31.0
+    assert policy.delay(0, retry_after=1e6) <= policy.max_retry_after + 1.0
@@ -0,0 +1,116 @@
+import asyncio
+import contextlib
+import os
+import time
+from http.cookiejar import LWPCookieJar
+from pathlib import Path
+from typing import AsyncIterator, Iterator, Optional, Union
+
+import httpx
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None  # type: ignore
+
+DEFAULT_PATH = Path.home() / ".cache" / "merra2" / "earthdata_session.lwp"
+
+
+class SessionStore(object):
+    def __init__(
+        self,
+        path: Union[str, Path, None] = None,
+        max_age: float = 8 * 3600.0,
+    ) -> None:
+        """Earthdata Login session cookies persisted between runs, so AsyncDownloader can skip its serial login request and start concurrent downloads immediately. Processes on the same host that use the same path share one session.
+
+        Cookies are stored in an LWP cookie file readable only by the current user, written atomically. A stored session is treated as invalid once any cookie has expired, or once the file is older than max_age, which covers session cookies sent without an expiry. A session that the server rejects early is refreshed by the normal login redirect, and the refreshed cookies are saved at the end of the run.
+
+        Parameters
+        ----------
+        path : Union[str, Path, None], optional
+            cookie file, by default None for $MERRA2_SESSION_FILE or ~/.cache/merra2/earthdata_session.lwp
+        max_age : float, optional
+            seconds a stored session is trusted, by default 8 hours
+
+        Example
+        -------
+        downloader = AsyncDownloader(Path('./data/'), session=SessionStore())
+        """
+        if path is None:
+            path = os.getenv("MERRA2_SESSION_FILE") or DEFAULT_PATH
+        self.path = Path(path)
+        self.max_age = max_age
+
+    def load(self) -> Optional[httpx.Cookies]:
+        """Stored cookies, or None if there is no valid stored session"""
+        try:
+            age = time.time() - self.path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if age > self.max_age:
+            return None
+        jar = LWPCookieJar()
+        try:
+            # expired cookies are dropped on load
+            jar.load(str(self.path), ignore_discard=True)
+        except (OSError, ValueError):  # LoadError is an OSError; corrupt file
+            return None
+        if not len(jar):
+            return None
+        return httpx.Cookies(jar)
+
+    def save(self, cookies: httpx.Cookies) -> None:
+        """Store cookies, replacing any stored session. Empty cookie jars are not stored."""
+        if not len(cookies.jar):
+            return
+        jar = LWPCookieJar()
+        for cookie in cookies.jar:
+            jar.set_cookie(cookie)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        # create with owner-only permissions before any secret is written
+        os.close(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+        jar.save(str(tmp_path), ignore_discard=True)
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _lock_path(self) -> Path:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return self.path.with_name(self.path.name + ".lock")
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[None]:
+        """Hold an exclusive lock across processes while reading or writing the stored session. Blocks until the lock is free, so don't use it on an event loop thread; see locked_async."""
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path(), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @contextlib.asynccontextmanager
+    async def locked_async(self, poll_interval: float = 0.05) -> AsyncIterator[None]:
+        """Same as locked, but waits for the lock without blocking the event loop: tries it without blocking and sleeps poll_interval seconds between tries. Keep the locked section short and free of network requests, since other processes poll for it meanwhile."""
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path(), "a") as f:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(poll_interval)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
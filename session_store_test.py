@@ -0,0 +1,115 @@
+import asyncio
+import stat
+import threading
+import time
+from datetime import datetime
+
+import httpx
+
+import merra_urls
+from async_downloader import AsyncDownloader
+from fake_opendap_server import SESSION_COOKIE, FakeOpendapServer
+from session_store import SessionStore
+
+URLS = list(
+    merra_urls.url_generator(
+        time_interval=(datetime(2020, 3, 1), datetime(2020, 3, 6)),
+        lat_interval=(26, 37),
+        lon_interval=(-107, -93),
+        collections=[
+            {
+                "collection": "tavg1_2d_slv_Nx",
+                "short_name": "M2T1NXSLV",
+                "fields": ["PS", "T10M"],
+            }
+        ],
+    )
+)
+
+
+def _download(server, directory, store):
+    downloader = AsyncDownloader(directory, max_per_second=100, session=store)
+    asyncio.run(downloader.download(server.localize_all(URLS)))
+    assert not downloader.failed_downloads
+    return downloader
+
+
+def test_session_is_reused(tmp_path, monkeypatch):
+    monkeypatch.setenv("MERRA2_USER", "user")
+    monkeypatch.setenv("MERRA2_PASS", "pass")
+    store = SessionStore(tmp_path / "session.lwp")
+    with FakeOpendapServer(require_auth=True) as server:
+        _download(server, tmp_path / "a", store)
+        assert server.stats[302] == 3  # one login
+        assert stat.S_IMODE(store.path.stat().st_mode) == 0o600
+        cookies = store.load()
+        assert cookies is not None and SESSION_COOKIE in cookies
+
+        # a new downloader starts with the stored session and doesn't log in
+        _download(server, tmp_path / "b", store)
+        assert server.stats[302] == 3
+        assert len(list((tmp_path / "b").glob("*.nc4"))) == len(URLS)
+
+        # the server forgets the session: requests log in again and the new session is stored
+        server._sessions.clear()
+        _download(server, tmp_path / "c", store)
+        assert server.stats[302] > 3
+        assert store.load()[SESSION_COOKIE] != cookies[SESSION_COOKIE]  # type: ignore
+
+
+def test_expired_session_is_not_loaded(tmp_path):
+    store = SessionStore(tmp_path / "session.lwp")
+    assert store.load() is None
+    with FakeOpendapServer(require_auth=True, session_lifetime=2) as server:
+        with httpx.Client(auth=("user", "pass"), follow_redirects=True) as client:
+            client.get(server.localize(URLS[0]))
+            assert SESSION_COOKIE in client.cookies
+            store.save(client.cookies)
+    assert store.load() is not None
+    assert SessionStore(store.path, max_age=0).load() is None
+    time.sleep(2.1)
+    assert store.load() is None  # cookie's Max-Age has passed
+
+    store.path.write_text("not a cookie file")
+    assert store.load() is None
+    store.clear()
+    assert not store.path.exists()
+
+
+def test_lock_does_not_block_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setenv("MERRA2_USER", "user")
+    monkeypatch.setenv("MERRA2_PASS", "pass")
+    store = SessionStore(tmp_path / "session.lwp")
+    held, release = threading.Event(), threading.Event()
+
+    def hold_lock():  # like another process starting at the same time
+        with store.locked():
+            held.set()
+            release.wait()
+
+    async def run(downloader, urls):
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        beat = asyncio.ensure_future(heartbeat())
+        await downloader.download(urls)
+        beat.cancel()
+        return ticks
+
+    with FakeOpendapServer(require_auth=True) as server:
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        held.wait()
+        threading.Timer(0.5, release.set).start()
+        downloader = AsyncDownloader(tmp_path / "a", max_per_second=100, session=store)
+        ticks = asyncio.run(run(downloader, list(server.localize_all(URLS))))
+        holder.join()
+        # the loop kept running while the lock was held elsewhere
+        assert ticks > 20
+        assert not downloader.failed_downloads
+        assert store.load() is not None
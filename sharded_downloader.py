@@ -0,0 +1,316 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, Iterable, List, Optional, Tuple, Union
+
+from async_downloader import AsyncDownloader, log_failures
+from download_manifest import DownloadManifest
+from download_metrics import DownloadMetrics
+from download_plan import schedule_urls
+from rate_control import check_limits
+
+
+class SharedBudget(object):
+    def __init__(
+        self,
+        max_at_once: int,
+        max_per_second: float,
+        context=None,
+        poll_interval: float = 0.005,
+        n_shards: int = 1,
+    ) -> None:
+        """Concurrency and rate limits shared by downloaders in several processes, kept in shared memory. Pass to each AsyncDownloader's budget argument. Must be handed to worker processes when they are created, e.g. as multiprocessing.Process args.
+
+        Slots are counted per shard as well, so the slots of a worker that died without releasing them (e.g. killed by the OOM killer) can be given back with reclaim. Each worker sets its budget's shard before using it.
+
+        Parameters
+        ----------
+        max_at_once : int
+            max requests in flight across all processes
+        max_per_second : float
+            max request starts per second across all processes
+        context : optional
+            multiprocessing context for the shared values, by default None for the default context
+        poll_interval : float, optional
+            seconds between checks for a free slot while the budget is exhausted, by default 0.005
+        n_shards : int, optional
+            number of workers sharing the budget, by default 1
+        """
+        check_limits(max_at_once, max_per_second)
+        context = context or multiprocessing.get_context()
+        self.max_at_once = max_at_once
+        self.max_per_second = max_per_second
+        self.poll_interval = poll_interval
+        self._in_flight = context.Value("i", 0)
+        # guarded by _in_flight's lock
+        self._shard_in_flight = context.Array("i", n_shards, lock=False)
+        self.shard = 0
+        # time.monotonic is system-wide, so start times are comparable across processes
+        self._next_start = context.Value("d", 0.0)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight.value
+
+    async def acquire(self) -> None:
+        """Wait for a free request slot, then for the next start time the rate limit allows"""
+        while True:
+            with self._in_flight.get_lock():
+                if self._in_flight.value < self.max_at_once:
+                    self._in_flight.value += 1
+                    self._shard_in_flight[self.shard] += 1
+                    break
+            await asyncio.sleep(self.poll_interval)
+        with self._next_start.get_lock():
+            now = time.monotonic()
+            start = max(now, self._next_start.value)
+            self._next_start.value = start + 1 / self.max_per_second
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def release(self) -> None:
+        with self._in_flight.get_lock():
+            self._in_flight.value -= 1
+            self._shard_in_flight[self.shard] -= 1
+
+    def reclaim(self, shard: int) -> int:
+        """Free the slots held by a shard whose worker is dead. Returns the number of slots freed."""
+        with self._in_flight.get_lock():
+            held = self._shard_in_flight[shard]
+            self._in_flight.value -= held
+            self._shard_in_flight[shard] = 0
+        return held
+
+
+def _shard_manifest_name(manifest_name: str, shard: int) -> str:
+    return f"{Path(manifest_name).stem}.shard{shard}.jsonl"
+
+
+def _run_shard(
+    shard: int,
+    urls: List[str],
+    directory: Path,
+    budget: SharedBudget,
+    results,
+    downloader_kwargs: Dict,
+) -> None:
+    """Worker process: download urls with its own event loop and report failures and metrics"""
+    try:
+        budget.shard = shard
+        downloader = AsyncDownloader(directory, budget=budget, **downloader_kwargs)
+        downloader.write_failure_log = False
+        asyncio.run(downloader.download(urls))
+        results.put((shard, dict(downloader.failed_downloads), downloader.metrics))
+    except BaseException:
+        results.put((shard, traceback.format_exc(), None))
+
+
+class ShardedDownloader(object):
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        n_workers: Optional[int] = None,
+        max_at_once: int = 10,
+        max_per_second: float = 3.0,
+        manifest_name: Optional[str] = "manifest.jsonl",
+        metrics_name: str = "metrics.json",
+        schedule: Optional[str] = None,
+        poll_interval: float = 1.0,
+        **downloader_kwargs,
+    ) -> None:
+        """Split downloads across worker processes, each running its own AsyncDownloader event loop, so response handling, verification and file writes use several cores. Workers share one global concurrency and rate budget (SharedBudget), so the server sees the same load as from a single AsyncDownloader with the same limits.
+
+        Failures and metrics from all workers are combined into self.failed_downloads and self.metrics, and written to one fails_X.txt and one metrics file, as AsyncDownloader does. Each worker records its progress in its own manifest shard, which is merged into the main manifest when the run ends, or at the start of the next run if it was interrupted. A worker that dies without reporting (e.g. killed by the OOM killer) isn't waited for: its budget slots are given back to the other workers, and the URLs of its shard that aren't complete in its manifest shard are reported as failed.
+
+        Parameters
+        ----------
+        directory : Union[str, Path]
+            output directory
+        n_workers : Optional[int], optional
+            number of worker processes, by default None for os.cpu_count()
+        max_at_once : int, optional
+            max concurrent requests across all workers, by default 10
+        max_per_second : float, optional
+            max request rate across all workers, by default 3.0
+        manifest_name : Optional[str], optional
+            as in AsyncDownloader, by default "manifest.jsonl"
+        metrics_name : str, optional
+            as in AsyncDownloader. Workers write their own metrics to metrics.shardN.json alongside. By default "metrics.json"
+        schedule : Optional[str], optional
+            as in AsyncDownloader. URLs are ordered once and dealt round-robin to workers, by default None
+        poll_interval : float, optional
+            seconds between checks that workers are still alive while waiting for their results, by default 1.0
+        **downloader_kwargs
+            passed to each worker's AsyncDownloader. Must be picklable; sinks other than FileSink and on_complete callbacks aren't supported, since results stay in the worker processes.
+
+        Example
+        -------
+        downloader = ShardedDownloader(Path('./data/'), n_workers=4, max_at_once=20, session=SessionStore())
+        asyncio.run(downloader.download(urls))
+        """
+        check_limits(max_at_once, max_per_second)
+        sink = downloader_kwargs.get("sink")
+        if sink is not None and not sink.persistent:
+            raise ValueError("ShardedDownloader only supports FileSink")
+        if downloader_kwargs.get("on_complete") is not None:
+            raise ValueError("on_complete callbacks can't run in worker processes")
+        self.directory = Path(directory)
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.max_at_once = max_at_once
+        self.max_per_second = max_per_second
+        self.manifest_name = manifest_name
+        self.metrics_name = metrics_name
+        self.schedule = schedule
+        self.poll_interval = poll_interval
+        self.downloader_kwargs = downloader_kwargs
+        self.failed_downloads: DefaultDict[Union[int, str], List[str]] = defaultdict(
+            list
+        )
+        self.metrics = DownloadMetrics()
+
+    def _collect(
+        self, result: Tuple[int, Any, Optional[DownloadMetrics]], errors: List[str]
+    ) -> int:
+        """Add one worker's result to the run's failures and metrics. Returns its shard."""
+        shard, failed, metrics = result
+        if metrics is None:
+            errors.append(f"shard {shard}:\n{failed}")
+            return shard
+        for reason, url_list in failed.items():
+            self.failed_downloads[reason].extend(url_list)
+        self.metrics.merge(metrics)
+        return shard
+
+    def _merge_manifest_shards(self) -> Optional[DownloadManifest]:
+        if self.manifest_name is None:
+            return None
+        manifest = DownloadManifest(self.directory / self.manifest_name)
+        pattern = _shard_manifest_name(self.manifest_name, 0).replace(
+            "shard0", "shard*"
+        )
+        for shard_path in sorted(self.directory.glob(pattern)):
+            shard = DownloadManifest(shard_path)
+            for url in shard:
+                manifest.record(**shard.get(url))  # type: ignore
+            shard_path.unlink()
+        manifest.compact()
+        return manifest
+
+    async def download(self, urls: Iterable[str]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # each run reports only its own failures and metrics
+        self.failed_downloads = defaultdict(list)
+        self.metrics = DownloadMetrics()
+        manifest = self._merge_manifest_shards()
+        urls = [
+            url
+            for url in urls
+            if manifest is None or not manifest.is_complete(url, self.directory)
+        ]
+        if not urls:
+            print("All files already downloaded.")
+            return
+        if self.schedule is not None:
+            urls = schedule_urls(urls, self.schedule)
+        n_workers = min(self.n_workers, len(urls))
+
+        # spawn, because forking a process with a running event loop and threads isn't safe
+        context = multiprocessing.get_context("spawn")
+        budget = SharedBudget(
+            self.max_at_once, self.max_per_second, context, n_shards=n_workers
+        )
+        results = context.Queue()
+        workers = []
+        for shard in range(n_workers):
+            kwargs = dict(
+                self.downloader_kwargs,
+                max_at_once=self.max_at_once,
+                max_per_second=self.max_per_second,
+                manifest_name=(
+                    None
+                    if self.manifest_name is None
+                    else _shard_manifest_name(self.manifest_name, shard)
+                ),
+                metrics_name=f"{Path(self.metrics_name).stem}.shard{shard}{Path(self.metrics_name).suffix}",
+            )
+            worker = context.Process(
+                target=_run_shard,
+                name=f"download-shard{shard}",
+                args=(
+                    shard,
+                    urls[shard::n_workers],
+                    self.directory,
+                    budget,
+                    results,
+                    kwargs,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            workers.append(worker)
+
+        loop = asyncio.get_running_loop()
+        errors: List[str] = []
+        pending = dict(enumerate(workers))
+        dead: Dict[int, Optional[int]] = {}
+        try:
+            while pending:
+                try:
+                    result = await loop.run_in_executor(
+                        None, results.get, True, self.poll_interval
+                    )
+                    del pending[self._collect(result, errors)]
+                    continue
+                except queue.Empty:
+                    pass
+                exited = [
+                    shard for shard, worker in pending.items() if not worker.is_alive()
+                ]
+                # a worker puts its result before exiting, so collect any that arrived meanwhile
+                while True:
+                    try:
+                        del pending[self._collect(results.get_nowait(), errors)]
+                    except queue.Empty:
+                        break
+                for shard in exited:
+                    if shard in pending:
+                        dead[shard] = pending.pop(shard).exitcode
+                        # the other workers would otherwise wait on its slots forever
+                        budget.reclaim(shard)
+        finally:
+            for worker in pending.values():
+                worker.terminate()
+            for worker in workers:
+                await loop.run_in_executor(None, worker.join)
+            manifest = self._merge_manifest_shards()
+            for shard, exitcode in dead.items():
+                unfinished = [
+                    url
+                    for url in urls[shard::n_workers]
+                    if manifest is None or not manifest.is_complete(url, self.directory)
+                ]
+                self.failed_downloads[f"worker exited with code {exitcode}"].extend(
+                    unfinished
+                )
+            self.metrics.extra.update(
+                {
+                    "limit_max_at_once": self.max_at_once,
+                    "limit_max_per_second": self.max_per_second,
+                    "workers": n_workers,
+                }
+            )
+            self.metrics.dump(self.directory / self.metrics_name)
+        if errors:
+            raise RuntimeError("Download workers failed:\n" + "\n".join(errors))
+
+        if self.failed_downloads:
+            print("After exhausting retries, there were still failed downloads.")
+            for reason, url_list in self.failed_downloads.items():
+                print(f"{len(url_list)}\tfailures due to: {reason}")
+            print("Failed URLs will be output to fails_X.txt")
+            log_failures(self.directory, self.failed_downloads)
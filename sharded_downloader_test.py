@@ -0,0 +1,156 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+
+import merra_urls
+from async_downloader import merra2_file_from_url
+from download_manifest import DownloadManifest
+from fake_opendap_server import FakeOpendapServer
+from retry_policy import RetryPolicy
+from sharded_downloader import ShardedDownloader, SharedBudget
+
+URLS = list(
+    merra_urls.url_generator(
+        time_interval=(datetime(2020, 3, 1), datetime(2020, 3, 13)),
+        lat_interval=(26, 37),
+        lon_interval=(-107, -93),
+        collections=[
+            {
+                "collection": "tavg1_2d_slv_Nx",
+                "short_name": "M2T1NXSLV",
+                "fields": ["PS", "T10M"],
+            }
+        ],
+    )
+)
+
+
+def test_sharded_download(tmp_path):
+    with FakeOpendapServer(latency=0.05, max_concurrent=3) as server:
+        urls = list(server.localize_all(URLS))
+        downloader = ShardedDownloader(
+            tmp_path, n_workers=3, max_at_once=3, max_per_second=100
+        )
+        asyncio.run(downloader.download(urls))
+        # workers never exceed the shared concurrency budget
+        assert server.max_in_flight <= 3
+        assert server.stats[503] == 0
+        assert not downloader.failed_downloads
+        assert downloader.metrics.status_counts["200"] == len(urls)
+        assert len(list(tmp_path.glob("*.nc4"))) == len(urls)
+
+        manifest = DownloadManifest(tmp_path / "manifest.jsonl")
+        assert all(manifest.is_complete(url, tmp_path) for url in urls)
+        assert not list(tmp_path.glob("manifest.shard*"))
+        assert (tmp_path / "metrics.json").exists()
+
+        # a rerun skips everything, and reports only its own metrics
+        requests = server.stats[200]
+        asyncio.run(downloader.download(urls))
+        assert server.stats[200] == requests
+        assert not downloader.metrics.status_counts
+
+
+def test_sharded_failures(tmp_path):
+    with FakeOpendapServer(error_rate=0.3, seed=0) as server:
+        urls = list(server.localize_all(URLS))
+        downloader = ShardedDownloader(
+            tmp_path,
+            n_workers=2,
+            max_per_second=100,
+            retry_policy=RetryPolicy(retries=0),
+        )
+        asyncio.run(downloader.download(urls))
+        failed = downloader.failed_downloads[503]
+        assert len(failed) == server.stats[503] > 0
+        assert downloader.metrics.status_counts["503"] == len(failed)
+        assert downloader.metrics.status_counts["200"] == len(urls) - len(failed)
+        assert len(list(tmp_path.glob("fails_*.txt"))) == 1
+
+
+def test_dead_worker(tmp_path):
+    with FakeOpendapServer(latency=0.3) as server:
+        urls = list(server.localize_all(URLS))
+        downloader = ShardedDownloader(
+            tmp_path, n_workers=2, max_at_once=2, max_per_second=100, poll_interval=0.1
+        )
+
+        def kill_a_worker():
+            while server.stats[200] < 2:
+                time.sleep(0.01)
+            os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+
+        killer = threading.Thread(target=kill_a_worker, daemon=True)
+        killer.start()
+        asyncio.run(asyncio.wait_for(downloader.download(urls), 60))
+        killer.join()
+
+        # the dead worker's unfinished URLs are failures; the other worker finished
+        [(reason, failed)] = downloader.failed_downloads.items()
+        assert reason == f"worker exited with code {-signal.SIGKILL}"
+        assert 0 < len(failed) <= len(urls) // 2
+        manifest = DownloadManifest(tmp_path / "manifest.jsonl")
+        for url in urls:
+            assert manifest.is_complete(url, tmp_path) == (url not in failed)
+        assert len(list(tmp_path.glob("fails_*.txt"))) == 1
+
+
+def _hold_every_slot(budget, held):
+    budget.shard = 1
+    for _ in range(budget.max_at_once):
+        asyncio.run(budget.acquire())
+    held.set()
+    time.sleep(60)
+
+
+def test_budget_reclaims_dead_shards():
+    context = multiprocessing.get_context("spawn")
+    budget = SharedBudget(3, 1000, context, n_shards=2)
+    held = context.Event()
+    worker = context.Process(target=_hold_every_slot, args=(budget, held))
+    worker.start()
+    assert held.wait(30)
+    worker.kill()
+    worker.join()
+    assert budget.in_flight == 3
+    assert budget.reclaim(1) == 3
+    assert budget.in_flight == 0
+    asyncio.run(asyncio.wait_for(budget.acquire(), 5))
+    assert budget.reclaim(0) == 1 and budget.reclaim(1) == 0
+
+
+def test_dead_worker_holding_every_slot(tmp_path):
+    # with one slot, the killed worker is the one whose request is in flight
+    with FakeOpendapServer(latency=0.3) as server:
+        urls = list(server.localize_all(URLS))
+        shards = {merra2_file_from_url(url): i % 2 for i, url in enumerate(urls)}
+        downloader = ShardedDownloader(
+            tmp_path, n_workers=2, max_at_once=1, max_per_second=100, poll_interval=0.1
+        )
+
+        def kill_the_slot_holder():
+            while server.stats[200] < 2 or not server.paths_in_flight:
+                time.sleep(0.01)
+            shard = shards[merra2_file_from_url(server.paths_in_flight[0])]
+            [worker] = [
+                process
+                for process in multiprocessing.active_children()
+                if process.name == f"download-shard{shard}"
+            ]
+            os.kill(worker.pid, signal.SIGKILL)
+
+        killer = threading.Thread(target=kill_the_slot_holder, daemon=True)
+        killer.start()
+        asyncio.run(asyncio.wait_for(downloader.download(urls), 60))
+        killer.join()
+
+        # the other worker got the slot back and finished its whole shard
+        [failed] = downloader.failed_downloads.values()
+        assert 0 < len(failed) <= len(urls) // 2
+        manifest = DownloadManifest(tmp_path / "manifest.jsonl")
+        for url in urls:
+            assert manifest.is_complete(url, tmp_path) == (url not in failed)
@@ -0,0 +1,245 @@
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+Point = Tuple[float, float]
+
+# variables in degrees that wrap around at 360, such as merra_etl's wind direction
+CIRCULAR_VARIABLES = ("WDIR50M",)
+
+
+def _axis_weights(
+    x: np.ndarray, grid: np.ndarray, periodic: bool = False
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lower and upper grid indices around each of x, and the weight of the upper one"""
+    n = len(grid)
+    if n == 1:
+        if not np.allclose(x, grid[0]):
+            raise ValueError(f"Grid has a single value, {grid[0]}; given {x}")
+        zeros = np.zeros(len(x), dtype=np.int64)
+        return zeros, zeros, np.zeros(len(x))
+    step = (grid[-1] - grid[0]) / (n - 1)
+    if not np.allclose(np.diff(grid), step):
+        raise ValueError("Grid must be evenly spaced")
+    position = (x - grid[0]) / step
+    if periodic:
+        position = position % n
+        lower = np.floor(position).astype(np.int64)
+        return lower, (lower + 1) % n, position - lower
+    # tolerate float error at the edges
+    eps = 1e-9
+    outside = (position < -eps) | (position > n - 1 + eps)
+    if outside.any():
+        raise ValueError(
+            f"{x[outside][:5]} outside the grid's range [{grid[0]}, {grid[-1]}]"
+        )
+    position = np.clip(position, 0, n - 1)
+    lower = np.minimum(np.floor(position).astype(np.int64), n - 2)
+    return lower, lower + 1, position - lower
+
+
+def bilinear_weights(
+    sites: Union[Sequence[Point], np.ndarray],
+    lat: np.ndarray,
+    lon: np.ndarray,
+) -> scipy.sparse.csr_matrix:
+    """Sparse matrix of bilinear interpolation weights from a regular lat/lon grid, such as MERRA-2's 0.5° x 0.625° grid, to sites. Each row has the weights of the (up to) 4 grid points around one site, so interpolating every site at one time step is a product with the grid's values flattened in (lat, lon) order.
+
+    Longitude wraps around when the grid covers the globe, so sites between the last and first longitude (179.375° and 180° on MERRA-2's grid) are interpolated across the dateline.
+
+    Parameters
+    ----------
+    sites : Union[Sequence[Point], np.ndarray]
+        (lat, lon) of each site, in degrees
+    lat : np.ndarray
+        grid latitudes, ascending and evenly spaced
+    lon : np.ndarray
+        grid longitudes, ascending and evenly spaced
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        shape (number of sites, len(lat) * len(lon))
+
+    Raises
+    ------
+    ValueError
+        When a site is outside the grid, or the grid isn't evenly spaced
+    """
+    sites = np.asarray(sites, dtype=np.float64).reshape(-1, 2)
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    n_sites, n_lon = len(sites), len(lon)
+    global_lon = n_lon > 1 and np.isclose((lon[-1] - lon[0]) * n_lon / (n_lon - 1), 360)
+    i0, i1, di = _axis_weights(sites[:, 0], lat)
+    j0, j1, dj = _axis_weights(sites[:, 1], lon, periodic=global_lon)
+    rows = np.repeat(np.arange(n_sites), 4)
+    columns = np.stack(
+        [i0 * n_lon + j0, i0 * n_lon + j1, i1 * n_lon + j0, i1 * n_lon + j1], axis=1
+    )
+    weights = np.stack(
+        [(1 - di) * (1 - dj), (1 - di) * dj, di * (1 - dj), di * dj], axis=1
+    )
+    # repeated points are summed; zero weights (sites on grid lines) aren't stored
+    matrix = scipy.sparse.csr_matrix(
+        (weights.reshape(-1), (rows, columns.reshape(-1))),
+        shape=(n_sites, len(lat) * n_lon),
+    )
+    matrix.eliminate_zeros()
+    return matrix
+
+
+class WeightCache(object):
+    def __init__(
+        self, directory: Optional[Union[str, Path]] = None, max_entries: int = 16
+    ) -> None:
+        """Interpolation weights keyed by site list and grid, so recurring site sets are interpolated without recomputing their weights. Entries are kept in memory, least recently used first out, and also saved to directory if given, so they're reused across processes.
+
+        Parameters
+        ----------
+        directory : Optional[Union[str, Path]], optional
+            where to save weights as .npz files, by default None to keep them in memory only
+        max_entries : int, optional
+            weight matrices kept in memory, by default 16
+
+        Example
+        -------
+        cache = WeightCache(Path('./cache/weights'))
+        interpolate_to_sites(ds, turbines, cache)  # computes and saves the weights
+        interpolate_to_sites(ds_next_month, turbines, cache)  # reuses them
+        """
+        self.directory = None if directory is None else Path(directory)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, scipy.sparse.csr_matrix]" = OrderedDict()
+
+    @staticmethod
+    def key(sites: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> str:
+        digest = hashlib.sha1()
+        for values in (sites, lat, lon):
+            digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+            digest.update(b"|")
+        return digest.hexdigest()
+
+    def weights(
+        self,
+        sites: Union[Sequence[Point], np.ndarray],
+        lat: np.ndarray,
+        lon: np.ndarray,
+    ) -> scipy.sparse.csr_matrix:
+        """bilinear_weights(sites, lat, lon), from the cache if available"""
+        sites = np.asarray(sites, dtype=np.float64).reshape(-1, 2)
+        key = self.key(sites, lat, lon)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        path = None if self.directory is None else self.directory / f"{key}.npz"
+        if path is not None and path.exists():
+            weights = scipy.sparse.load_npz(path).tocsr()
+        else:
+            weights = bilinear_weights(sites, lat, lon)
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(f"{key}.tmp.npz")
+                scipy.sparse.save_npz(tmp_path, weights)
+                tmp_path.replace(path)
+        self._entries[key] = weights
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return weights
+
+
+def _apply_weights(values: np.ndarray, weights: scipy.sparse.csr_matrix) -> np.ndarray:
+    """Interpolate values with dims (..., lat, lon) to sites, as (..., site)"""
+    dtype = np.result_type(values.dtype, np.float32)
+    n_sites, n_cells = weights.shape
+    flat = values.reshape(-1, n_cells).astype(dtype, copy=False)
+    sites = weights.astype(dtype) @ flat.T
+    return np.ascontiguousarray(sites.T).reshape(values.shape[:-2] + (n_sites,))
+
+
+def _apply_weights_circular(
+    values: np.ndarray, weights: scipy.sparse.csr_matrix
+) -> np.ndarray:
+    """As _apply_weights for angles in degrees: interpolates the unit vector and converts it back to an angle in [0, 360)"""
+    dtype = np.result_type(values.dtype, np.float32)
+    radians = np.radians(values.astype(dtype, copy=False))
+    sin = _apply_weights(np.sin(radians), weights)
+    cos = _apply_weights(np.cos(radians), weights)
+    angle = np.mod(np.degrees(np.arctan2(sin, cos)), 360).astype(dtype, copy=False)
+    # tiny negative angles round up to 360 in float32
+    angle[angle >= 360] = 0
+    return angle
+
+
+def interpolate_to_sites(
+    ds: xr.Dataset,
+    sites: Union[Sequence[Point], np.ndarray],
+    cache: Optional[WeightCache] = None,
+    circular: Sequence[str] = CIRCULAR_VARIABLES,
+) -> xr.Dataset:
+    """Bilinear interpolation of every variable with lat and lon dims to many sites at once, such as turbine coordinates. The weights are computed once for the site list (see bilinear_weights) and applied to all time steps of a variable as a single sparse matrix product, rather than per site or per time step. Works on loaded and dask backed datasets, such as open_merra's or xr.open_zarr of merra_nc4_to_zarr's output.
+
+    Angles in degrees, such as WDIR50M, can't be interpolated linearly: halfway between 350° and 10° is 0°, not 180°. For the circular variables the sine and cosine are interpolated instead, with the same weights, and recombined with arctan2 into [0, 360).
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dataset on a regular lat/lon grid, such as MERRA-2's 0.5° x 0.625° grid
+    sites : Union[Sequence[Point], np.ndarray]
+        (lat, lon) of each site, in degrees
+    cache : Optional[WeightCache], optional
+        cache of weights to use and fill, by default None to compute them
+    circular : Sequence[str], optional
+        names of variables holding angles in degrees, by default CIRCULAR_VARIABLES
+
+    Returns
+    -------
+    xr.Dataset
+        variables with the lat and lon dims replaced by a site dim, and site_lat and site_lon coordinates. Integer variables are returned as float64, others as at least float32.
+
+    Raises
+    ------
+    ValueError
+        When a site is outside ds's grid
+
+    Example
+    -------
+    turbines = [(39.91, -105.23), (41.25, -95.47)]
+    interpolate_to_sites(merra_etl.open_merra(files), turbines)['WS50M'].to_pandas()
+    """
+    sites = np.asarray(sites, dtype=np.float64).reshape(-1, 2)
+    lat, lon = ds.lat.values, ds.lon.values
+    if cache is None:
+        weights = bilinear_weights(sites, lat, lon)
+    else:
+        weights = cache.weights(sites, lat, lon)
+    gridded = [
+        name for name, var in ds.data_vars.items() if {"lat", "lon"} <= set(var.dims)
+    ]
+    out = xr.Dataset(
+        {
+            name: xr.apply_ufunc(
+                _apply_weights_circular if name in circular else _apply_weights,
+                ds[name],
+                kwargs={"weights": weights},
+                input_core_dims=[["lat", "lon"]],
+                output_core_dims=[["site"]],
+                dask="parallelized",
+                output_dtypes=[np.result_type(ds[name].dtype, np.float32)],
+                dask_gufunc_kwargs={
+                    "output_sizes": {"site": len(sites)},
+                    "allow_rechunk": True,
+                },
+                keep_attrs=True,
+            )
+            for name in gridded
+        },
+        attrs=ds.attrs,
+    )
+    return out.assign_coords(
+        site_lat=("site", sites[:, 0]), site_lon=("site", sites[:, 1])
+    )
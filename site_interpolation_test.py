@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import merra_etl
+from site_interpolation import (
+    CIRCULAR_VARIABLES,
+    WeightCache,
+    bilinear_weights,
+    interpolate_to_sites,
+)
+
+RNG = np.random.default_rng(0)
+
+
+def test_bilinear_weights():
+    lat = np.arange(20, 30.5, 0.5)
+    lon = np.arange(-100, -90, 0.625)
+    sites = np.column_stack([RNG.uniform(20, 30, 50), RNG.uniform(-100, -90.625, 50)])
+    weights = bilinear_weights(sites, lat, lon)
+    assert weights.shape == (50, len(lat) * len(lon))
+    assert weights.getnnz(axis=1).max() <= 4
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+
+    # exact for a field linear in lat and lon, including on the grid's edges
+    field = np.add.outer(3 * lat, -2 * lon)
+    edges = np.array([[20, -100], [30, -90.625], [30, -95]])
+    for points in (sites, edges):
+        np.testing.assert_allclose(
+            bilinear_weights(points, lat, lon) @ field.reshape(-1),
+            3 * points[:, 0] - 2 * points[:, 1],
+        )
+
+    # global grids wrap across the dateline
+    global_lon = -180 + 0.625 * np.arange(576)
+    row = bilinear_weights([(25, 179.6875)], lat, global_lon)
+    assert set(row.indices % 576) == {0, 575}
+    np.testing.assert_allclose(row.data, 0.5)
+
+    with pytest.raises(ValueError):
+        bilinear_weights([(35, -95)], lat, lon)
+    with pytest.raises(ValueError):
+        bilinear_weights([(25, -95)], lat, lon**2)
+
+
+def test_interpolate_to_sites(tmp_path, write_daily_files):
+    files = write_daily_files(tmp_path / "nc4")
+    with merra_etl.open_merra(files) as ds:
+        ds = merra_etl.transforms(ds.load())
+    sites = np.column_stack(
+        [
+            RNG.uniform(ds.lat.min(), ds.lat.max(), 200),
+            RNG.uniform(ds.lon.min(), ds.lon.max(), 200),
+        ]
+    )
+    out = interpolate_to_sites(ds, sites)
+    expected = ds.interp(
+        lat=xr.DataArray(sites[:, 0], dims="site"),
+        lon=xr.DataArray(sites[:, 1], dims="site"),
+    )
+    assert out["TS"].dims == ("time", "site")
+    for name in set(ds.data_vars) - set(CIRCULAR_VARIABLES):
+        np.testing.assert_allclose(
+            out[name].values, expected[name].values, rtol=1e-5, atol=1e-3
+        )
+    np.testing.assert_array_equal(out.site_lat, sites[:, 0])
+
+    # dask backed data gives the same result
+    chunked = interpolate_to_sites(ds.chunk(time=24, lat=2), sites)
+    np.testing.assert_allclose(chunked["TS"].values, out["TS"].values, rtol=1e-6)
+
+    cache = WeightCache(tmp_path / "weights")
+    cached = interpolate_to_sites(ds, sites, cache)
+    assert len(list((tmp_path / "weights").glob("*.npz"))) == 1
+    assert cache.weights(sites, ds.lat.values, ds.lon.values) is cache.weights(
+        sites.tolist(), ds.lat.values, ds.lon.values
+    )
+    reloaded = WeightCache(tmp_path / "weights").weights(
+        sites, ds.lat.values, ds.lon.values
+    )
+    assert (reloaded != bilinear_weights(sites, ds.lat, ds.lon)).nnz == 0
+    xr.testing.assert_identical(cached, out)
+
+
+def test_interpolate_directions():
+    # directions straddling north: the average of 350° and 10° is 0°, not 180°
+    wdir = np.array([[[350.0, 10.0], [340.0, 20.0]]], dtype=np.float32)
+    ds = xr.Dataset(
+        {
+            "WDIR50M": (("time", "lat", "lon"), wdir),
+            "WS50M": (("time", "lat", "lon"), wdir),
+        },
+        coords={"time": [0], "lat": [40.0, 40.5], "lon": [-100.0, -99.375]},
+    )
+    sites = [(40.0, -99.6875), (40.5, -99.6875), (40.25, -99.6875), (40.0, -99.84375)]
+    out = interpolate_to_sites(ds, sites)
+    assert out["WDIR50M"].dtype == np.float32
+    # a quarter of the way from 350° to 10°, by the unit vector's angle
+    quarter = np.degrees(np.arctan(-0.5 * np.tan(np.radians(10))))
+    np.testing.assert_allclose(
+        np.mod(out["WDIR50M"].values[0] + 180, 360) - 180,
+        [0, 0, 0, quarter],
+        atol=1e-3,
+    )
+    assert ((out["WDIR50M"] >= 0) & (out["WDIR50M"] < 360)).all()
+    # other variables are still interpolated linearly
+    np.testing.assert_allclose(out["WS50M"].values[0], [180, 180, 180, 265])
+    linear = interpolate_to_sites(ds, sites, circular=())
+    np.testing.assert_allclose(linear["WDIR50M"].values[0], [180, 180, 180, 265])
@@ -0,0 +1,176 @@
+import heapq
+import itertools
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import merra_urls
+
+Slab = Tuple[int, int]
+Point = Tuple[float, float]
+Box = Tuple[Tuple[float, float], Tuple[float, float]]
+
+
+class SiteRequest(NamedTuple):
+    """One bounding box to request. Slabs are inclusive MERRA-2 index ranges; sites are positions in the input site list."""
+
+    lat: Slab
+    lon: Slab
+    sites: List[int]
+
+    @property
+    def n_cells(self) -> int:
+        return _n_cells((self.lat, self.lon))
+
+
+def site_slabs(site: Union[Point, Box]) -> Tuple[Slab, Slab]:
+    """Index slabs of a (lat, lon) point or a ((lat_min, lat_max), (lon_min, lon_max)) box"""
+    lat, lon = site
+    if isinstance(lat, (tuple, list)):
+        lat_slab = (
+            merra_urls.lat_to_index_num(lat[0]),
+            merra_urls.lat_to_index_num(lat[1]),
+        )
+        lon_slab = (merra_urls.lon_to_index_num(lon[0]), merra_urls.lon_to_index_num(lon[1]))  # type: ignore
+        return lat_slab, lon_slab
+    i, j = merra_urls.lat_to_index_num(lat), merra_urls.lon_to_index_num(lon)
+    return (i, i), (j, j)
+
+
+def _union(a: Tuple[Slab, Slab], b: Tuple[Slab, Slab]) -> Tuple[Slab, Slab]:
+    return (
+        (min(a[0][0], b[0][0]), max(a[0][1], b[0][1])),
+        (min(a[1][0], b[1][0]), max(a[1][1], b[1][1])),
+    )
+
+
+def _n_cells(box: Tuple[Slab, Slab]) -> int:
+    return (box[0][1] - box[0][0] + 1) * (box[1][1] - box[1][0] + 1)
+
+
+def coalesce_sites(
+    sites: Sequence[Union[Point, Box]],
+    collections: Sequence[dict],
+    request_overhead: float = 1.0,
+    bandwidth: float = 5e6,
+    bytes_per_value: int = 4,
+    max_cells: Optional[int] = None,
+) -> List[SiteRequest]:
+    """Group scattered sites into bounding boxes that minimize estimated download time.
+
+    Estimated time for one box is, per collection, request_overhead + bytes / bandwidth, where bytes = 24 hours * fields * cells * bytes_per_value. Starting from one box per site, the pair of boxes whose merge saves the most time is merged repeatedly until no merge saves time. A few large boxes waste bytes on cells nobody asked for; many tiny boxes are dominated by per-request latency. This finds a middle ground.
+
+    Parameters
+    ----------
+    sites : Sequence[Union[Point, Box]]
+        (lat, lon) points and/or ((lat_min, lat_max), (lon_min, lon_max)) boxes, in degrees
+    collections : Sequence[dict]
+        collections as passed to merra_urls.url_generator; used for field counts
+    request_overhead : float, optional
+        fixed seconds per request (latency, server processing), by default 1.0
+    bandwidth : float, optional
+        bytes per second per request, by default 5e6
+    bytes_per_value : int, optional
+        size of each value in the response, by default 4 (float32)
+    max_cells : Optional[int], optional
+        upper limit on grid cells per box, by default None for no limit
+
+    Returns
+    -------
+    List[SiteRequest]
+        boxes to request, each listing the sites it covers
+    """
+    n_requests = len(collections)
+    values_per_cell = 24 * sum(len(c["fields"]) for c in collections)
+    seconds_per_cell = values_per_cell * bytes_per_value / bandwidth
+
+    def cost(box: Tuple[Slab, Slab]) -> float:
+        return n_requests * request_overhead + _n_cells(box) * seconds_per_cell
+
+    boxes: Dict[int, Tuple[Slab, Slab]] = {}
+    members: Dict[int, List[int]] = {}
+    # identical slabs merge for free, so start from unique slabs
+    by_slab: Dict[Tuple[Slab, Slab], int] = {}
+    for site_num, site in enumerate(sites):
+        slabs = site_slabs(site)
+        if slabs in by_slab:
+            members[by_slab[slabs]].append(site_num)
+            continue
+        by_slab[slabs] = len(boxes)
+        boxes[len(boxes)] = slabs
+        members[len(members)] = [site_num]
+
+    heap: List[Tuple[float, int, int]] = []
+
+    def push_pair(a: int, b: int) -> None:
+        merged = _union(boxes[a], boxes[b])
+        if max_cells is not None and _n_cells(merged) > max_cells:
+            return
+        saving = cost(boxes[a]) + cost(boxes[b]) - cost(merged)
+        if saving > 0:
+            heapq.heappush(heap, (-saving, a, b))
+
+    for a, b in itertools.combinations(boxes, 2):
+        push_pair(a, b)
+    next_id = len(boxes)
+    while heap:
+        _, a, b = heapq.heappop(heap)
+        if a not in boxes or b not in boxes:  # stale pair; one side was merged already
+            continue
+        merged_box = _union(boxes.pop(a), boxes.pop(b))
+        boxes[next_id] = merged_box
+        members[next_id] = members.pop(a) + members.pop(b)
+        for other in list(boxes):
+            if other != next_id:
+                push_pair(other, next_id)
+        next_id += 1
+
+    return [
+        SiteRequest(lat=box[0], lon=box[1], sites=sorted(members[box_id]))
+        for box_id, box in sorted(boxes.items(), key=lambda item: item[1])
+    ]
+
+
+def site_offsets(
+    requests: Sequence[SiteRequest], sites: Sequence[Union[Point, Box]]
+) -> Dict[int, Tuple[int, slice, slice]]:
+    """Where each site's data sits in the planned responses.
+
+    Returns
+    -------
+    Dict[int, Tuple[int, slice, slice]]
+        site position -> (request position, lat slice, lon slice), where the slices index the lat and lon dims of that request's response
+    """
+    out = {}
+    for request_num, request in enumerate(requests):
+        for site_num in request.sites:
+            lat, lon = site_slabs(sites[site_num])
+            out[site_num] = (
+                request_num,
+                slice(lat[0] - request.lat[0], lat[1] - request.lat[0] + 1),
+                slice(lon[0] - request.lon[0], lon[1] - request.lon[0] + 1),
+            )
+    return out
+
+
+def planned_urls(
+    requests: Sequence[SiteRequest], time_interval, collections: Sequence[dict]
+) -> Dict[str, int]:
+    """Render requests as OPeNDAP URLs with merra_urls.url_generator.
+
+    Returns
+    -------
+    Dict[str, int]
+        URL -> position of its request in requests
+    """
+    out = {}
+    for request_num, request in enumerate(requests):
+        # index -> degrees, which url_generator maps back to the same index
+        lat_interval = tuple(-90 + 0.5 * i for i in request.lat)
+        lon_interval = tuple(-180 + 0.625 * j for j in request.lon)
+        for url in merra_urls.url_generator(
+            time_interval=time_interval,
+            lat_interval=lat_interval,
+            lon_interval=lon_interval,
+            collections=collections,
+        ):
+            out[url] = request_num
+    return out
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import merra_urls
+import site_planner
+
+COLLECTIONS = [
+    {
+        "collection": "tavg1_2d_slv_Nx",
+        "short_name": "M2T1NXSLV",
+        "fields": ["PS", "T10M", "U50M", "V50M"],
+    }
+]
+
+
+def test_nearby_points_are_merged():
+    sites = [(40.0, -100.0), (40.5, -100.0), (40.0, -99.375)]
+    requests = site_planner.coalesce_sites(sites, COLLECTIONS)
+    assert len(requests) == 1
+    assert requests[0].sites == [0, 1, 2]
+    assert requests[0].n_cells == 4
+
+
+def test_distant_points_stay_separate():
+    sites = [(40.0, -100.0), (-30.0, 20.0), (40.0, -99.375)]
+    requests = site_planner.coalesce_sites(sites, COLLECTIONS)
+    assert sorted(r.sites for r in requests) == [[0, 2], [1]]
+
+
+def test_cost_model_controls_merging():
+    sites = [(40.0, -100.0), (45.0, -100.0)]
+    # cheap requests: not worth fetching the 9 cells in between
+    assert (
+        len(site_planner.coalesce_sites(sites, COLLECTIONS, request_overhead=0.0)) == 2
+    )
+    # expensive requests: one box is faster
+    assert (
+        len(site_planner.coalesce_sites(sites, COLLECTIONS, request_overhead=10.0)) == 1
+    )
+    capped = site_planner.coalesce_sites(
+        sites, COLLECTIONS, request_overhead=10.0, max_cells=5
+    )
+    assert len(capped) == 2
+
+
+def test_site_offsets_and_urls():
+    sites = [(40.0, -100.0), ((41.0, 42.0), (-100.0, -98.75)), (-30.0, 20.0)]
+    requests = site_planner.coalesce_sites(sites, COLLECTIONS)
+    offsets = site_planner.site_offsets(requests, sites)
+    assert set(offsets) == {0, 1, 2}
+    for site_num, (request_num, lat_slice, lon_slice) in offsets.items():
+        request = requests[request_num]
+        assert site_num in request.sites
+        lat, lon = site_planner.site_slabs(sites[site_num])
+        assert request.lat[0] + lat_slice.start == lat[0]
+        assert request.lat[0] + lat_slice.stop - 1 == lat[1]
+        assert request.lon[0] + lon_slice.start == lon[0]
+        assert request.lon[0] + lon_slice.stop - 1 == lon[1]
+
+    time_interval = (datetime(2020, 1, 1), datetime(2020, 1, 3))
+    urls = site_planner.planned_urls(requests, time_interval, COLLECTIONS)
+    assert len(urls) == 2 * len(requests)
+    for url, request_num in urls.items():
+        parsed = merra_urls.parse_url(url)
+        assert parsed["lat"] == requests[request_num].lat
+        assert parsed["lon"] == requests[request_num].lon
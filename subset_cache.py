@@ -0,0 +1,248 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import xarray as xr
+
+import merra_urls
+from async_downloader import AsyncDownloader, merra2_file_from_url
+from download_sinks import CallbackSink
+
+Slab = Tuple[int, int]
+
+
+def _covers(outer: Slab, inner: Slab) -> bool:
+    return outer[0] <= inner[0] and inner[1] <= outer[1]
+
+
+class SubsetCache(object):
+    def __init__(
+        self, directory: Union[str, Path], max_bytes: int = 10 * 2**30
+    ) -> None:
+        """Local cache of OPeNDAP subsets, shared between requests with overlapping variables, dates and bounding boxes.
+
+        Each downloaded response is split into one netCDF file per variable. Entries are keyed by (collection, date, variable, index slab) and stored under a hash of that key. A request is answered from any cached entry whose slab contains the requested slab, by slicing it. Only (date, variable) pairs with no covering entry are downloaded; a request that partly overlaps a cached slab fetches its full slab for that variable.
+
+        When the cache grows beyond max_bytes, least recently used entries are evicted.
+
+        Parameters
+        ----------
+        directory : Union[str, Path]
+            cache directory. Will be created if needed.
+        max_bytes : int, optional
+            disk budget for cached entries, by default 10 GiB
+
+        Example
+        -------
+        cache = SubsetCache(Path('./cache/'), max_bytes=50 * 2**30)
+        files = asyncio.run(cache.download(urls, Path('./data/')))
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._index_path = self.directory / "index.json"
+        self._lock = threading.RLock()
+        self.entries: Dict[str, Dict] = {}
+        self.failed_downloads: Dict = {}
+        if self._index_path.exists():
+            self.entries = json.loads(self._index_path.read_text())
+
+    @staticmethod
+    def _key(collection: str, date: str, variable: str, slabs: Dict[str, Slab]) -> str:
+        raw = f"{collection}/{date}/{variable}/" + "/".join(
+            f"{dim}{slabs[dim][0]}-{slabs[dim][1]}" for dim in ("time", "lat", "lon")
+        )
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.nc"
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def save(self) -> None:
+        with self._lock:
+            tmp_path = self._index_path.with_name("index.json.tmp")
+            tmp_path.write_text(json.dumps(self.entries))
+            os.replace(tmp_path, self._index_path)
+
+    @staticmethod
+    def _request(url: str) -> Tuple[Dict, Dict[str, Slab]]:
+        parsed = merra_urls.parse_url(url)
+        slabs = {
+            "time": parsed["time"] or (0, 23),
+            "lat": parsed["lat"] or (0, 360),
+            "lon": parsed["lon"] or (0, 575),
+        }
+        return parsed, slabs
+
+    def lookup(
+        self, collection: str, date: str, variable: str, slabs: Dict[str, Slab]
+    ) -> Optional[str]:
+        """Key of a cached entry covering slabs, or None. Prefers the smallest such entry."""
+        with self._lock:
+            candidates = [
+                (entry["size"], key)
+                for key, entry in self.entries.items()
+                if entry["collection"] == collection
+                and entry["date"] == date
+                and entry["variable"] == variable
+                and all(_covers(entry[dim], slabs[dim]) for dim in slabs)
+            ]
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    def missing(self, url: str) -> Optional[str]:
+        """URL for the fields of url that aren't cached, or None if url can be answered from the cache"""
+        parsed, slabs = self._request(url)
+        date = parsed["date"].strftime("%Y%m%d")
+        fields = [
+            field
+            for field in parsed["fields"]
+            if self.lookup(parsed["collection"], date, field, slabs) is None
+        ]
+        if not fields:
+            return None
+        if fields == parsed["fields"]:
+            return url
+        query = merra_urls.build_query(
+            fields, slabs["time"], slabs["lat"], slabs["lon"]
+        )
+        return urlunsplit(urlsplit(url)._replace(query=query))
+
+    def add(self, url: str, body: bytes, evict: bool = True) -> None:
+        """Split a downloaded response into per-variable entries and store them. Cached entries made redundant by the new slab are removed. If evict, then evict older entries to fit the disk budget."""
+        parsed, slabs = self._request(url)
+        date = parsed["date"].strftime("%Y%m%d")
+        with xr.open_dataset(io.BytesIO(body)) as ds:
+            ds.load()
+        new_keys = []
+        for variable in parsed["fields"]:
+            key = self._key(parsed["collection"], date, variable, slabs)
+            new_keys.append(key)
+            path = self._path(key)
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(path.name + ".part")
+            ds[[variable]].to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+            with self._lock:
+                for old_key, entry in list(self.entries.items()):
+                    if (
+                        old_key != key
+                        and entry["collection"] == parsed["collection"]
+                        and entry["date"] == date
+                        and entry["variable"] == variable
+                        and all(_covers(slabs[dim], entry[dim]) for dim in slabs)
+                    ):
+                        self._remove(old_key)
+                self.entries[key] = {
+                    "collection": parsed["collection"],
+                    "date": date,
+                    "variable": variable,
+                    "size": path.stat().st_size,
+                    "last_access": time.time(),
+                    **slabs,
+                }
+        if evict:
+            self.evict(protect=new_keys)
+
+    def _remove(self, key: str) -> None:
+        with self._lock:
+            self.entries.pop(key, None)
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def evict(self, protect: Iterable[str] = ()) -> None:
+        """Remove least recently used entries until the cache fits in max_bytes. Keys in protect are kept."""
+        protect = set(protect)
+        with self._lock:
+            total = self.nbytes
+            by_age = sorted(self.entries, key=lambda k: self.entries[k]["last_access"])
+            for key in by_age:
+                if total <= self.max_bytes:
+                    break
+                if key in protect:
+                    continue
+                total -= self.entries[key]["size"]
+                self._remove(key)
+            self.save()
+
+    def extract(self, url: str, file_out: Path) -> Path:
+        """Write the subset requested by url to file_out, sliced from cached entries. Raises KeyError if any field isn't cached."""
+        parsed, slabs = self._request(url)
+        date = parsed["date"].strftime("%Y%m%d")
+        pieces = []
+        for variable in parsed["fields"]:
+            # held until the slice is read, so eviction can't remove the entry in between
+            with self._lock:
+                key = self.lookup(parsed["collection"], date, variable, slabs)
+                if key is None:
+                    raise KeyError(f"{variable} for {date} is not cached")
+                entry = self.entries[key]
+                entry["last_access"] = time.time()
+                offsets = {
+                    dim: slice(
+                        slabs[dim][0] - entry[dim][0], slabs[dim][1] - entry[dim][0] + 1
+                    )
+                    for dim in slabs
+                }
+                with xr.open_dataset(self._path(key)) as ds:
+                    pieces.append(ds.isel(offsets).load())
+        tmp_path = file_out.with_name(file_out.name + ".part")
+        xr.merge(pieces).to_netcdf(tmp_path)
+        os.replace(tmp_path, file_out)
+        return file_out
+
+    async def download(
+        self, urls: Iterable[str], directory: Union[str, Path], **downloader_kwargs
+    ) -> List[Path]:
+        """Answer urls from the cache, downloading only what's missing. Writes one file per URL to directory, named as AsyncDownloader would.
+
+        Parameters
+        ----------
+        urls : Iterable[str]
+            URLs from merra_urls.url_generator
+        directory : Union[str, Path]
+            output directory
+        **downloader_kwargs
+            passed to AsyncDownloader, whose metrics and failure logs go to the cache's downloads/ directory rather than directory
+
+        Returns
+        -------
+        List[Path]
+            output files. URLs whose downloads failed are skipped; see self.failed_downloads.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        urls = list(urls)
+        to_fetch = [u for u in (self.missing(url) for url in urls) if u is not None]
+        self.failed_downloads = {}
+        if to_fetch:
+            # bodies go straight to the cache, so only the downloader's metrics and failure logs land here, not next to the user's files
+            downloader = AsyncDownloader(
+                self.directory / "downloads",
+                # evict after extracting, so this request's entries aren't evicted before they're used
+                sink=CallbackSink(lambda url, body: self.add(url, body, evict=False)),
+                **downloader_kwargs,
+            )
+            await downloader.download(to_fetch)
+            self.failed_downloads = dict(downloader.failed_downloads)
+        outputs = []
+        for url in urls:
+            file_out = directory / merra2_file_from_url(urlsplit(url).path)
+            try:
+                outputs.append(self.extract(url, file_out))
+            except KeyError:
+                continue
+        self.evict()
+        return outputs
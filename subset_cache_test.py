@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import xarray as xr
+
+import merra_urls
+from fake_opendap_server import FakeOpendapServer
+from subset_cache import SubsetCache
+
+
+def make_urls(lat_interval, lon_interval, fields):
+    return list(
+        merra_urls.url_generator(
+            time_interval=(datetime(2020, 1, 1), datetime(2020, 1, 3)),
+            lat_interval=lat_interval,
+            lon_interval=lon_interval,
+            collections=[
+                {
+                    "collection": "tavg1_2d_slv_Nx",
+                    "short_name": "M2T1NXSLV",
+                    "fields": fields,
+                }
+            ],
+        )
+    )
+
+
+def test_superset_reuse(tmp_path):
+    cache = SubsetCache(tmp_path / "cache")
+    big = make_urls((20, 40), (-110, -90), ["PS", "TS"])
+    small = make_urls((26, 30), (-100, -95), ["TS"])
+    with FakeOpendapServer() as server:
+        files = asyncio.run(cache.download(server.localize_all(big), tmp_path / "big"))
+        assert server.stats[200] == 2
+        # only the extracted files go to the output directory, no metrics or logs
+        assert set((tmp_path / "big").iterdir()) == set(files)
+
+        files = asyncio.run(
+            cache.download(server.localize_all(small), tmp_path / "small")
+        )
+        assert server.stats[200] == 2  # answered from cache
+        ds = xr.open_dataset(files[0])
+        assert list(ds.data_vars) == ["TS"]
+        assert float(ds.lat[0]) == 26.0 and float(ds.lon[-1]) == -95.0
+
+        # only the uncached variable is fetched
+        extra = make_urls((26, 30), (-100, -95), ["TS", "T10M"])
+        asyncio.run(cache.download(server.localize_all(extra), tmp_path / "extra"))
+        assert server.stats[200] == 4
+        assert len(cache.entries) == 6
+
+    # cache persists between instances
+    assert len(SubsetCache(tmp_path / "cache").entries) == 6
+
+
+def test_eviction(tmp_path):
+    cache = SubsetCache(tmp_path / "cache")
+    urls = make_urls((26, 30), (-100, -95), ["PS", "TS"])
+    with FakeOpendapServer() as server:
+        asyncio.run(cache.download(server.localize_all(urls[:1]), tmp_path / "out"))
+        cache.max_bytes = int(cache.nbytes * 1.25)  # room for one day plus a bit
+        files = asyncio.run(
+            cache.download(server.localize_all(urls[1:]), tmp_path / "out")
+        )
+    assert len(files) == 1
+    assert {entry["date"] for entry in cache.entries.values()} == {"20200102"}
+    assert len(list((tmp_path / "cache").glob("*/*.nc"))) == 2
+
+
+def test_eviction_waits_for_extract(tmp_path):
+    cache = SubsetCache(tmp_path / "cache")
+    urls = make_urls((26, 30), (-100, -95), ["TS"])
+    with FakeOpendapServer() as server:
+        url = next(iter(server.localize_all(urls[:1])))
+        asyncio.run(cache.download([url], tmp_path / "out"))
+
+    # evict everything from another thread right after extract finds its entry
+    lookup = cache.lookup
+    evictor = threading.Thread(target=cache.evict)
+
+    def lookup_then_evict(*args):
+        key = lookup(*args)
+        cache.max_bytes = 0
+        evictor.start()
+        evictor.join(0.2)
+        return key
+
+    cache.lookup = lookup_then_evict  # type: ignore
+    path = cache.extract(url, tmp_path / "extracted.nc4")
+    evictor.join()
+    with xr.open_dataset(path) as ds:
+        assert list(ds.data_vars) == ["TS"]
+    assert not cache.entries